@@ -0,0 +1,386 @@
+"""
+asyncio HTTP gateway module.
+
+An ASGI application with the same routes as the Flask gateway. Request bodies
+are read and responses written without blocking, so slow clients uploading or
+downloading large studies do not hold an OS thread each. Handlers can be
+coroutine functions, which run on the event loop, or regular functions, which
+run in a bounded thread pool.
+
+Parsing the body, which writes large parts to temporary files, and producing
+the response, which expands and copies the binary parts, run in the thread
+pool one chunk at a time, so they never block the event loop.
+
+Run it with any ASGI server, e.g. uvicorn:
+
+    uvicorn.run(app, host='0.0.0.0', port=8000)
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import email.message
+import functools
+import inspect
+import logging
+
+from gateway import InferenceRequest, InferenceSerializer, InvalidRequestError
+from utils import digest
+from utils import lazy_instances
+from utils import multipart
+
+logger = logging.getLogger('async_gateway')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def _close_parser(parser, parsing=None):
+    """Close the part a parser was writing when its body failed.
+
+    :param utils.multipart.MultipartParser parser: the parser to close.
+    :param concurrent.futures.Future parsing: optional call of the parser
+     that completed after the request failed, the parts it returned are
+     closed too.
+    """
+    if parsing is not None and not parsing.cancelled() and parsing.exception() is None:
+        for part in parsing.result() or []:
+            part.close()
+    with contextlib.suppress(multipart.MultipartError):
+        parser.close()
+
+
+class AsyncGateway():
+    """ASGI gateway to receive multipart requests
+
+    :param int max_workers: number of threads used to run regular (non
+     coroutine) handlers, to parse request bodies and to serialize and encode
+     model outputs.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        # Same keys and meaning as the config of the Flask gateway
+        self.config = {
+            'MULTIPART_SPILL_THRESHOLD': multipart.DEFAULT_SPILL_THRESHOLD,
+            'MULTIPART_SPILL_DIR': None,
+            'MULTIPART_CHUNK_SIZE': multipart.DEFAULT_CHUNK_SIZE,
+            'HASH_ALGORITHM': digest.DEFAULT_ALGORITHM,
+        }
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='model'
+        )
+        self._part_hasher = digest.PartHasher()
+        self._serializer = InferenceSerializer(self._part_hasher)
+        self._routes = {}
+        self._model_routes = {}
+        self._in_flight = {}
+        self.coalesced_requests = 0
+        self._add_route('/ping', self._pong, ['GET', 'POST'])
+
+    def add_healthcheck_route(self, handler_fn):
+        """ Add a handler for the healthcheck route
+
+        The handler takes no arguments and returns the body as a string, or a
+        (body, status) tuple. It can be a coroutine function.
+        """
+
+        async def healthcheck(scope, receive, send):
+            if inspect.iscoroutinefunction(handler_fn):
+                response = await handler_fn()
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self._executor, handler_fn)
+
+            status = 200
+            if isinstance(response, tuple):
+                response, status = response
+            await self._send_text(send, status, response)
+
+        self._add_route('/healthcheck', healthcheck, ['GET', 'POST'])
+
+    def add_inference_route(self, route, model_fn, result_cache=None, coalesce=False,
+                            lazy_instances=False):
+        """Add a callback function and unique route.
+
+        :param callable model_fn: callback function to use for the backend of
+         the provided route. Coroutine functions are awaited on the event
+         loop, other functions run in the thread pool.
+        :param str route: URL path at which to listen for the route.
+        :param utils.result_cache.ResultCache result_cache: optional cache of the
+         responses of this route, keyed by the input digest.
+        :param bool coalesce: if true, identical requests in flight at the same
+         time share one call of model_fn. Only enable it if model_fn always
+         returns the same output for the same input.
+        :param bool lazy_instances: if true, model_fn receives a
+         utils.lazy_instances.InstanceList of lazily parsed instances.
+        """
+        if route in self._model_routes:
+            raise ValueError('Route {} already maps to model {}'.format(
+                route, self._model_routes[route]
+            ))
+        self._model_routes[route] = model_fn
+
+        if lazy_instances:
+            model_fn = _with_lazy_instances(model_fn)
+
+        logger.info('added inference route %s' % route)
+
+        async def endpoint(scope, receive, send):
+            await self._do_inference(
+                model_fn, receive, send, scope, route, result_cache, coalesce
+            )
+
+        self._add_route(route, endpoint, ['POST'])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        endpoints = self._routes.get(scope['path'])
+        if endpoints is None:
+            await self._send_text(send, 404, 'not found')
+            return
+        endpoint = endpoints.get(scope['method'])
+        if endpoint is None:
+            await self._send_text(send, 405, 'method not allowed')
+            return
+
+        started = False
+
+        async def tracking_send(message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await endpoint(scope, receive, tracking_send)
+        except Exception as e:
+            logger.exception('internal server error %s', e)
+            if not started:
+                await self._send_text(send, 500, 'internal server error')
+
+    def _add_route(self, path, endpoint, methods):
+        endpoints = self._routes.setdefault(path, {})
+        for method in methods:
+            endpoints[method] = endpoint
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                self._part_hasher.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _pong(self, scope, receive, send):
+        """Handles a ping request with a pong response"""
+        await self._send_text(send, 200, 'inference-service is up and accepting connections')
+
+    @staticmethod
+    async def _send_text(send, status, text):
+        body = text if isinstance(text, bytes) else str(text).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode('latin-1')),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _do_inference(self, model_fn, receive, send, scope, route, result_cache, coalesce):
+        """ASGI endpoint of an inference route."""
+        try:
+            request = await self._read_request(scope, receive)
+        except InvalidRequestError as e:
+            logger.error(str(e))
+            await self._send_text(send, 400, str(e))
+            return
+
+        result = await self._get_result(model_fn, request, route, result_cache, coalesce)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', request.response_content_type.encode('latin-1'))],
+        })
+        loop = asyncio.get_running_loop()
+        chunks = request.encode_response(result, self.config['MULTIPART_CHUNK_SIZE'])
+        while True:
+            chunk = await loop.run_in_executor(self._executor, next, chunks, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _read_request(self, scope, receive):
+        """Decode a multipart/related request body as it is received.
+
+        :return: InferenceRequest
+        :raises InvalidRequestError: if the request is not a valid multipart
+         inference request.
+        """
+        content_type = ''
+        for name, value in scope['headers']:
+            if name.lower() == b'content-type':
+                content_type = value.decode('latin-1')
+
+        header = email.message.Message()
+        header['content-type'] = content_type
+        if not content_type.startswith('multipart/related'):
+            raise InvalidRequestError('invalid content-type {}'.format(content_type))
+
+        boundary = header.get_param('boundary')
+        if not boundary:
+            raise InvalidRequestError('missing boundary in content-type {}'.format(content_type))
+        encoding = header.get_param('charset') or 'utf-8'
+
+        # Decode JSON and DICOMs part by part while the body is received.
+        # Each part is hashed as it is written.
+        algorithm = self.config['HASH_ALGORITHM']
+        parser = multipart.MultipartParser(
+            boundary, encoding=encoding,
+            spill_threshold=self.config['MULTIPART_SPILL_THRESHOLD'],
+            spill_dir=self.config['MULTIPART_SPILL_DIR'],
+            hash_algorithm=algorithm
+        )
+        parts = []
+        parsing = None
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise multipart.MultipartError('client disconnected')
+                # Spilled parts are written to disk and hashed while parsing
+                parsing = self._executor.submit(parser.feed, message.get('body', b''))
+                parts.extend(await asyncio.wrap_future(parsing))
+                more_body = message.get('more_body', False)
+            parsing = self._executor.submit(parser.close)
+            await asyncio.wrap_future(parsing)
+        except multipart.MultipartError as e:
+            for part in parts:
+                part.close()
+            raise InvalidRequestError('invalid multipart body: {}'.format(e))
+        except BaseException:
+            # E.g. the request was cancelled while it was received
+            for part in parts:
+                part.close()
+            raise
+        finally:
+            if parsing is not None and not parsing.done():
+                # Cancelled while a chunk is parsed, the parser is closed
+                # once the executor is done with it
+                parsing.add_done_callback(functools.partial(_close_parser, parser))
+            else:
+                _close_parser(parser)
+
+        if not parts:
+            raise InvalidRequestError('multipart body has no parts')
+
+        part_digests = [part.digest for part in parts]
+        input_digest = digest.combine([bytes.fromhex(d) for d in part_digests], algorithm)
+        logger.debug('received request with hash %s' % input_digest)
+
+        return InferenceRequest(parts, input_digest, boundary, encoding, part_digests=part_digests)
+
+    async def _get_result(self, model_fn, request, route, result_cache, coalesce):
+        """Produce the serialized result for a request, and close the
+        request once it is not needed anymore.
+
+        The result comes from the cache, from an identical request in flight
+        or from calling model_fn, in that order of preference.
+        """
+        loop = asyncio.get_running_loop()
+        test_logger = request.logger
+
+        async def get_result():
+            if result_cache is None:
+                return await self._run_model(model_fn, request)
+
+            cache_key = result_cache.make_key(route, request.input_digest)
+            result = await loop.run_in_executor(self._executor, result_cache.get, cache_key)
+            if result is None:
+                result = await self._run_model(model_fn, request)
+                await loop.run_in_executor(self._executor, result_cache.put, cache_key, result)
+            else:
+                test_logger.debug('replaying cached response')
+            return result
+
+        if not coalesce:
+            try:
+                return await get_result()
+            finally:
+                request.close()
+
+        # Identical requests in flight at the same time share one model_fn
+        # call, and its exception if it raises
+        key = '{}:{}'.format(route, request.input_digest)
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            request.close()
+            self.coalesced_requests += 1
+            result = await asyncio.shield(in_flight)
+            test_logger.debug('coalesced with in-flight request')
+            return result
+
+        # The computation runs in its own task, which outlives the leader if
+        # its client disconnects, so followers still get the result
+        in_flight = asyncio.ensure_future(get_result())
+        self._in_flight[key] = in_flight
+
+        def finished(task):
+            del self._in_flight[key]
+            request.close()
+            if not task.cancelled():
+                # Do not warn about an exception nobody waited for
+                task.exception()
+
+        in_flight.add_done_callback(finished)
+        return await asyncio.shield(in_flight)
+
+    async def _run_model(self, model_fn, request):
+        """Run the model on a decoded request and serialize its output."""
+        loop = asyncio.get_running_loop()
+        if inspect.iscoroutinefunction(model_fn):
+            response_json_body, response_binary_elements = await model_fn(
+                request.json_body(), request.dicom_instances(), request.input_digest
+            )
+        else:
+            response_json_body, response_binary_elements = await loop.run_in_executor(
+                self._executor, model_fn,
+                request.json_body(), request.dicom_instances(), request.input_digest
+            )
+
+        # Hashing and serialization touch every output byte, keep them off
+        # the event loop
+        return await loop.run_in_executor(
+            self._executor, self._serializer.to_result,
+            response_json_body, response_binary_elements, request.logger, None,
+            self.config['HASH_ALGORITHM']
+        )
+
+
+def _with_lazy_instances(model_fn):
+    """Wrap model_fn to be called with lazily parsed instances, keeping
+    coroutine functions as such."""
+    if inspect.iscoroutinefunction(model_fn):
+        @functools.wraps(model_fn)
+        async def wrapper(json_input, dicom_instances, input_digest):
+            return await model_fn(
+                json_input, lazy_instances.to_instance_list(dicom_instances), input_digest
+            )
+    else:
+        @functools.wraps(model_fn)
+        def wrapper(json_input, dicom_instances, input_digest):
+            return model_fn(
+                json_input, lazy_instances.to_instance_list(dicom_instances), input_digest
+            )
+    return wrapper
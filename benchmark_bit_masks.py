@@ -0,0 +1,87 @@
+"""
+Compare the size and throughput of boolean masks sent one uint8 per voxel
+and bit-packed, see utils/bit_masks.py.
+
+Ex. python benchmark_bit_masks.py --shape 1 300 512 512 --fill 0.05
+"""
+
+import argparse
+import logging
+import time
+
+import numpy
+
+from gateway import InferenceSerializer
+from utils import bit_masks
+from utils import buffers
+from utils import compression
+from utils.tagged_logger import TaggedLogger
+
+logger = logging.getLogger('benchmark')
+
+
+def make_mask(shape, fill, seed=0):
+    """Return a uint8 mask of 0 and 255 holding one box per slice, covering
+    about the fill fraction of each slice."""
+    mask = numpy.zeros(shape, dtype=numpy.uint8)
+    height, width = shape[-2:]
+    side = numpy.sqrt(fill)
+    rows, columns = int(height * side), int(width * side)
+    rng = numpy.random.RandomState(seed)
+    for index in numpy.ndindex(*shape[:-2]):
+        top = rng.randint(0, height - rows + 1)
+        left = rng.randint(0, width - columns + 1)
+        mask[index][top:top + rows, left:left + columns] = 255
+    return mask
+
+
+def timed(fn, repeat):
+    """Return the result of fn and the best of repeat wall times."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def gzip_size(data):
+    return sum(len(chunk) for chunk in compression.iter_compress(data, 'gzip'))
+
+
+def serialize(serializer, mask, packed):
+    shape = dict(zip(('timepoints', 'depth', 'height', 'width'), mask.shape))
+    part = {'binary_type': 'boolean_mask', 'binary_data_shape': shape, 'bit_packed': packed}
+    result = serializer.to_result({'protocol_version': '1.0', 'parts': [part]}, [mask], TaggedLogger(logger))
+    # Read the parts like the response does
+    return sum(len(chunk) for _, p in result.parts for chunk in buffers.iter_chunks(p, 1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=4, default=[1, 300, 512, 512],
+        help="Shape of the mask, (timepoints, depth, height, width)")
+    parser.add_argument("--fill", type=float, default=0.05, help="Fraction of the voxels of each slice that are positive")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest is reported")
+    args = parser.parse_args()
+
+    mask = make_mask(tuple(args.shape), args.fill)
+    megabytes = mask.nbytes / 1e6
+    packed, pack_seconds = timed(lambda: bit_masks.pack(mask), args.repeat)
+    packed_bytes = b''.join(bytes(chunk) for chunk in packed.iter_chunks())
+    _, unpack_seconds = timed(lambda: bit_masks.unpack(packed_bytes, mask.shape), args.repeat)
+
+    serializer = InferenceSerializer()
+    raw_sent, raw_seconds = timed(lambda: serialize(serializer, mask, False), args.repeat)
+    packed_sent, packed_seconds = timed(lambda: serialize(serializer, mask, True), args.repeat)
+    serializer.part_hasher.shutdown()
+
+    print("mask of shape {}, {:.1f} MB".format(mask.shape, megabytes))
+    print("{:<8} {:>14} {:>14} {:>14}".format('format', 'sent bytes', 'gzip bytes', 'serialize MB/s'))
+    print("{:<8} {:>14} {:>14} {:>14.0f}".format('raw', raw_sent, gzip_size(mask), megabytes / raw_seconds))
+    print("{:<8} {:>14} {:>14} {:>14.0f}".format('packed', packed_sent, gzip_size(packed), megabytes / packed_seconds))
+    print("pack {:.0f} MB/s, unpack {:.0f} MB/s of voxels".format(megabytes / pack_seconds, megabytes / unpack_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,43 +3,185 @@ Flask HTTP gateway module.
 
 """
 
+import contextlib
 import functools
-from io import BytesIO
 import json
 import logging
-import hashlib
-import numpy
+import os
+import random
+import tempfile
+import time
+import uuid
 
 import flask
 from flask import Flask, make_response
 from utils import tagged_logger
-
-# pylint: disable=import-error
-# Not designed to be installed in vision, yet
-from requests_toolbelt import MultipartEncoder, MultipartDecoder
+from utils import batching
+from utils import bit_masks
+from utils import buffers
+from utils import compression
+from utils import digest
+from utils import jobs
+from utils import lazy_instances
+from utils import metrics
+from utils import multipart
+from utils import output_files
+from utils import process_pool
+from utils import study_files
+from utils import tracing
+from utils.admission import AdmissionRejected
+from utils.result_cache import CachedResult
+from utils.single_flight import SingleFlight
 
 logger = logging.getLogger('gateway')
 
+class InvalidRequestError(ValueError):
+    """Raised when an inference request cannot be decoded."""
+
+
+class InferenceRequest():
+    """A decoded multipart inference request.
+
+    :param list(multipart.BodyPart) parts: request parts, JSON part first.
+    :param str input_digest: digest of the content of all parts.
+    :param str boundary: multipart boundary of the request.
+    :param str encoding: encoding of the request body.
+    :param metrics.StageTimer timer: time spent so far in each stage of the
+     request.
+    :param int body_bytes: size of the request body.
+    :param list(str) part_digests: hex digest of the content of each part,
+     also set as the ``digest`` of the parts and of the dicom_instances.
+    """
+
+    def __init__(self, parts, input_digest, boundary, encoding, timer=None, body_bytes=None,
+                 part_digests=None):
+        self.parts = parts
+        self.input_digest = input_digest
+        self.part_digests = part_digests
+        if part_digests is not None:
+            for part, part_digest in zip(parts, part_digests):
+                part.digest = part_digest
+        self.boundary = boundary
+        self.encoding = encoding
+        self.timer = timer if timer is not None else metrics.StageTimer()
+        self.body_bytes = body_bytes
+        # Directory the DICOM files were read from, for studyPath requests
+        self.study_path = None
+        # (part name, compression.CompressionStats) of the compressed parts
+        # of the last encoded response
+        self.compression_stats = []
+        self.logger = tagged_logger.TaggedLogger(logger)
+        self.logger.add_tags({ 'input_hash': input_digest })
+
+    def json_body(self):
+        """Return the decoded JSON part of the request."""
+        return json.loads(self.parts[0].text)
+
+    def dicom_instances(self):
+        """Return a read-only file-like object for each part after the JSON."""
+        return [p.open() for p in self.parts[1:]]
+
+    @property
+    def response_content_type(self):
+        return 'multipart/related; boundary={}'.format(self.boundary)
+
+    def encode_response(self, result, chunk_size=multipart.DEFAULT_CHUNK_SIZE,
+                        content_encoding=None, compress_min_size=compression.DEFAULT_MIN_SIZE):
+        """Encode a serialized result as the multipart body of the response.
+
+        The response uses the same boundary and encoding as the request, and
+        its last part holds the input and output digests.
+
+        :param CachedResult result: the serialized model output. Its parts
+         are sent while they are still being hashed, the digests part waits
+         for the hashes.
+        :param int chunk_size: maximum size of the yielded chunks.
+        :param str content_encoding: encoding the binary mask parts of at
+         least compress_min_size bytes are compressed with, as they are sent,
+         e.g. 'gzip'. Their size and compression time are added to
+         compression_stats.
+        :param int compress_min_size: size of the smallest part compressed.
+        :return: iterator over the chunks of the body.
+        """
+        # Assemble the list of multipart/related parts
+        # The json response must be the first part
+        fields = [('json-body', result.json_text, 'application/json')]
+
+        self.compression_stats = []
+        for i, (mimetype, elem) in enumerate(result.parts):
+            name = 'elem_{}'.format(i)
+            # DICOM parts are usually compressed already
+            if (content_encoding is None or mimetype != 'application/binary'
+                    or buffers.nbytes(elem) < compress_min_size):
+                fields.append((name, elem, mimetype))
+                continue
+            stats = compression.CompressionStats(content_encoding)
+            self.compression_stats.append((name, stats))
+            fields.append((
+                name,
+                compression.iter_compress(elem, content_encoding, chunk_size, stats=stats),
+                mimetype,
+                {'Content-Encoding': content_encoding}
+            ))
+
+        def iter_fields():
+            yield from fields
+            # Read once the other parts are sent, so the first bytes of the
+            # response never wait for the hashes
+            self.logger.add_tags({ 'output_hash': result.output_digest })
+            yield ('hashes', self.input_digest + ':' + result.output_digest, 'text/plain')
+
+        # Stream the body using the same boundary and encoding as original,
+        # so no part is copied into a single response string
+        return multipart.iter_encode(
+            iter_fields(), self.boundary, encoding=self.encoding, chunk_size=chunk_size
+        )
+
+    @property
+    def trace(self):
+        """The utils.tracing.Trace of the request, if it is traced."""
+        return self.timer.trace
+
+    @property
+    def nbytes(self):
+        """Size of the content of all parts."""
+        return sum(p.size for p in self.parts)
+
+    def close(self):
+        """Release the memory and temporary files held by request parts."""
+        for part in self.parts:
+            part.close()
+
+
 class InferenceSerializer():
     """Class to convert model outputs to HTTP-friendly binary format.
 
     Currently, could be a function, but this will likely grow in complexity
     as other response formats are accepted.
+
+    :param digest.PartHasher part_hasher: thread pool hashing the parts of
+     the responses.
     """
 
-    def __call__(self, json_response, binary_components):
-        """Generator to convert each part of the model response to text.
+    def __init__(self, part_hasher=None):
+        self.part_hasher = part_hasher if part_hasher is not None else digest.PartHasher()
+
+    def __call__(self, json_response, binary_components, copy_counter=None):
+        """Generator to convert each part of the model response to bytes.
 
         Iterates over the "parts" field of the JSON response and the parts of
-        binary_components and converts them to strings.
+        binary_components and exposes each of them as a flat byte buffer.
+        Buffers are not copied unless a numpy array is not C-contiguous or a
+        file-like object has to be read.
 
         :param dict json_response: dictionary of JSON-serializable components
          which describes the binary response format.
         :param list(obj) binary_components: list of binary response components,
-         to be serialized to strings by this function
-        :return: list(2-tuple(str, str)), one tuple for each binary component,
-         where the first string is the HTTP mime-type, and the second string
-         is the data of the binary component serialized to a string.
+         to be serialized by this function
+        :param buffers.CopyCounter copy_counter: counter to record copies in.
+        :return: list(2-tuple(str, memoryview)), one tuple for each binary
+         component, where the string is the HTTP mime-type, and the memoryview
+         holds the bytes of the binary component.
         """
 
         binary_part_iter = enumerate(
@@ -57,13 +199,82 @@ class InferenceSerializer():
             if binary_type in {'dicom_secondary_capture', 'dicom'}:
                 # Binary blob is assumed to be a file pointer or buffer type
                 # to be read directly into the response
-                yield ('application/dicom', binary_blob)
+                buffer = buffers.as_buffer(binary_blob, copy_counter)
+                yield ('application/dicom', buffers.byte_view(buffer))
             elif binary_type in {'probability_mask', 'heatmap', 'numeric_label_mask', 'boolean_mask'}:
-                # Binary blob is a numpy array of any shape
-                yield ('application/binary', binary_blob.tostring())
+                # Binary blob is a numpy array of any shape, or a ChunkedBuffer
+                # such as a SparseMask, expanded only when it is sent
+                if json_desc.get(bit_masks.BIT_PACKED_FIELD):
+                    binary_blob = bit_masks.pack(binary_blob)
+                buffer = buffers.as_buffer(binary_blob, copy_counter)
+                if not isinstance(buffer, buffers.ChunkedBuffer):
+                    buffer = buffers.byte_view(buffer)
+                yield ('application/binary', buffer)
             else:
                 raise NotImplementedError("Binary type {} is not supported".format(binary_type))
 
+    def to_result(self, response_json_body, response_binary_elements, test_logger, timer=None,
+                  algorithm=digest.DEFAULT_ALGORITHM):
+        """Hash and serialize the output of a model.
+
+        The parts are hashed in the pool, the output digest of the returned
+        result waits for the hashes the first time it is read.
+
+        :param dict response_json_body: JSON part of the model response.
+        :param list(obj) response_binary_elements: binary components of the
+         model response.
+        :param tagged_logger.TaggedLogger test_logger: request logger, tagged
+         with the output hash by this function.
+        :param metrics.StageTimer timer: records the time spent hashing and
+         serializing.
+        :param str algorithm: hash algorithm of the output digest.
+        :return: CachedResult holding the serialized response.
+        """
+        if timer is None:
+            timer = metrics.StageTimer()
+
+        with timer.stage('serialize'):
+            # Expose every binary element as a contiguous buffer once, so
+            # hashing and serialization below read the same memory without
+            # copying it
+            copy_counter = buffers.CopyCounter()
+            response_binary_elements = [
+                buffers.as_buffer(part, copy_counter) for part in bit_masks.pack_parts(
+                    response_json_body.get('parts', []), response_binary_elements
+                )
+            ]
+
+            # The JSON body is dumped once so the hash matches the sent bytes
+            response_json_text = json.dumps(response_json_body)
+
+        # The parts are hashed in the pool while they are serialized below
+        hash_futures = [
+            self.part_hasher.submit(part, algorithm)
+            for part in [response_json_text.encode('utf-8')] + [
+                part if isinstance(part, buffers.ChunkedBuffer) else buffers.byte_view(part)
+                for part in response_binary_elements
+            ]
+        ]
+
+        # Serialize model response to byte buffers
+        with timer.stage('serialize'):
+            response_body_elements = list(self(
+                response_json_body, response_binary_elements, copy_counter
+            ))
+
+        def digests():
+            with timer.stage('output_hash'):
+                part_digests = [f.result() for f in hash_futures]
+                output_digest = digest.combine(part_digests, algorithm)
+            test_logger.add_tags({ 'output_hash': output_digest })
+            logger.debug('sending response with hash %s' % output_digest)
+            return output_digest, [d.hex() for d in part_digests[1:]]
+
+        test_logger.add_tags({ 'buffer_copies': copy_counter.copies })
+        test_logger.debug('request processed')
+
+        return CachedResult(response_json_text, response_body_elements, digests=digests)
+
 
 class Gateway(Flask):
     """Main HTTP gateway to receive multipart requests"""
@@ -71,9 +282,101 @@ class Gateway(Flask):
     def __init__(self, *args, **kwargs):
         """Instantiate the model Gateway to delegate to the given function."""
         super().__init__(*args, **kwargs)
+        # Parts larger than this many bytes are spilled to a temporary file
+        # in MULTIPART_SPILL_DIR instead of being kept in memory
+        self.config.setdefault('MULTIPART_SPILL_THRESHOLD', multipart.DEFAULT_SPILL_THRESHOLD)
+        self.config.setdefault('MULTIPART_SPILL_DIR', None)
+        self.config.setdefault('MULTIPART_CHUNK_SIZE', multipart.DEFAULT_CHUNK_SIZE)
+        # Algorithm of the input and output digests, any name accepted by
+        # hashlib.new, e.g. 'blake2b'
+        self.config.setdefault('HASH_ALGORITHM', digest.DEFAULT_ALGORITHM)
+        # Binary mask parts of at least COMPRESSION_MIN_SIZE bytes are sent
+        # with a Content-Encoding negotiated from the Accept-Encoding header
+        # of the request. Opt-in, since HTTP clients usually accept gzip for
+        # the whole body without decoding the encoding of each part
+        self.config.setdefault('COMPRESS_RESPONSE_PARTS', False)
+        self.config.setdefault('COMPRESSION_ENCODINGS', compression.AVAILABLE_ENCODINGS)
+        self.config.setdefault('COMPRESSION_MIN_SIZE', compression.DEFAULT_MIN_SIZE)
+        # Requests with a JSON body holding a studyPath read the DICOM files
+        # of that directory, which must be under one of STUDY_PATH_ROOTS,
+        # e.g. a volume mounted in the container. Disabled when empty
+        self.config.setdefault('STUDY_PATH_ROOTS', ())
+        # The binary parts of the responses to studyPath requests are written
+        # to files in OUTPUT_DIR, e.g. on the same volume, and replaced with
+        # references to the files. Sent inline when None
+        self.config.setdefault('OUTPUT_DIR', None)
+        # Inference responses get a Server-Timing header, and this fraction of
+        # the requests are written as Chrome traces named <input_hash>.json
+        # in TRACE_DIR
+        self.config.setdefault('SERVER_TIMING', True)
+        self.config.setdefault('TRACE_SAMPLE_RATE', 0.0)
+        self.config.setdefault('TRACE_DIR', os.path.join(tempfile.gettempdir(), 'inference-traces'))
         self.add_url_rule('/ping', 'ping', self._pong, methods=['GET', 'POST'])
-        self._serializer = InferenceSerializer()
+        self.add_url_rule('/metrics', 'metrics', self._get_metrics, methods=['GET'])
+        # Thread pool hashing the parts of requests and responses
+        self._part_hasher = digest.PartHasher()
+        self._serializer = InferenceSerializer(self._part_hasher)
+        # Thread pool opening and reading ahead the files of studyPath requests
+        self._study_loader = study_files.StudyLoader()
+        self._single_flight = SingleFlight()
         self._model_routes = {}
+        self._batch_schedulers = {}
+        self._process_pools = {}
+        self._admission_controllers = {}
+        # Optional utils.admission.MemoryGovernor shared by all inference routes
+        self.memory_governor = None
+        # Optional utils.instance_cache.InstanceCache handlers can read the
+        # DICOM instances through, its counters are added to the metrics
+        self.instance_cache = None
+        # Optional utils.decoding.DecodePool handlers can decode volumes with,
+        # its throughput per transfer syntax is added to the metrics
+        self.decode_pool = None
+        self._result_caches = {}
+
+        self.metrics = metrics.Registry()
+        self._requests_total = self.metrics.counter(
+            'inference_requests_total', 'Inference requests by response status code',
+            ['route', 'status']
+        )
+        self._requests_in_flight = self.metrics.gauge(
+            'inference_requests_in_flight', 'Inference requests being processed or sent',
+            ['route']
+        )
+        self._stage_seconds = self.metrics.histogram(
+            'inference_stage_seconds', 'Time spent in each stage of successful inference requests',
+            ['route', 'stage']
+        )
+        self._request_bytes = self.metrics.histogram(
+            'inference_request_bytes', 'Size of inference request bodies',
+            ['route'], buckets=metrics.SIZE_BUCKETS
+        )
+        self._response_bytes = self.metrics.histogram(
+            'inference_response_bytes', 'Size of inference response bodies',
+            ['route'], buckets=metrics.SIZE_BUCKETS
+        )
+        self._request_parts = self.metrics.histogram(
+            'inference_request_parts', 'Number of parts of inference requests, including the JSON part',
+            ['route'], buckets=metrics.COUNT_BUCKETS
+        )
+        self._compression_ratio = self.metrics.histogram(
+            'inference_compression_ratio', 'Compressed over raw size of compressed response parts',
+            ['route', 'encoding'], buckets=metrics.RATIO_BUCKETS
+        )
+        self._compression_seconds = self.metrics.counter(
+            'inference_compression_cpu_seconds_total', 'CPU time spent compressing response parts',
+            ['route', 'encoding']
+        )
+        self._compression_bytes = self.metrics.counter(
+            'inference_compression_bytes_total', 'Raw and compressed size of compressed response parts',
+            ['route', 'encoding', 'direction']
+        )
+        self.metrics.add_collector(self._collect_metrics)
+
+    @property
+    def coalesced_requests(self):
+        """Number of requests answered with the result of an identical
+        request that was already in flight."""
+        return self._single_flight.coalesced
 
     @staticmethod
     def _pong():
@@ -84,17 +387,116 @@ class Gateway(Flask):
 
         return make_response('inference-service is up and accepting connections', 200)
 
+    def _get_metrics(self):
+        """Handles a scrape of the metrics in the Prometheus text format"""
+        return self.response_class(self.metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE})
+
+    def _collect_metrics(self):
+        """Collect the counters kept by the caches, batch schedulers,
+        process pools and admission control of the routes, and by the
+        instance cache and decode pool."""
+        families = [(
+            'inference_coalesced_requests_total', 'counter',
+            'Requests answered with the result of an identical request in flight',
+            [({}, self.coalesced_requests)]
+        )]
+
+        cache_stats = {route: cache.stats() for route, cache in self._result_caches.items()}
+        for name in ['hits', 'disk_hits', 'misses', 'evictions', 'disk_evictions']:
+            families.append((
+                'inference_result_cache_{}_total'.format(name), 'counter',
+                'Result cache {}'.format(name.replace('_', ' ')),
+                [({'route': route}, stats[name]) for route, stats in cache_stats.items()]
+            ))
+        for name in ['entries', 'bytes']:
+            families.append((
+                'inference_result_cache_{}'.format(name), 'gauge',
+                'Result cache {} in memory'.format(name),
+                [({'route': route}, stats[name]) for route, stats in cache_stats.items()]
+            ))
+
+        families.append((
+            'inference_batches_total', 'counter', 'Batches run by batch size',
+            [
+                ({'route': route, 'size': size}, count)
+                for route, scheduler in self._batch_schedulers.items()
+                for size, count in sorted(scheduler.batch_size_histogram().items())
+            ]
+        ))
+        families.append((
+            'inference_worker_restarts_total', 'counter', 'Restarts of crashed worker process pools',
+            [({'route': route}, pool.restarts) for route, pool in self._process_pools.items()]
+        ))
+
+        admission_stats = self.admission_stats()
+        for name, type in [('active', 'gauge'), ('queued', 'gauge'), ('rejected', 'counter')]:
+            families.append((
+                'inference_admission_{}{}'.format(name, '_total' if type == 'counter' else ''),
+                type, 'Requests {} by admission control'.format(name),
+                [({'route': route}, stats[name]) for route, stats in admission_stats.items()]
+            ))
+
+        if self.instance_cache is not None:
+            instance_stats = self.instance_cache.stats()
+            for name in ['hits', 'misses', 'evictions']:
+                families.append((
+                    'inference_instance_cache_{}_total'.format(name), 'counter',
+                    'DICOM instance cache {}'.format(name), [({}, instance_stats[name])]
+                ))
+            for name in ['entries', 'bytes']:
+                families.append((
+                    'inference_instance_cache_{}'.format(name), 'gauge',
+                    'DICOM instance cache {}'.format(name), [({}, instance_stats[name])]
+                ))
+
+        if self.decode_pool is not None:
+            decode_stats = self.decode_pool.stats()
+            for name, help in [('frames', 'Frames decoded'), ('bytes', 'Bytes of pixels decoded'),
+                               ('seconds', 'Seconds spent decoding pixels')]:
+                families.append((
+                    'inference_decode_{}_total'.format(name), 'counter',
+                    '{} by transfer syntax'.format(help),
+                    [({'transfer_syntax': uid}, stats[name]) for uid, stats in decode_stats.items()]
+                ))
+
+        if self.memory_governor is not None:
+            memory_stats = self.memory_governor.stats()
+            families.extend([
+                ('inference_memory_reserved_bytes', 'gauge', 'Bytes reserved by requests in flight',
+                 [({}, memory_stats['reserved_bytes'])]),
+                ('inference_memory_waiting', 'gauge', 'Requests waiting for memory',
+                 [({}, memory_stats['waiting'])]),
+                ('inference_memory_rejected_total', 'counter', 'Requests rejected by the memory budget',
+                 [({}, memory_stats['rejected'])]),
+            ])
+        return families
+
     def add_healthcheck_route(self, handler_fn):
         """ Add a handler for the healthcheck route """
 
         self.add_url_rule('/healthcheck', 'healthcheck', handler_fn, methods=['GET', 'POST'])
 
-    def add_inference_route(self, route, model_fn):
+    def add_inference_route(self, route, model_fn, result_cache=None, coalesce=False, admission=None,
+                            lazy_instances=False):
         """Add a callback function and unique route.
 
         :param callable model_fn: callback function to use for the backend of
          the provided route.
         :param str route: URL path at which to listen for the route.
+        :param utils.result_cache.ResultCache result_cache: optional cache of the
+         responses of this route, keyed by the input digest. Requests for a
+         cached digest are answered without calling model_fn.
+        :param bool coalesce: if true, requests with the same input digest
+         that arrive while one of them is being processed wait for it and
+         share its response instead of calling model_fn again. Only enable it
+         if model_fn always returns the same output for the same input.
+        :param utils.admission.AdmissionController admission: optional limit
+         of the requests processed concurrently by this route. Requests that
+         are not admitted get a 503 response with a Retry-After header.
+        :param bool lazy_instances: if true, model_fn receives a
+         utils.lazy_instances.InstanceList, whose instances parse their header
+         and decode their pixels on first access, through the instance cache
+         of the gateway if it has one.
         """
         if route in self._model_routes:
             msg = (
@@ -105,12 +507,260 @@ class Gateway(Flask):
         else:
             self._model_routes[route] = model_fn
 
+        if admission is not None:
+            self._admission_controllers[route] = admission
+        if result_cache is not None:
+            self._result_caches[route] = result_cache
+
+        if lazy_instances:
+            model_fn = self._with_lazy_instances(model_fn)
+
         logger.info('added inference route %s' % route)
 
-        callback_fn = functools.partial(self._do_inference, model_fn)
+        callback_fn = functools.partial(
+            self._do_inference, model_fn, route=route,
+            result_cache=result_cache, coalesce=coalesce, admission=admission
+        )
         self.add_url_rule(route, route, callback_fn, methods=['POST'])
 
-    def _do_inference(self, model_fn):
+    def _with_lazy_instances(self, model_fn):
+        """Wrap model_fn to be called with lazily parsed instances."""
+
+        @functools.wraps(model_fn)
+        def wrapper(json_input, dicom_instances, input_digest):
+            return model_fn(
+                json_input, lazy_instances.to_instance_list(dicom_instances, self.instance_cache),
+                input_digest
+            )
+
+        return wrapper
+
+    def admission_stats(self):
+        """Return the admission counters of each route added with an
+        admission controller, as a dictionary keyed by route.
+
+        Healthcheck handlers can use it, or ``saturated``, to report that the
+        service is not ready while it sheds load.
+        """
+        return {route: a.stats() for route, a in self._admission_controllers.items()}
+
+    @property
+    def saturated(self):
+        """True if a route would currently reject new requests, or requests
+        are waiting for memory."""
+        if self.memory_governor is not None and self.memory_governor.saturated:
+            return True
+        return any(a.saturated for a in self._admission_controllers.values())
+
+    def add_batch_inference_route(self, route, batch_model_fn,
+                                  max_batch_size=batching.DEFAULT_MAX_BATCH_SIZE,
+                                  max_wait=batching.DEFAULT_MAX_WAIT, **kwargs):
+        """Add a route served by a model function that handles batches.
+
+        Concurrent requests to the route are collected into batches of up to
+        max_batch_size requests, waiting at most max_wait seconds for a batch
+        to fill up, and batch_model_fn is called once per batch.
+
+        :param str route: URL path at which to listen for the route.
+        :param callable batch_model_fn: called with a list of (json_input,
+         dicom_instances, input_digest) tuples, must return a list with one
+         (response_json, binary_components) tuple per request, in order.
+        :param int max_batch_size: maximum number of requests per call.
+        :param float max_wait: maximum time in seconds a request waits for
+         others to join its batch.
+        :param kwargs: other options of ``add_inference_route``.
+        """
+        scheduler = batching.BatchScheduler(
+            batch_model_fn, max_batch_size=max_batch_size, max_wait=max_wait,
+            name='batch-scheduler {}'.format(route)
+        )
+        self.add_inference_route(route, scheduler, **kwargs)
+        self._batch_schedulers[route] = scheduler
+
+    def batch_size_histogram(self, route):
+        """Return a dictionary mapping batch sizes to the number of batches
+        run for a route added with ``add_batch_inference_route``."""
+        return self._batch_schedulers[route].batch_size_histogram()
+
+    def add_process_pool_inference_route(self, route, model_fn,
+                                         processes=process_pool.DEFAULT_PROCESSES,
+                                         warmup_fn=None,
+                                         shm_dir=process_pool.DEFAULT_SHM_DIR, **kwargs):
+        """Add a route whose model function runs in a pool of worker processes.
+
+        Use it for CPU-bound models, which only run one at a time in the
+        handler threads because of the GIL. The DICOM parts and the binary
+        components returned are passed through shared memory. The worker
+        processes are started and warmed up when the route is added, and the
+        pool is restarted if one of them crashes.
+
+        :param str route: URL path at which to listen for the route.
+        :param callable model_fn: callback function defined at module level,
+         so that worker processes can import it.
+        :param int processes: number of worker processes of this route.
+        :param callable warmup_fn: optional function called once in each worker
+         process when it starts, e.g. to load the model.
+        :param str shm_dir: directory of the shared memory files.
+        :param kwargs: other options of ``add_inference_route``.
+        """
+        pool = process_pool.ProcessPool(
+            model_fn, processes=processes, warmup_fn=warmup_fn, shm_dir=shm_dir
+        )
+        self.add_inference_route(route, pool, **kwargs)
+        self._process_pools[route] = pool
+        pool.start()
+
+    def worker_restarts(self, route):
+        """Return how many times the worker processes of a route added with
+        ``add_process_pool_inference_route`` were restarted after a crash."""
+        return self._process_pools[route].restarts
+
+    def shutdown_process_pools(self):
+        """Stop the worker processes of all process pool routes."""
+        for pool in self._process_pools.values():
+            pool.shutdown()
+
+    def add_async_inference_route(self, route, model_fn, job_manager=None,
+                                  result_cache=None, coalesce=False, admission=None):
+        """Add routes to run inference as asynchronous jobs.
+
+        The following routes are added under ``<route>/jobs``:
+
+        * ``POST <route>/jobs``: accepts the same request as an inference
+          route, queues it and returns the job status with a ``job_id``.
+        * ``GET <route>/jobs/<job_id>``: returns the job status.
+        * ``GET <route>/jobs/<job_id>/result``: returns the multipart response
+          of a finished job, or the job status with code 202 while it is
+          queued or running.
+        * ``DELETE <route>/jobs/<job_id>``: cancels the job.
+
+        :param str route: URL path under which to add the job routes.
+        :param callable model_fn: callback function to use for the jobs.
+        :param utils.jobs.JobManager job_manager: runs the jobs and keeps their
+         results. Defaults to a new JobManager with default settings.
+        :param result_cache: see ``add_inference_route``.
+        :param bool coalesce: see ``add_inference_route``.
+        :param utils.admission.AdmissionController admission: optional limit
+         of the number of jobs queued or running, a job holds its slot until
+         it is done. Submissions are rejected with code 503 once the
+         controller's queue is full, see ``add_inference_route``.
+        """
+        jobs_route = route.rstrip('/') + '/jobs'
+        if jobs_route in self._model_routes:
+            raise ValueError('Route {} already maps to model {}'.format(
+                jobs_route, self._model_routes[jobs_route]
+            ))
+        self._model_routes[jobs_route] = model_fn
+
+        if job_manager is None:
+            job_manager = jobs.JobManager()
+
+        logger.info('added async inference route %s' % jobs_route)
+
+        if admission is not None:
+            self._admission_controllers[jobs_route] = admission
+
+        submit_fn = functools.partial(
+            self._submit_job, model_fn, job_manager, route=route,
+            result_cache=result_cache, coalesce=coalesce, admission=admission
+        )
+        self.add_url_rule(jobs_route, jobs_route, submit_fn, methods=['POST'])
+
+        job_route = jobs_route + '/<job_id>'
+        self.add_url_rule(
+            job_route, job_route + ':status',
+            functools.partial(self._get_job_status, job_manager), methods=['GET']
+        )
+        self.add_url_rule(
+            job_route, job_route + ':cancel',
+            functools.partial(self._cancel_job, job_manager), methods=['DELETE']
+        )
+        self.add_url_rule(
+            job_route + '/result', job_route + '/result',
+            functools.partial(self._get_job_result, job_manager), methods=['GET']
+        )
+
+    def _submit_job(self, model_fn, job_manager, route=None, result_cache=None, coalesce=False,
+                    admission=None):
+        """HTTP endpoint to queue an inference job.
+
+        The job is admitted like a request to an inference route, and holds
+        its slot and memory until it is done.
+        """
+        try:
+            reservation, releases = self._admit(admission)
+        except AdmissionRejected as e:
+            return self._rejected_response(route, e)
+
+        try:
+            request = self._read_request(reservation)
+        except InvalidRequestError as e:
+            self._release(releases)
+            logger.error(str(e))
+            return make_response(str(e), 400)
+        except AdmissionRejected as e:
+            self._release(releases)
+            return self._rejected_response(route, e)
+        except BaseException:
+            self._release(releases)
+            raise
+
+        def cleanup():
+            request.close()
+            self._release(releases)
+
+        try:
+            if reservation is not None:
+                reservation.resize(request.nbytes)
+            job = job_manager.submit(
+                functools.partial(self._get_result, model_fn, request, route, result_cache, coalesce),
+                request.input_digest, context=request, cleanup=cleanup
+            )
+        except AdmissionRejected as e:
+            cleanup()
+            return self._rejected_response(route, e)
+        except BaseException:
+            cleanup()
+            raise
+        request.logger.add_tags({ 'job_id': job.id })
+        request.logger.debug('queued inference job')
+
+        response = flask.jsonify(job.to_json())
+        response.status_code = 202
+        response.headers['Location'] = '{}/{}'.format(flask.request.path.rstrip('/'), job.id)
+        return response
+
+    @staticmethod
+    def _get_job_status(job_manager, job_id):
+        """HTTP endpoint returning the status of a job."""
+        job = job_manager.get(job_id)
+        if job is None:
+            return make_response('unknown job {}'.format(job_id), 404)
+        return flask.jsonify(job.to_json())
+
+    @staticmethod
+    def _cancel_job(job_manager, job_id):
+        """HTTP endpoint cancelling a job."""
+        job = job_manager.cancel(job_id)
+        if job is None:
+            return make_response('unknown job {}'.format(job_id), 404)
+        return flask.jsonify(job.to_json())
+
+    def _get_job_result(self, job_manager, job_id):
+        """HTTP endpoint returning the multipart response of a finished job."""
+        job = job_manager.get(job_id)
+        if job is None:
+            return make_response('unknown job {}'.format(job_id), 404)
+
+        if job.status == jobs.SUCCEEDED:
+            return self._make_multipart_response(job.result, job.context)
+
+        status_codes = {jobs.FAILED: 500, jobs.CANCELLED: 410}
+        response = flask.jsonify(job.to_json())
+        response.status_code = status_codes.get(job.status, 202)
+        return response
+
+    def _do_inference(self, model_fn, route=None, result_cache=None, coalesce=False, admission=None):
         """HTTP endpoint provided by the gateway.
 
         This function should be partially applied with the model_fn argument
@@ -121,6 +771,117 @@ class Gateway(Flask):
         always supposed to be accurate within the context of a request-handler.
 
         :param callable model_fn: the callback function to use for inference.
+        :param str route: the route being served, used in cache keys.
+        :param utils.result_cache.ResultCache result_cache: optional result cache.
+        :param bool coalesce: whether to share results between identical
+         concurrent requests.
+        :param utils.admission.AdmissionController admission: optional
+         admission controller of the route.
+        """
+        in_flight = self._requests_in_flight.labels(route=route)
+        in_flight.inc()
+        try:
+            response = self._admit_and_process(model_fn, route, result_cache, coalesce, admission)
+        except BaseException:
+            in_flight.dec()
+            self._requests_total.labels(route=route, status=500).inc()
+            raise
+        self._requests_total.labels(route=route, status=response.status_code).inc()
+        response.call_on_close(in_flight.dec)
+        return response
+
+    def _admit_and_process(self, model_fn, route, result_cache, coalesce, admission):
+        # Requests are admitted before their body is read, so rejecting them
+        # is cheap. Servers that send "100 Continue" when the body is first
+        # read spare clients using "Expect: 100-continue" the upload
+        try:
+            reservation, releases = self._admit(admission)
+        except AdmissionRejected as e:
+            return self._rejected_response(route, e)
+        try:
+            response = self._process_inference(model_fn, route, result_cache, coalesce, reservation)
+        except AdmissionRejected as e:
+            self._release(releases)
+            return self._rejected_response(route, e)
+        except BaseException:
+            self._release(releases)
+            raise
+
+        # The request holds its slot and memory until the response is fully
+        # streamed
+        for release in releases:
+            response.call_on_close(release)
+        return response
+
+    def _admit(self, admission):
+        """Acquire a slot of the admission controller of the route and reserve
+        memory for the body of the current Flask request.
+
+        :param utils.admission.AdmissionController admission: optional
+         admission controller of the route.
+        :return: (reservation, releases) tuple, where reservation is the
+         utils.admission.Reservation of the request, or None without memory
+         governor, and releases the functions to call once it is done.
+        :raises AdmissionRejected: if the request is not admitted, nothing is
+         held then.
+        """
+        releases = []
+        try:
+            if admission is not None:
+                admission.acquire()
+                releases.append(admission.release)
+            reservation = None
+            if self.memory_governor is not None:
+                reservation = self.memory_governor.reserve(flask.request.content_length or 0)
+                releases.append(reservation.release)
+        except BaseException:
+            self._release(releases)
+            raise
+        return reservation, releases
+
+    @staticmethod
+    def _release(releases):
+        for release in releases:
+            release()
+
+    @staticmethod
+    def _rejected_response(route, e):
+        logger.warning('rejected request to %s: %s' % (route, e))
+        response = make_response('request rejected, {}'.format(e), e.status)
+        if e.status == 503:
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    def _process_inference(self, model_fn, route, result_cache, coalesce, reservation=None):
+        try:
+            request = self._read_request(reservation)
+        except InvalidRequestError as e:
+            logger.error(str(e))
+            return make_response(str(e), 400)
+
+        if reservation is not None:
+            reservation.resize(request.nbytes)
+        try:
+            result = self._get_result(model_fn, request, route, result_cache, coalesce)
+        finally:
+            request.close()
+        if reservation is not None:
+            # Only the response is held from now on
+            reservation.resize(result.nbytes)
+
+        return self._make_multipart_response(result, request, route)
+
+    def _read_request(self, reservation=None):
+        """Decode the multipart/related body of the current Flask request.
+
+        :param utils.admission.Reservation reservation: optional memory
+         reservation of the request, grown as a compressed body is
+         decompressed.
+        :return: InferenceRequest
+        :raises InvalidRequestError: if the request is not a valid multipart
+         inference request.
+        :raises AdmissionRejected: if a compressed body decompresses to more
+         than the memory budget.
         """
         r = flask.request
 
@@ -129,125 +890,322 @@ class Gateway(Flask):
         except KeyError:
             encoding = 'utf-8'
 
+        if r.mimetype == 'application/json':
+            return self._read_study_path_request(encoding)
+
         if not r.content_type.startswith('multipart/related'):
-            msg = 'invalid content-type {}'.format(r.content_type)
-            logger.error(msg)
-            return make_response(msg, 400)
+            raise InvalidRequestError('invalid content-type {}'.format(r.content_type))
 
-        # Decode JSON and DICOMs into BytesIO buffers and pass to model
-        mp = MultipartDecoder(
-            content=r.get_data(), content_type=r.content_type,
-            encoding=encoding
-        )
+        try:
+            boundary = r.mimetype_params['boundary']
+        except KeyError:
+            raise InvalidRequestError('missing boundary in content-type {}'.format(r.content_type))
 
-        input_hash = hashlib.sha256()
+        trace = tracing.Trace()
+        timer = metrics.StageTimer(trace)
+        body_bytes = 0
 
-        for part in mp.parts:
-            input_hash.update(part.content)
+        def receive():
+            nonlocal body_bytes
+            with timer.stage('receive', span=False):
+                chunk = r.stream.read(self.config['MULTIPART_CHUNK_SIZE'])
+            body_bytes += len(chunk)
+            return chunk
 
-        input_digest = input_hash.hexdigest()
-        logger.debug('received request with hash %s' % input_digest)
+        # Compressed bodies are decompressed as they are received
+        decompressor = None
+        read = receive
+        content_encoding = r.headers.get('Content-Encoding', '').strip().lower()
+        if content_encoding and content_encoding != 'identity':
+            try:
+                decompressor = compression.StreamDecompressor(
+                    content_encoding, receive, self.config['MULTIPART_CHUNK_SIZE']
+                )
+            except compression.UnsupportedEncodingError as e:
+                raise InvalidRequestError(str(e))
+            read = functools.partial(self._read_decompressed, decompressor, timer, reservation)
 
-        test_logger = tagged_logger.TaggedLogger(logger)
-        test_logger.add_tags({ 'input_hash': input_digest })
+        # Decode JSON and DICOMs part by part while the body is received.
+        # Each part is hashed as it is written, so spilled parts are not
+        # read back from disk to be hashed.
+        algorithm = self.config['HASH_ALGORITHM']
+        parser = multipart.MultipartParser(
+            boundary, encoding=encoding,
+            spill_threshold=self.config['MULTIPART_SPILL_THRESHOLD'],
+            spill_dir=self.config['MULTIPART_SPILL_DIR'],
+            hash_algorithm=algorithm
+        )
+        parts = []
+        try:
+            with trace.span('decode') as decode_span:
+                part_start = decode_span.start
+                # A compressed body is read to the end of its stream
+                while not parser.finished or decompressor is not None:
+                    chunk = read()
+                    if not chunk:
+                        break
+                    if parser.finished:
+                        # Epilogue of a compressed body
+                        continue
+                    with timer.stage('decode', span=False):
+                        completed = parser.feed(chunk)
+                    for part in completed:
+                        # Each part spans from the end of the previous one
+                        part_start = trace.add_span(
+                            'part', part_start, time.perf_counter(), parent=decode_span,
+                            index=len(parts), size=part.size, content_type=part.content_type
+                        ).end
+                        parts.append(part)
+                if decompressor is not None:
+                    decompressor.close()
+                parser.close()
+        except (multipart.MultipartError, compression.DecompressionError) as e:
+            for part in parts:
+                part.close()
+            raise InvalidRequestError('invalid multipart body: {}'.format(e))
+        except BaseException:
+            for part in parts:
+                part.close()
+            raise
+        finally:
+            # Closes the part the parser was writing when the body failed
+            with contextlib.suppress(multipart.MultipartError):
+                parser.close()
 
-        request_json_body = json.loads(mp.parts[0].text)
-        request_binary_dicom_parts = [BytesIO(p.content) for p in mp.parts[1:]]
+        if not parts:
+            raise InvalidRequestError('multipart body has no parts')
+
+        # Part of the decode time
+        timer.add('input_hash', parser.hash_seconds)
+        part_digests = [part.digest for part in parts]
+        input_digest = digest.combine([bytes.fromhex(d) for d in part_digests], algorithm)
+        logger.debug('received request with hash %s' % input_digest)
+        if decompressor is not None:
+            logger.debug('decompressed %s request body from %d to %d bytes' % (
+                decompressor.encoding, decompressor.compressed_bytes, decompressor.raw_bytes
+            ))
 
-        response_json_body, response_binary_elements = model_fn(
-            request_json_body, request_binary_dicom_parts, input_digest
+        return InferenceRequest(
+            parts, input_digest, boundary, encoding, timer, body_bytes, part_digests
         )
 
-        output_hash = hashlib.sha256()
-        output_hash.update(json.dumps(response_json_body).encode('utf-8'))
+    def _get_result(self, model_fn, request, route, result_cache, coalesce):
+        """Produce the serialized result for a request.
 
-        for part in response_binary_elements:
-            output_hash.update(numpy.ascontiguousarray(part))
+        The result comes from the cache, from an identical request in flight
+        or from calling model_fn, in that order of preference.
 
-        output_digest = output_hash.hexdigest()
+        :param callable model_fn: the callback function to use for inference.
+        :param InferenceRequest request: the decoded request.
+        :param str route: the route being served, used in cache keys.
+        :param utils.result_cache.ResultCache result_cache: optional result cache.
+        :param bool coalesce: whether to share results between identical
+         concurrent requests.
+        :return: CachedResult
+        """
+        test_logger = request.logger
 
-        test_logger.add_tags({ 'output_hash': output_digest })
-        test_logger.debug('request processed')
+        def get_result():
+            if result_cache is None:
+                return self._run_model(model_fn, request)
 
-        logger.debug('sending response with hash %s' % output_digest)
+            cache_key = result_cache.make_key(route, request.input_digest)
+            result = result_cache.get(cache_key)
+            if result is None:
+                result = self._run_model(model_fn, request)
+                result_cache.put(cache_key, result)
+            else:
+                test_logger.debug('replaying cached response')
+            return result
 
-        # Serialize model response to text
-        response_body_text_elements = self._serializer(
-            response_json_body, response_binary_elements
-        )
+        if not coalesce:
+            return get_result()
 
-        # Assemble the list of multipart/related parts
-        # The json response must be the first part
-        fields = []
-        fields.append(
-            self._make_field_tuple(
-                'json-body', json.dumps(response_json_body),
-                content_type='application/json'
-            )
+        # Identical requests in flight at the same time share one model_fn
+        # call, and its exception if it raises
+        result, shared = self._single_flight.do(
+            '{}:{}'.format(route, request.input_digest), get_result
         )
+        if shared:
+            test_logger.debug('coalesced with in-flight request')
+        return result
 
-        fields.extend(
-            self._make_field_tuple('elem_{}'.format(i), elem, mimetype)
-            for i, (mimetype, elem) in enumerate(response_body_text_elements)
-        )
+    def _run_model(self, model_fn, request):
+        """Run the model on a decoded request and serialize its output.
 
-        fields.append(
-            self._make_field_tuple(
-                'hashes', input_digest + ':' + output_digest,
-                content_type='text/plain'
+        :param callable model_fn: the callback function to use for inference.
+        :param InferenceRequest request: the decoded request.
+        :return: CachedResult holding the serialized response.
+        """
+        with request.timer.stage('model'):
+            response_json_body, response_binary_elements = model_fn(
+                request.json_body(), request.dicom_instances(), request.input_digest
             )
+        return self._serializer.to_result(
+            response_json_body, response_binary_elements, request.logger, request.timer,
+            self.config['HASH_ALGORITHM']
         )
 
-        # Encode using the same boundary and encoding as original
-        encoder = MultipartEncoder(
-            fields, encoding=mp.encoding, boundary=mp.boundary
-        )
+    def _read_study_path_request(self, encoding):
+        """Read the instances of the study directory named by the studyPath
+        of the JSON body of the current Flask request.
+
+        The JSON body is the first part of the request, followed by the
+        memory-mapped DICOM files of the directory, like the parts of a
+        multipart request.
+
+        :return: InferenceRequest
+        :raises InvalidRequestError: if studyPath is missing or not a
+         directory under one of STUDY_PATH_ROOTS.
+        """
+        body = flask.request.get_data()
+        try:
+            study_path = json.loads(body)['studyPath']
+            if not isinstance(study_path, str):
+                raise TypeError('studyPath must be a string')
+        except (ValueError, KeyError, TypeError) as e:
+            raise InvalidRequestError('invalid JSON request, expected a studyPath: {}'.format(e))
+        if not self.config['STUDY_PATH_ROOTS']:
+            raise InvalidRequestError('studyPath requests are not enabled')
+        try:
+            study_path = study_files.resolve(study_path, self.config['STUDY_PATH_ROOTS'])
+        except ValueError as e:
+            raise InvalidRequestError(str(e))
 
-        # Override the Content-Type header that MultipartEncoder uses
-        # flask.make_response takes content, response code, and headers
-        return make_response(
-            encoder.to_string(), 200,
-            {'Content-Type': 'multipart/related; boundary={}'.format(mp.boundary)}
+        algorithm = self.config['HASH_ALGORITHM']
+        trace = tracing.Trace()
+        timer = metrics.StageTimer(trace)
+        json_part = multipart.BodyPart({'content-type': 'application/json'}, encoding, len(body) + 1)
+        json_part.write(body)
+        json_part.finish()
+        with trace.span('decode') as decode_span:
+            try:
+                with timer.stage('load', span=False):
+                    file_parts = self._study_loader.load(study_path)
+            except OSError as e:
+                json_part.close()
+                raise InvalidRequestError('failed to read studyPath: {}'.format(e))
+            parts = [json_part] + file_parts
+            # Hashing reads the files in parallel, after the kernel read-ahead
+            hash_futures = [
+                self._part_hasher.submit(part.buffer, algorithm, timer, 'input_hash', decode_span)
+                for part in parts
+            ]
+            part_digests = [f.result() for f in hash_futures]
+
+        input_digest = digest.combine(part_digests, algorithm)
+        logger.debug('read {} instances from {} with hash {}'.format(len(file_parts), study_path, input_digest))
+
+        # The response needs a boundary of its own
+        inference_request = InferenceRequest(
+            parts, input_digest, uuid.uuid4().hex, encoding, timer, len(body),
+            [d.hex() for d in part_digests]
         )
+        inference_request.study_path = study_path
+        return inference_request
 
     @staticmethod
-    def _make_field_tuple(field_name, content_string, content_type,
-                          headers=None):
-        """Generate a MultipartEncoder field entry.
-
-        MultipartEncoder uses the same syntax as the files argument to
-        `requests.post`.
-
-        Requests assumes you want multipart/form-data, and makes certain
-        decisions based on that. Namely, you have to provide a field name for
-        each "part". You also have to provide a filename for each part. We make
-        the field name and filename identical, because we aren't actually
-        filling out a form.
-
-        You can provide a dictionary to the files={} argument, and most of the
-        requests examples do this. However, dictionaries are unordered; we
-        require that field1, field2 be returned to the client in order. To do
-        this, we return tuples and assemble a list of parts out of them.
-
-        For more detail, see the Requests documentation on multipart-encoded
-        files.
-
-        :param str field_name: name of the form-field for the binary part, and
-         also the "filename" of the binary part.
-        :param str content_string: string representing the binary content to be
-         included in the request
-        :param str content_type: string defining the Content-Type (mime type)
-         of the request part.
-        :param dict(str:str) headers: dictionary of arbitrary HTTP headers and
-         header values to include in the request part.
-        :return: tuple, suitable for the files argument of `requests.post`. See
-         above for details.
-        """
-        if headers:
-            # (filename, data, Content-Type header, other headers)
-            content_tuple = (field_name, content_string, content_type, headers)
-        else:
-            # (filename, data, Content-Type header)
-            content_tuple = (field_name, content_string, content_type)
+    def _read_decompressed(decompressor, timer, reservation):
+        """Read the next decompressed chunk of a request body, growing the
+        memory reservation of the request with the decompressed size.
+
+        The decompressor receives the body as it needs it, that time is
+        counted as receive time rather than decompress time.
+        """
+        start = time.perf_counter()
+        received = timer.durations.get('receive', 0)
+        chunk = decompressor.read()
+        received = timer.durations.get('receive', 0) - received
+        timer.add('decompress', time.perf_counter() - start - received)
+        if reservation is not None:
+            reservation.grow(decompressor.raw_bytes)
+        return chunk
+
+    def _make_multipart_response(self, result, request, route=None):
+        """Stream a serialized inference result as a multipart/related response.
+
+        :param CachedResult result: the serialized model output.
+        :param InferenceRequest request: the request being answered.
+        :param str route: the route being served, if the request metrics
+         should be recorded once the response is sent.
+
+        The binary parts of the responses to studyPath requests are written to
+        OUTPUT_DIR, if set, and sent as references to the files.
+        """
+        if self.config['OUTPUT_DIR'] is not None and request.study_path is not None:
+            with request.timer.stage('write_output'):
+                result = output_files.write_result(
+                    result, self.config['OUTPUT_DIR'], self.config['HASH_ALGORITHM']
+                )
+
+        content_encoding = None
+        if self.config['COMPRESS_RESPONSE_PARTS']:
+            content_encoding = compression.negotiate(
+                flask.request.headers.get('Accept-Encoding'), self.config['COMPRESSION_ENCODINGS']
+            )
+        body = request.encode_response(
+            result, self.config['MULTIPART_CHUNK_SIZE'], content_encoding,
+            self.config['COMPRESSION_MIN_SIZE']
+        )
+        headers = {'Content-Type': request.response_content_type}
+        if self.config['COMPRESS_RESPONSE_PARTS']:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.config['SERVER_TIMING'] and request.trace is not None:
+            headers['Server-Timing'] = request.trace.server_timing()
+        if route is not None:
+            body = self._observe_response(body, request, route)
+        return self.response_class(body, 200, headers)
+
+    def _observe_response(self, body, request, route):
+        """Pass the response chunks through, timing their encoding, and
+        record the metrics and trace of the request once it is sent."""
+        timer = request.timer
+        response_bytes = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                with timer.stage('encode', span=False):
+                    chunk = next(body, None)
+                if chunk is None:
+                    break
+                response_bytes += len(chunk)
+                yield chunk
+        finally:
+            for stage, seconds in timer.durations.items():
+                self._stage_seconds.labels(route=route, stage=stage).observe(seconds)
+            self._request_bytes.labels(route=route).observe(request.body_bytes or 0)
+            self._request_parts.labels(route=route).observe(len(request.parts))
+            self._response_bytes.labels(route=route).observe(response_bytes)
+            self._observe_compression(request, route)
+
+            trace = request.trace
+            if trace is not None and random.random() < self.config['TRACE_SAMPLE_RATE']:
+                trace.add_span('encode', start, time.perf_counter(), bytes=response_bytes)
+                trace.tags.update(request.logger.tags, route=route)
+                try:
+                    path = trace.write(self.config['TRACE_DIR'], request.input_digest)
+                    request.logger.debug('wrote trace to {}'.format(path))
+                except OSError as e:
+                    request.logger.warning('failed to write trace: {}'.format(e))
 
-        return (field_name, content_tuple)
+    def _observe_compression(self, request, route):
+        """Record the compression ratio and CPU time of each compressed part
+        of a response."""
+        for name, stats in request.compression_stats:
+            labels = {'route': route, 'encoding': stats.encoding}
+            self._compression_ratio.labels(**labels).observe(stats.ratio)
+            self._compression_seconds.labels(**labels).inc(stats.cpu_seconds)
+            self._compression_bytes.labels(direction='in', **labels).inc(stats.raw_bytes)
+            self._compression_bytes.labels(direction='out', **labels).inc(stats.compressed_bytes)
+            request.logger.debug('compressed {} with {}: {} -> {} bytes ({:.1%}) in {:.1f} ms CPU'.format(
+                name, stats.encoding, stats.raw_bytes, stats.compressed_bytes, stats.ratio,
+                stats.cpu_seconds * 1000
+            ))
+        if request.trace is not None and request.compression_stats:
+            request.trace.tags['compression'] = {
+                name: {
+                    'encoding': stats.encoding, 'raw_bytes': stats.raw_bytes,
+                    'compressed_bytes': stats.compressed_bytes, 'cpu_seconds': stats.cpu_seconds,
+                }
+                for name, stats in request.compression_stats
+            }
@@ -9,9 +9,12 @@ Ex. python mock_upload_study.py <path_to_dicom_dir>
 """
 
 import argparse
+import hashlib
 import os
 import requests
 import json
+import time
+import zlib
 
 import numpy as np
 from requests_toolbelt import MultipartEncoder
@@ -19,11 +22,52 @@ from requests_toolbelt.multipart import decoder
 import pydicom
 
 import test_inference_mask, test_inference_boxes, test_inference_classification
-from utils import create_folder, DICOM_BINARY_TYPES
+from utils import create_folder, mask_voxel_count, unpack_bit_mask, DICOM_BINARY_TYPES
 
 
 from utils import load_image_data, sort_images
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PATH_REFERENCE_CONTENT_TYPE = 'application/x-path-reference+json'
+
+
+def read_path_reference(reference):
+    """Read the file of a part written to the output directory of the gateway, checking its size and digest"""
+    with open(reference['path'], 'rb') as f:
+        content = f.read()
+    if len(content) != reference['size']:
+        raise ValueError('{} has {} bytes, expected {}'.format(reference['path'], len(content), reference['size']))
+    if hashlib.new(reference['algorithm'], content).hexdigest() != reference['digest']:
+        raise ValueError('{} does not match its digest'.format(reference['path']))
+    return content
+
+
+def part_content(part):
+    """Return the content of a response part, decompressed if the part has a Content-Encoding,
+    or read from its file if the part is a path reference"""
+    if part.headers.get(b'Content-Type', b'').decode() == PATH_REFERENCE_CONTENT_TYPE:
+        return read_path_reference(json.loads(part.text))
+    encoding = part.headers.get(b'Content-Encoding', b'').decode()
+    if not encoding:
+        return part.content
+    if encoding == 'gzip':
+        return zlib.decompress(part.content, 16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(part.content)
+    raise ValueError('Unsupported part Content-Encoding {}'.format(encoding))
+
+
+def read_mask(content, json_part):
+    """Return a mask as one uint8 per voxel, unpacking it if it was sent bit-packed"""
+    if json_part.get('bit_packed'):
+        return unpack_bit_mask(content, mask_voxel_count(json_part))
+    return np.frombuffer(content, dtype=np.uint8)
+
 
 def save_secondary_captures(json_response, output_folder_path, multipart_data):
     secondary_capture_parts = [
@@ -37,7 +81,24 @@ def save_secondary_captures(json_response, output_folder_path, multipart_data):
             output_folder_path, 'sc_{}.dcm'.format(index)
         )
         with open(file_path, 'wb') as outfile:
-            outfile.write(multipart_data.parts[index + 1].content)
+            outfile.write(part_content(multipart_data.parts[index + 1]))
+
+def compress_body(encoder, encoding, chunk_size=1024 * 1024):
+    """Compress the body of a MultipartEncoder with the given Content-Encoding"""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd' and zstandard is not None:
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError('Unsupported request Content-Encoding {}'.format(encoding))
+    chunks = []
+    while True:
+        chunk = encoder.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
 
 def upload_study_me(file_path,
                     host,
@@ -49,9 +110,13 @@ def upload_study_me(file_path,
                     include_label_plots=False,
                     route='/',
                     request_study_path='',
-                    request_options={}):
+                    request_options={},
+                    accept_encoding=None,
+                    request_encoding=None):
     file_dict = []
     headers = {'Content-Type': 'multipart/related; '}
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
 
     images = load_image_data(file_path)
     images = sort_images(images)
@@ -113,7 +178,18 @@ def upload_study_me(file_path,
         me = MultipartEncoder(fields=file_dict)
         boundary = me.content_type.split('boundary=')[1]
         headers['Content-Type'] = headers['Content-Type'] + 'boundary="{}"'.format(boundary)
-        r = requests.post(target, data=me, headers=headers)
+        if request_encoding:
+            body_size = me.len
+            start = time.time()
+            data = compress_body(me, request_encoding)
+            print('Compressed request body with {} from {} to {} bytes in {:.2f}s'.format(
+                request_encoding, body_size, len(data), time.time() - start))
+            headers['Content-Encoding'] = request_encoding
+        else:
+            data = me
+        start = time.time()
+        r = requests.post(target, data=data, headers=headers)
+        print('Request sent and answered in {:.2f}s'.format(time.time() - start))
 
     if r.status_code != 200:
         print("Got error status code ", r.status_code)
@@ -137,7 +213,7 @@ def upload_study_me(file_path,
         "The server must return one binary buffer for each object in `parts`. Got {} buffers and {} 'parts' objects" \
         .format(len(multipart_data.parts) - non_buffer_count, mask_count)
 
-    masks = [np.frombuffer(p.content, dtype=np.uint8) for i, p in enumerate(multipart_data.parts[1:mask_count+1])
+    masks = [read_mask(part_content(p), json_response['parts'][i]) for i, p in enumerate(multipart_data.parts[1:mask_count+1])
              if json_response['parts'][i]['binary_type'] not in DICOM_BINARY_TYPES]
 
     if images[0].position is None and \
@@ -227,6 +303,12 @@ def parse_args():
                         "If a value contains spaces, you should define "
                         "it with double quotes. Values are always treated as strings. "
                         "e.g. --request_options foo=bar a=b greeting=\"hello there\"")
+    parser.add_argument("--accept_encoding", default=None, type=str,
+                        help="If set, sent as the Accept-Encoding header of the request, e.g. 'gzip' or 'zstd, gzip', "
+                        "to receive compressed mask parts from a gateway with COMPRESS_RESPONSE_PARTS enabled")
+    parser.add_argument("--request_encoding", default=None, choices=['gzip', 'zstd'],
+                        help="If set, the multipart request body is compressed and sent with this Content-Encoding, "
+                        "to compare the upload time of large studies with and without compression")
     args = parser.parse_args()
 
     return args
@@ -245,4 +327,6 @@ if __name__ == '__main__':
                     args.include_label_plots,
                     args.route,
                     args.request_study_path,
-                    request_options)
+                    request_options,
+                    args.accept_encoding,
+                    args.request_encoding)
@@ -8,7 +8,7 @@ from io import BytesIO
 import numpy as np
 import matplotlib.pyplot as plt
 import pydicom
-from utils import load_image_data, sort_images, create_folder, get_pixels, group_by_series, filter_masks_by_binary_type, filter_mask_parts
+from utils import load_image_data, sort_images, create_folder, get_pixels, group_by_series, filter_masks_by_binary_type, filter_mask_parts, unpack_bit_mask
 import cv2
 
 colors = [[1, 0, 0],
@@ -174,6 +174,10 @@ def _draw_mask_on_image(pixels, image_mask, json_part, response_json, mask_index
     mask_alpha = 0.5
     max_value = np.iinfo(pixels.dtype).max
 
+    if json_part.get('bit_packed') and image_mask.shape[0] == (pixels.shape[0] + 7) // 8:
+        # Bit-packed mask of this image only
+        image_mask = unpack_bit_mask(image_mask, pixels.shape[0])
+
     assert image_mask.shape[0] == pixels.shape[0], \
         "The size of mask {} ({}) does not match the size of the image ({})".format(mask_index, image_mask.shape[0], pixels.shape[0])
 
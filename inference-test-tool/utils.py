@@ -123,6 +123,14 @@ def _sort_series_images(images):
 def filter_mask_parts(response_json):
     return [p for p in response_json["parts"] if p['binary_type'] not in DICOM_BINARY_TYPES]
 
+def mask_voxel_count(json_part):
+    return int(np.prod([json_part['binary_data_shape'].get(axis, 1) for axis in ('timepoints', 'depth', 'height', 'width')]))
+
+def unpack_bit_mask(mask, count):
+    # Unpacks a mask sent with "bit_packed": true, 8 voxels per byte with the first voxel in the
+    # most significant bit, into one uint8 per voxel, 255 for positive voxels
+    return np.unpackbits(np.frombuffer(mask, dtype=np.uint8), count=count) * np.uint8(255)
+
 def filter_masks_by_binary_type(masks, all_mask_parts, response_json):
     # Filters the output masks into binary masks vs dicom data such as SC
     # Returns a tuple of two lists: ([binary masks], [dicom data])
@@ -15,8 +15,8 @@ import tempfile
 import yaml
 
 import numpy
-import pydicom
 from utils import tagged_logger
+from utils import volumes
 
 # ensure logging is configured before flask is initialized
 
@@ -28,7 +28,7 @@ logger = logging.getLogger('inference')
 
 # pylint: disable=import-error,no-name-in-module
 from gateway import Gateway
-from flask import make_response
+from async_gateway import AsyncGateway
 
 def handle_exception(e):
     logger.exception('internal server error %s', e)
@@ -44,10 +44,10 @@ def get_empty_response():
 def healthcheck_handler():
     # Return if the model is ready to receive inference requests
 
-    return make_response('READY', 200)
+    return 'READY', 200
 
 def get_classification_response(json_input, dicom_instances):
-    dcm = pydicom.read_file(dicom_instances[0])
+    dcm = dicom_instances[0].header
     response_json = {
         'protocol_version': '1.0',
         'parts': [],
@@ -70,7 +70,7 @@ def get_classification_response(json_input, dicom_instances):
     return response_json, []
 
 def get_bounding_box_2d_response(json_input, dicom_instances):
-    dcm = pydicom.read_file(dicom_instances[0])
+    dcm = dicom_instances[0].header
     response_json = {
         'protocol_version': '1.0',
         'parts': [],
@@ -86,39 +86,26 @@ def get_bounding_box_2d_response(json_input, dicom_instances):
     return response_json, []
 
 def get_probability_mask_3D_response(json_input, dicom_instances):
-    # Assuming that all files have the same size
-    dcm = pydicom.read_file(dicom_instances[0])
-    depth = len(dicom_instances)
-    image_width = dcm.Columns
-    image_height = dcm.Rows
+    # Only the geometry of the series is needed, the pixels are not decoded
+    volume = volumes.assemble_volumes(dicom_instances, pixels=False)[0]
+    depth = volume.depth
+    image_width = volume.width
+    image_height = volume.height
     response_json = {
         'protocol_version': '1.0',
-        'parts': [
-            {
-                'label': 'Mock seg',
-                'binary_type': 'probability_mask',
-                'binary_data_shape': {
-                    'timepoints': 1,
-                    'depth': depth,
-                    'width': image_width,
-                    'height': image_height
-                },
-                'SeriesInstanceUID': dcm.SeriesInstanceUID
-            }
-        ]
+        'parts': [volume.mask_part('Mock seg', 'probability_mask')]
     }
 
-    array_shape = (depth, image_height, image_width)
-
-    # This code produces a mask that grows from the center of the image outwards as the image slices advance
-    mask = numpy.zeros(array_shape, dtype=numpy.uint8)
+    # This code produces a mask that grows from the center of the image outwards as the image slices advance.
+    # Only the box of each slice is stored, the gateway expands the slices one by one as it sends them
+    mask = volume.new_sparse_mask()
     mid_x = int(image_width / 2)
     mid_y = int(image_height / 2)
     for s in range(depth):
         offset_x = int(s / depth * mid_x)
         offset_y = int(s / depth * mid_y)
-        indices = numpy.ogrid[mid_y - offset_y : mid_y + offset_y, mid_x - offset_x : mid_x + offset_x]
-        mask[s][tuple(indices)] = 255
+        for t in range(volume.timepoints):
+            mask.fill_box((t, s), mid_y - offset_y, mid_x - offset_x, mid_y + offset_y, mid_x + offset_x, 255)
 
     return response_json, [mask]
 
@@ -131,7 +118,7 @@ def get_probability_mask_2D_response(json_input, dicom_instances):
 
     masks = []
     for dicom_file in dicom_instances:
-        dcm = pydicom.read_file(dicom_file)
+        dcm = dicom_file.header
         response_json['parts'].append(
             {
                 'label': 'Mock seg',
@@ -200,22 +187,34 @@ def parse_args():
         action='store_true')
     group.add_argument("-cl", "--classification_model", default=False, help="If the model's output are labels",
         action='store_true')
+    parser.add_argument("--asgi", default=False, help="Serve with the asyncio gateway and uvicorn instead of Flask",
+        action='store_true')
+    parser.add_argument("--study_path_root", default=[], action='append',
+        help="Directory studyPath requests may read studies from, e.g. a mounted volume. Can be repeated")
     args = parser.parse_args()
 
     return args
 
 if __name__ == '__main__':
     args = parse_args()
-    app = Gateway(__name__)
-    app.register_error_handler(Exception, handle_exception)
+    if args.asgi:
+        app = AsyncGateway()
+    else:
+        app = Gateway(__name__)
+        app.register_error_handler(Exception, handle_exception)
+        app.config['STUDY_PATH_ROOTS'] = args.study_path_root
     if args.bounding_box_model:
-        app.add_inference_route('/', request_handler_bbox)
+        app.add_inference_route('/', request_handler_bbox, lazy_instances=True)
     elif args.segmentation_model_3D:
-        app.add_inference_route('/', request_handler_3D_segmentation)
+        app.add_inference_route('/', request_handler_3D_segmentation, lazy_instances=True)
     elif args.classification_model:
-        app.add_inference_route('/', request_handler_classification)
+        app.add_inference_route('/', request_handler_classification, lazy_instances=True)
     else:
-        app.add_inference_route('/', request_handler_2D_segmentation)
+        app.add_inference_route('/', request_handler_2D_segmentation, lazy_instances=True)
 
     app.add_healthcheck_route(healthcheck_handler)
-    app.run(host='0.0.0.0', port=8000, debug=True, use_reloader=True)
+    if args.asgi:
+        import uvicorn
+        uvicorn.run(app, host='0.0.0.0', port=8000)
+    else:
+        app.run(host='0.0.0.0', port=8000, debug=True, use_reloader=True)
@@ -0,0 +1,127 @@
+import threading
+import time
+import unittest
+
+from utils.admission import AdmissionController, AdmissionRejected, MemoryGovernor
+
+class TestAdmissionController(unittest.TestCase):
+    def testRejectWhenQueueFull(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=0, retry_after=5)
+        admission.acquire()
+        self.assertTrue(admission.saturated)
+        with self.assertRaises(AdmissionRejected) as cm:
+            admission.acquire()
+        self.assertEqual(cm.exception.retry_after, 5)
+
+        admission.release()
+        self.assertFalse(admission.saturated)
+        admission.acquire()
+        self.assertEqual(admission.stats(), {
+            'active': 1, 'queued': 0, 'rejected': 1, 'max_concurrent': 1, 'max_queue': 0,
+        })
+
+    def testQueue(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=1)
+        admission.acquire()
+        admitted = threading.Event()
+
+        def queued_request():
+            admission.acquire()
+            admitted.set()
+
+        thread = threading.Thread(target=queued_request)
+        thread.start()
+        while admission.stats()['queued'] == 0:
+            time.sleep(0.001)
+        self.assertTrue(admission.saturated)
+        self.assertRaises(AdmissionRejected, admission.acquire)
+        self.assertFalse(admitted.is_set())
+
+        admission.release()
+        thread.join()
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(admission.stats()['active'], 1)
+
+    def testQueueTimeout(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.01)
+        admission.acquire()
+        self.assertRaises(AdmissionRejected, admission.acquire)
+        self.assertEqual(admission.stats()['queued'], 0)
+        self.assertEqual(admission.stats()['rejected'], 1)
+
+class TestMemoryGovernor(unittest.TestCase):
+    def testLargerThanBudget(self):
+        governor = MemoryGovernor(max_bytes=100)
+        with self.assertRaises(AdmissionRejected) as cm:
+            governor.reserve(101)
+        self.assertEqual(cm.exception.status, 413)
+        self.assertEqual(governor.stats()['rejected'], 1)
+
+    def testGrow(self):
+        governor = MemoryGovernor(max_bytes=100)
+        reservation = governor.reserve(10)
+        reservation.grow(60)
+        # Growing does not wait, and never shrinks the reservation
+        other = governor.reserve(40)
+        reservation.grow(80)
+        reservation.grow(20)
+        self.assertEqual(governor.stats()['reserved_bytes'], 120)
+        with self.assertRaises(AdmissionRejected) as cm:
+            reservation.grow(101)
+        self.assertEqual(cm.exception.status, 413)
+        self.assertEqual(reservation.nbytes, 80)
+        reservation.release()
+        other.release()
+        self.assertEqual(governor.stats()['reserved_bytes'], 0)
+
+    def testWaitForMemory(self):
+        governor = MemoryGovernor(max_bytes=100)
+        first = governor.reserve(60)
+        reserved = []
+        thread = threading.Thread(target=lambda: reserved.append(governor.reserve(50)))
+        thread.start()
+        while not governor.saturated:
+            time.sleep(0.001)
+
+        first.resize(40)
+        thread.join()
+        self.assertEqual(governor.stats()['reserved_bytes'], 90)
+        self.assertFalse(governor.saturated)
+
+        first.release()
+        reserved[0].release()
+        self.assertEqual(governor.stats()['reserved_bytes'], 0)
+
+    def testFirstComeFirstServed(self):
+        governor = MemoryGovernor(max_bytes=100)
+        first = governor.reserve(100)
+        order = []
+
+        def reserve(nbytes):
+            governor.reserve(nbytes)
+            order.append(nbytes)
+
+        large = threading.Thread(target=reserve, args=(80,))
+        large.start()
+        while governor.stats()['waiting'] < 1:
+            time.sleep(0.001)
+        small = threading.Thread(target=reserve, args=(10,))
+        small.start()
+        while governor.stats()['waiting'] < 2:
+            time.sleep(0.001)
+
+        first.resize(10)
+        large.join()
+        small.join()
+        self.assertEqual(order, [80, 10])
+
+    def testTimeout(self):
+        governor = MemoryGovernor(max_bytes=100, max_wait=0.01, retry_after=2)
+        governor.reserve(100)
+        with self.assertRaises(AdmissionRejected) as cm:
+            governor.reserve(1)
+        self.assertEqual((cm.exception.status, cm.exception.retry_after), (503, 2))
+        self.assertEqual(governor.stats()['waiting'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
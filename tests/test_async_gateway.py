@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+import unittest
+
+from requests_toolbelt import MultipartDecoder
+
+from async_gateway import AsyncGateway
+from tests.test_gateway import make_request_body, mask_handler
+from utils import multipart
+from utils.lazy_instances import InstanceList
+from utils.result_cache import ResultCache
+
+async def call(app, method, path, body=b'', content_type=None, chunk_size=1000):
+    headers = [] if content_type is None else [(b'content-type', content_type.encode('latin-1'))]
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers}
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b'']
+    messages = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(0)
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+class TestAsyncGateway(unittest.TestCase):
+    dicoms = [b'\x01' * 10, b'\x02' * 5000]
+
+    def setUp(self):
+        self.app = AsyncGateway()
+        self.app.config['MULTIPART_SPILL_THRESHOLD'] = 1024
+        self.addCleanup(self.app._executor.shutdown)
+
+    def post(self, route='/', **kwargs):
+        body, content_type = make_request_body(self.dicoms)
+        return asyncio.run(call(self.app, 'POST', route, body, content_type, **kwargs))
+
+    def decode(self, body, headers):
+        return MultipartDecoder(body, headers['content-type']).parts
+
+    def testSyncHandler(self):
+        self.app.add_inference_route('/', mask_handler)
+        status, headers, body = self.post()
+        self.assertEqual(status, 200)
+
+        parts = self.decode(body, headers)
+        self.assertEqual(len(parts), len(self.dicoms) + 2)
+        self.assertEqual(len(json.loads(parts[0].text)['parts']), len(self.dicoms))
+        self.assertEqual(parts[1].content, bytes([10] * 12))
+        self.assertEqual(parts[2].content, bytes([5000 % 256] * 12))
+
+    def testAsyncHandler(self):
+        threads = []
+
+        async def async_handler(json_input, dicom_instances, input_digest):
+            threads.append(threading.current_thread())
+            await asyncio.sleep(0)
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/', async_handler)
+        status, headers, body = self.post()
+        self.assertEqual(status, 200)
+        self.assertEqual(threads, [threading.main_thread()])
+        self.assertEqual(self.decode(body, headers)[2].content, bytes([5000 % 256] * 12))
+
+    def testLazyInstances(self):
+        received = []
+
+        async def async_handler(json_input, dicom_instances, input_digest):
+            received.append(dicom_instances)
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/', async_handler, lazy_instances=True)
+        status, _, _ = self.post()
+        self.assertEqual(status, 200)
+        self.assertIsInstance(received[0], InstanceList)
+        self.assertEqual(len(received[0]), len(self.dicoms))
+
+    def testSameResponseAsFlaskGateway(self):
+        from gateway import Gateway
+        flask_app = Gateway(__name__)
+        flask_app.add_inference_route('/', mask_handler)
+        request_body, content_type = make_request_body(self.dicoms)
+        flask_response = flask_app.test_client().post('/', data=request_body, content_type=content_type)
+
+        self.app.add_inference_route('/', mask_handler)
+        status, headers, body = self.post()
+        self.assertEqual(body, flask_response.get_data())
+        self.assertEqual(headers['content-type'], flask_response.headers['Content-Type'])
+
+    def testInvalidRequests(self):
+        self.app.add_inference_route('/', mask_handler)
+        status, _, _ = asyncio.run(call(self.app, 'POST', '/', b'{}', 'application/json'))
+        self.assertEqual(status, 400)
+
+        body, content_type = make_request_body(self.dicoms)
+        status, _, _ = asyncio.run(call(self.app, 'POST', '/', body[:-30], content_type))
+        self.assertEqual(status, 400)
+
+        status, _, _ = asyncio.run(call(self.app, 'GET', '/'))
+        self.assertEqual(status, 405)
+        status, _, _ = asyncio.run(call(self.app, 'POST', '/missing'))
+        self.assertEqual(status, 404)
+
+    def testPartsClosedOnError(self):
+        created = []
+        init = multipart.BodyPart.__init__
+
+        def tracking_init(part, *args, **kwargs):
+            init(part, *args, **kwargs)
+            created.append(part)
+
+        multipart.BodyPart.__init__ = tracking_init
+        self.addCleanup(setattr, multipart.BodyPart, '__init__', init)
+        self.app.add_inference_route('/', mask_handler)
+        body, content_type = make_request_body(self.dicoms)
+        status, _, _ = asyncio.run(call(self.app, 'POST', '/', body[:-30], content_type))
+        self.assertEqual(status, 400)
+        self.assertEqual(len(created), len(self.dicoms) + 1)
+        self.assertTrue(all(part._file is None and part._memory is None for part in created))
+
+        # Cancelled while the last part is received
+        scope = {'type': 'http', 'method': 'POST', 'path': '/',
+                 'headers': [(b'content-type', content_type.encode('latin-1'))]}
+        messages = [{'type': 'http.request', 'body': body[:-1000], 'more_body': True}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait()
+
+        async def cancelled():
+            request = asyncio.ensure_future(self.app(scope, receive, None))
+            while len(created) < len(self.dicoms) + 1:
+                await asyncio.sleep(0.001)
+            request.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await request
+
+        created.clear()
+        asyncio.run(cancelled())
+        # Wait for a chunk that was still being parsed
+        self.app._executor.shutdown()
+        self.assertEqual(len(created), len(self.dicoms) + 1)
+        self.assertTrue(all(part._file is None and part._memory is None for part in created))
+
+    def testHandlerError(self):
+        def failing_handler(*args):
+            raise RuntimeError('model failed')
+
+        self.app.add_inference_route('/', failing_handler)
+        with self.assertLogs('async_gateway', 'ERROR'):
+            status, _, _ = self.post()
+        self.assertEqual(status, 500)
+
+    def testHealthcheck(self):
+        self.app.add_healthcheck_route(lambda: ('LOADING', 503))
+        status, _, body = asyncio.run(call(self.app, 'GET', '/healthcheck'))
+        self.assertEqual((status, body), (503, b'LOADING'))
+
+        status, _, _ = asyncio.run(call(self.app, 'GET', '/ping'))
+        self.assertEqual(status, 200)
+
+    def testCoalesceAndCache(self):
+        calls = []
+
+        async def slow_handler(json_input, dicom_instances, input_digest):
+            calls.append(input_digest)
+            await asyncio.sleep(0.05)
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        cache = ResultCache()
+        self.app.add_inference_route('/', slow_handler, result_cache=cache, coalesce=True)
+        body, content_type = make_request_body(self.dicoms)
+
+        async def concurrent_posts():
+            return await asyncio.gather(*[
+                call(self.app, 'POST', '/', body, content_type) for _ in range(3)
+            ])
+
+        responses = asyncio.run(concurrent_posts())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.app.coalesced_requests, 2)
+        self.assertEqual(len({r[2] for r in responses}), 1)
+
+        status, _, replayed = self.post()
+        self.assertEqual(status, 200)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(replayed, responses[0][2])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def testNotCoalescedByDefault(self):
+        calls = []
+
+        async def slow_handler(json_input, dicom_instances, input_digest):
+            calls.append(input_digest)
+            await asyncio.sleep(0.05)
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/', slow_handler)
+        body, content_type = make_request_body(self.dicoms)
+
+        async def concurrent_posts():
+            return await asyncio.gather(*[
+                call(self.app, 'POST', '/', body, content_type) for _ in range(3)
+            ])
+
+        asyncio.run(concurrent_posts())
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.app.coalesced_requests, 0)
+
+    def testLeaderCancelled(self):
+        calls = []
+
+        async def slow_handler(json_input, dicom_instances, input_digest):
+            calls.append(input_digest)
+            await asyncio.sleep(0.05)
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/', slow_handler, coalesce=True)
+        body, content_type = make_request_body(self.dicoms)
+
+        async def cancel_leader():
+            leader = asyncio.ensure_future(call(self.app, 'POST', '/', body, content_type))
+            while not calls:
+                await asyncio.sleep(0.001)
+            follower = asyncio.ensure_future(call(self.app, 'POST', '/', body, content_type))
+            while not self.app.coalesced_requests:
+                await asyncio.sleep(0.001)
+            leader.cancel()
+            return await follower
+
+        status, headers, body = asyncio.run(cancel_leader())
+        self.assertEqual(status, 200)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.decode(body, headers)[2].content, bytes([5000 % 256] * 12))
+
+    def testBodyParsedInThreadPool(self):
+        from utils import multipart
+        threads = set()
+        feed = multipart.MultipartParser.feed
+
+        def tracking_feed(parser, data):
+            threads.add(threading.current_thread())
+            return feed(parser, data)
+
+        self.app.add_inference_route('/', mask_handler)
+        multipart.MultipartParser.feed = tracking_feed
+        self.addCleanup(setattr, multipart.MultipartParser, 'feed', feed)
+        status, _, _ = self.post()
+        self.assertEqual(status, 200)
+        self.assertNotIn(threading.main_thread(), threads)
+
+if __name__ == '__main__':
+    unittest.main()
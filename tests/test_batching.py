@@ -0,0 +1,63 @@
+import threading
+import unittest
+
+from utils.batching import BatchScheduler
+
+class TestBatchScheduler(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def batch_fn(self, requests):
+        self.batches.append(len(requests))
+        return [({'digest': digest}, [json_input]) for json_input, _, digest in requests]
+
+    def submit_concurrently(self, scheduler, count):
+        results = [None] * count
+        def submit(i):
+            results[i] = scheduler(i, [], str(i))
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def testResultsAreSplitPerRequest(self):
+        scheduler = BatchScheduler(self.batch_fn, max_batch_size=4, max_wait=0.5)
+        results = self.submit_concurrently(scheduler, 10)
+        self.assertEqual(results, [({'digest': str(i)}, [i]) for i in range(10)])
+        self.assertEqual(sum(self.batches), 10)
+        self.assertLessEqual(max(self.batches), 4)
+        histogram = scheduler.batch_size_histogram()
+        self.assertEqual(sum(size * count for size, count in histogram.items()), 10)
+
+    def testSingleRequestWaitsAtMostMaxWait(self):
+        scheduler = BatchScheduler(self.batch_fn, max_batch_size=4, max_wait=0.01)
+        self.assertEqual(scheduler({}, [], 'a'), ({'digest': 'a'}, [{}]))
+        self.assertEqual(scheduler.batch_size_histogram(), {1: 1})
+
+    def testErrorIsRaisedForEveryRequest(self):
+        def failing_fn(requests):
+            raise RuntimeError('model failed')
+        scheduler = BatchScheduler(failing_fn, max_batch_size=4, max_wait=0.01)
+        with self.assertRaises(RuntimeError):
+            scheduler({}, [], 'a')
+
+    def testWrongNumberOfResults(self):
+        scheduler = BatchScheduler(lambda requests: [], max_wait=0.01)
+        with self.assertRaises(ValueError):
+            scheduler({}, [], 'a')
+
+    def testWorkerStopsOnBaseException(self):
+        def exiting_fn(requests):
+            raise SystemExit()
+        scheduler = BatchScheduler(exiting_fn, max_wait=0.01)
+        with self.assertRaises(SystemExit):
+            scheduler({}, [], 'a')
+        scheduler._thread.join(5)
+        # Later requests fail fast instead of waiting for a dead worker
+        with self.assertRaises(RuntimeError):
+            scheduler({}, [], 'b')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import pickle
+import unittest
+
+import numpy
+
+from utils import bit_masks
+from utils import buffers
+from utils.sparse_masks import SparseMask
+
+
+class TestBitMasks(unittest.TestCase):
+    def testPackAndUnpack(self):
+        rng = numpy.random.RandomState(0)
+        mask = (rng.randint(0, 4, (3, 5, 7)) == 0).astype(numpy.uint8) * 255
+        packed = bit_masks.pack(mask)
+        self.assertEqual(packed.nbytes, (3 * 5 * 7 + 7) // 8)
+        self.assertEqual(buffers.nbytes(packed), packed.nbytes)
+        data = b''.join(bytes(chunk) for chunk in buffers.iter_chunks(packed, 4))
+        self.assertEqual(data, numpy.packbits(mask != 0).tobytes())
+        numpy.testing.assert_array_equal(bit_masks.unpack(data, mask.shape), mask != 0)
+        numpy.testing.assert_array_equal(packed.toarray(), mask != 0)
+
+    def testNonZeroValuesArePositive(self):
+        mask = numpy.array([0, 0.5, -1, 0, 0, 0, 0, 2, 0], dtype=numpy.float32)
+        self.assertEqual(bytes(bit_masks.pack(mask)._packed), bytes([0b01100001, 0]))
+
+    def testBlocks(self):
+        original = bit_masks.PACK_BLOCK_SIZE
+        bit_masks.PACK_BLOCK_SIZE = 16
+        self.addCleanup(setattr, bit_masks, 'PACK_BLOCK_SIZE', original)
+        mask = numpy.arange(101, dtype=numpy.float64) % 3 == 0
+        numpy.testing.assert_array_equal(bit_masks.pack(mask.astype(numpy.float64)).toarray(), mask)
+
+    def testPackSparseMask(self):
+        # Slices of 3 x 5 voxels are not a multiple of 8
+        sparse = SparseMask((4, 3, 5))
+        sparse.fill_box(1, 0, 1, 2, 4)
+        sparse.add_runs(3, [14], [1])
+        packed = bit_masks.pack(sparse)
+        self.assertEqual(b''.join(bytes(c) for c in packed.iter_chunks()),
+                         numpy.packbits(sparse.toarray() != 0).tobytes())
+        self.assertEqual(packed.nbytes, 8)
+        numpy.testing.assert_array_equal(pickle.loads(pickle.dumps(packed)).toarray(), sparse.toarray() != 0)
+
+    def testUnpackWrongSize(self):
+        with self.assertRaises(ValueError):
+            bit_masks.unpack(bytes(3), (5, 5))
+
+    def testPackParts(self):
+        parts = [
+            {'binary_type': 'boolean_mask', 'bit_packed': True},
+            {'binary_type': 'boolean_mask'},
+            {'binary_type': 'probability_mask'},
+        ]
+        mask = numpy.ones((2, 8), dtype=numpy.uint8)
+        packed = bit_masks.pack_parts(parts, [mask, bit_masks.pack(mask), mask])
+        self.assertIsInstance(packed[0], bit_masks.PackedMask)
+        self.assertTrue(parts[1]['bit_packed'])
+        self.assertIs(packed[2], mask)
+
+        with self.assertRaises(ValueError):
+            bit_masks.pack_parts([{'binary_type': 'probability_mask', 'bit_packed': True}], [mask])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import io
+import unittest
+
+import numpy
+import pydicom
+
+from utils import buffers
+
+class TestBufferReader(unittest.TestCase):
+    def setUp(self):
+        with open('tests/data/test_2d/1.dcm', 'rb') as f:
+            self.data = f.read()
+        self.reader = buffers.BufferReader(memoryview(self.data))
+
+    def testRead(self):
+        self.assertEqual(self.reader.read(10), self.data[:10])
+        self.assertEqual(self.reader.tell(), 10)
+        self.reader.seek(-5, io.SEEK_END)
+        self.assertEqual(self.reader.read(), self.data[-5:])
+        self.assertEqual(self.reader.read(), b'')
+
+    def testReadInto(self):
+        target = bytearray(16)
+        self.reader.seek(4)
+        self.assertEqual(self.reader.readinto(target), 16)
+        self.assertEqual(bytes(target), self.data[4:20])
+
+    def testGetBufferIsReadOnly(self):
+        view = self.reader.getbuffer()
+        self.assertTrue(view.readonly)
+        self.assertEqual(view.nbytes, len(self.data))
+
+    def testDcmread(self):
+        expected = pydicom.dcmread(io.BytesIO(self.data))
+        dcm = pydicom.dcmread(self.reader)
+        self.assertEqual(dcm.SOPInstanceUID, expected.SOPInstanceUID)
+
+class TestAsBuffer(unittest.TestCase):
+    def testContiguousArrayIsNotCopied(self):
+        counter = buffers.CopyCounter()
+        mask = numpy.zeros((4, 5), dtype=numpy.uint8)
+        self.assertIs(buffers.as_buffer(mask, counter), mask)
+        self.assertEqual(counter.copies, 0)
+
+    def testNonContiguousArrayIsCopied(self):
+        counter = buffers.CopyCounter()
+        mask = numpy.arange(40, dtype=numpy.uint8).reshape(4, 10)[:, ::2]
+        buffer = buffers.as_buffer(mask, counter)
+        self.assertEqual(counter.copies, 1)
+        self.assertEqual(counter.bytes_copied, 20)
+        self.assertEqual(buffers.byte_view(buffer).tobytes(), mask.tobytes())
+
+    def testFileLike(self):
+        counter = buffers.CopyCounter()
+        self.assertEqual(bytes(buffers.as_buffer(io.BytesIO(b'abc'), counter)), b'abc')
+        self.assertEqual(counter.copies, 0)
+
+    def testByteView(self):
+        mask = numpy.arange(6, dtype=numpy.uint16).reshape(2, 3)
+        view = buffers.byte_view(mask)
+        self.assertEqual(view.format, 'B')
+        self.assertEqual(view.tobytes(), mask.tobytes())
+
+if __name__ == "__main__":
+    unittest.main()
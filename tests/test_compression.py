@@ -0,0 +1,104 @@
+import io
+import unittest
+import zlib
+
+import numpy
+
+from utils import compression
+
+
+class TestNegotiate(unittest.TestCase):
+    def testQualities(self):
+        self.assertEqual(compression.negotiate('gzip, deflate', ('zstd', 'gzip')), 'gzip')
+        self.assertEqual(compression.negotiate('gzip;q=0.5, zstd', ('zstd', 'gzip')), 'zstd')
+        self.assertEqual(compression.negotiate('gzip, zstd;q=0.8', ('zstd', 'gzip')), 'gzip')
+        self.assertEqual(compression.negotiate('zstd, gzip', ('zstd', 'gzip')), 'zstd')
+
+    def testNotAccepted(self):
+        self.assertIsNone(compression.negotiate(None))
+        self.assertIsNone(compression.negotiate(''))
+        self.assertIsNone(compression.negotiate('br, identity'))
+        self.assertIsNone(compression.negotiate('gzip;q=0'))
+
+    def testWildcard(self):
+        self.assertEqual(compression.negotiate('*', ('gzip',)), 'gzip')
+        self.assertIsNone(compression.negotiate('*, gzip;q=0', ('gzip',)))
+
+
+class TestIterCompress(unittest.TestCase):
+    def testGzipRoundTrip(self):
+        mask = numpy.zeros((64, 100, 100), dtype=numpy.uint8)
+        mask[10:20, 30:40, 50:60] = 255
+        stats = compression.CompressionStats('gzip')
+        chunks = list(compression.iter_compress(mask, 'gzip', chunk_size=4096, stats=stats))
+
+        compressed = b''.join(chunks)
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), mask.tobytes())
+        self.assertEqual(stats.raw_bytes, mask.nbytes)
+        self.assertEqual(stats.compressed_bytes, len(compressed))
+        self.assertLess(stats.ratio, 0.05)
+        self.assertGreaterEqual(stats.cpu_seconds, 0)
+
+        decompressor = compression.decompressor('gzip')
+        self.assertEqual(b''.join(decompressor.decompress(c) for c in chunks), mask.tobytes())
+
+    def testEmpty(self):
+        stats = compression.CompressionStats('gzip')
+        compressed = b''.join(compression.iter_compress(b'', 'gzip', stats=stats))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), b'')
+        self.assertEqual(stats.raw_bytes, 0)
+        self.assertEqual(stats.ratio, 1.0)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def testZstdRoundTrip(self):
+        data = bytes(100000)
+        compressed = b''.join(compression.iter_compress(data, 'zstd', chunk_size=30000))
+        self.assertEqual(compression.decompressor('zstd').decompress(compressed), data)
+
+    def decompress(self, compressed, encoding, max_length=10000):
+        stream = io.BytesIO(compressed + b'epilogue')
+        decompressor = compression.StreamDecompressor(encoding, lambda: stream.read(100), max_length)
+        chunks = list(iter(decompressor.read, b''))
+        decompressor.close()
+        self.assertEqual(decompressor.compressed_bytes, len(compressed) + len(b'epilogue'))
+        self.assertEqual(decompressor.raw_bytes, sum(len(c) for c in chunks))
+        return chunks
+
+    def testStreamDecompressor(self):
+        data = bytes(1000000)
+        chunks = self.decompress(b''.join(compression.iter_compress(data, 'gzip')), 'gzip')
+        self.assertEqual(b''.join(chunks), data)
+        self.assertLessEqual(max(len(c) for c in chunks), 10000)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def testZstdStreamDecompressor(self):
+        data = bytes(1000000)
+        # Each chunk of 100 compressed bytes decompresses to far more than
+        # max_length
+        compressed = compression.zstandard.ZstdCompressor().compress(data)
+        stream = io.BytesIO(compressed)
+        decompressor = compression.StreamDecompressor('zstd', lambda: stream.read(100), 10000)
+        chunks = list(iter(decompressor.read, b''))
+        decompressor.close()
+        self.assertEqual(b''.join(chunks), data)
+        self.assertLessEqual(max(len(c) for c in chunks), 10000)
+        self.assertEqual((decompressor.compressed_bytes, decompressor.raw_bytes), (len(compressed), len(data)))
+
+    def testTruncatedAndCorruptedStreams(self):
+        compressed = b''.join(compression.iter_compress(bytes(1000), 'gzip'))
+        decompressor = compression.StreamDecompressor('gzip', io.BytesIO(compressed[:-4]).read)
+        list(iter(decompressor.read, b''))
+        with self.assertRaises(compression.DecompressionError):
+            decompressor.close()
+        with self.assertRaises(compression.DecompressionError):
+            compression.StreamDecompressor('gzip', io.BytesIO(b'not gzip data').read).read()
+
+    def testUnsupportedEncoding(self):
+        with self.assertRaises(compression.UnsupportedEncodingError):
+            list(compression.iter_compress(b'data', 'br'))
+        with self.assertRaises(compression.UnsupportedEncodingError):
+            compression.decompressor('br')
+
+
+if __name__ == '__main__':
+    unittest.main()
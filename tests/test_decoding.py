@@ -0,0 +1,81 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from utils import buffers
+from utils.decoding import DecodePool, _create_output
+from utils.lazy_instances import to_instance_list
+from utils.volumes import assemble_volumes
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'test_3d')
+
+def read_instances():
+    files = []
+    for name in ['1.dcm', '2.dcm', '3.dcm']:
+        with open(os.path.join(DATA_DIR, name), 'rb') as f:
+            files.append(buffers.BufferReader(f.read()))
+    return to_instance_list(files)
+
+class TestDecodePool(unittest.TestCase):
+    def setUp(self):
+        self.instances = read_instances()
+        self.expected = numpy.stack([i.read_pixels() for i in self.instances])
+
+    def decode(self, pool):
+        self.addCleanup(pool.shutdown)
+        pixels = pool.decode(self.instances, self.expected.shape, self.expected.dtype)
+        numpy.testing.assert_array_equal(pixels, self.expected)
+
+        stats, = pool.stats().values()
+        self.assertEqual(stats['frames'], 3)
+        self.assertEqual(stats['bytes'], self.expected.nbytes)
+        self.assertGreater(stats['seconds'], 0)
+        return pixels
+
+    def testThreads(self):
+        self.decode(DecodePool(workers=2))
+
+    def testProcesses(self):
+        pixels = self.decode(DecodePool(workers=2, processes=True))
+        self.assertTrue(pixels.flags.writeable)
+
+    def testVolume(self):
+        pool = DecodePool(workers=2)
+        self.addCleanup(pool.shutdown)
+        volume, = assemble_volumes(self.instances, decode_pool=pool)
+        expected, = assemble_volumes(self.instances)
+        numpy.testing.assert_array_equal(volume.pixels, expected.pixels)
+
+    def testFullShmDir(self):
+        shm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shm_dir)
+
+        allocate = os.posix_fallocate
+        calls = []
+
+        def full_shm(fd, offset, size):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            allocate(fd, offset, size)
+
+        with mock.patch('os.posix_fallocate', full_shm), self.assertLogs('decoding', 'WARNING'):
+            path, output = _create_output(100, shm_dir)
+        self.assertEqual(len(calls), 2)
+        self.addCleanup(os.remove, path)
+        self.assertNotEqual(os.path.dirname(path), shm_dir)
+        self.assertEqual(os.listdir(shm_dir), [])
+        self.assertEqual(len(output), 100)
+        output.close()
+
+    def testInvalidSize(self):
+        with self.assertRaises(ValueError):
+            DecodePool(workers=0)
+
+if __name__ == '__main__':
+    unittest.main()
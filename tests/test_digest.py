@@ -0,0 +1,54 @@
+import hashlib
+import unittest
+
+from utils import digest
+from utils import tracing
+from utils.metrics import StageTimer
+
+class TestDigest(unittest.TestCase):
+    parts = [b'{}', b'\x01' * 10, b'\x02' * 300000]
+
+    def testMessageDigest(self):
+        expected = hashlib.sha256()
+        for part in self.parts:
+            expected.update(hashlib.sha256(part).digest())
+        self.assertEqual(digest.message_digest(self.parts), expected.hexdigest())
+
+    def testUnsupportedAlgorithm(self):
+        with self.assertRaises(ValueError):
+            digest.new('md4000')
+        with self.assertRaises(ValueError):
+            digest.new('shake_128')
+
+class TestPartHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = digest.PartHasher(max_workers=2, min_parallel_size=100)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+
+    def testDigest(self):
+        for algorithm in ['sha256', 'blake2b']:
+            self.assertEqual(
+                self.hasher.digest(TestDigest.parts, algorithm),
+                digest.message_digest(TestDigest.parts, algorithm)
+            )
+
+    def testTimer(self):
+        trace = tracing.Trace()
+        timer = StageTimer(trace)
+        with trace.span('decode') as decode_span:
+            futures = [
+                self.hasher.submit(part, 'sha256', timer, 'input_hash', decode_span)
+                for part in TestDigest.parts
+            ]
+            digests = [f.result() for f in futures]
+
+        self.assertEqual(digests, [hashlib.sha256(part).digest() for part in TestDigest.parts])
+        self.assertIn('input_hash', timer.durations)
+        spans = [s for s in trace.spans if s.name == 'input_hash']
+        self.assertEqual(sorted(s.attributes['size'] for s in spans), [2, 10, 300000])
+        self.assertTrue(all(s.parent is decode_span for s in spans))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,707 @@
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import numpy
+from requests_toolbelt import MultipartEncoder, MultipartDecoder
+
+from gateway import Gateway
+from utils import bit_masks
+from utils import compression
+from utils import digest
+from utils import multipart
+from utils import volumes
+from utils.decoding import DecodePool
+from utils.admission import AdmissionController, MemoryGovernor
+from utils.instance_cache import InstanceCache
+from utils.jobs import JobManager
+from utils.result_cache import ResultCache
+from utils.sparse_masks import SparseMask
+from utils.tagged_logger import TaggedLogger
+
+def mask_handler(json_input, dicom_instances, input_digest):
+    response_json = {
+        'protocol_version': '1.0',
+        'parts': [
+            {
+                'label': 'Mock seg',
+                'binary_type': 'probability_mask',
+                'binary_data_shape': {'width': 4, 'height': 3}
+            }
+            for _ in dicom_instances
+        ]
+    }
+    masks = [numpy.full((3, 4), len(d.read()) % 256, dtype=numpy.uint8) for d in dicom_instances]
+    return response_json, masks
+
+def sparse_mask_handler(json_input, dicom_instances, input_digest):
+    response_json, masks = mask_handler(json_input, dicom_instances, input_digest)
+    return response_json, [SparseMask.from_dense(mask) for mask in masks]
+
+def packed_mask_handler(json_input, dicom_instances, input_digest):
+    mask = SparseMask((2, 3, 4))
+    mask.fill_box(1, 0, 0, 2, 3)
+    shape = {'depth': 2, 'width': 4, 'height': 3}
+    return (
+        {'protocol_version': '1.0', 'parts': [{'binary_type': 'boolean_mask', 'binary_data_shape': shape}]},
+        [bit_masks.pack(mask)]
+    )
+
+def read_test_dicom(name, directory='test_3d'):
+    with open(os.path.join(os.path.dirname(__file__), 'data', directory, name), 'rb') as f:
+        return f.read()
+
+def make_request_body(dicoms, request_json=None, boundary='gateway-test'):
+    fields = [('request_json', ('request', json.dumps(request_json or {}).encode('utf-8'), 'text/json'))]
+    fields.extend((str(i), ('{}.dcm'.format(i), d, 'application/dicom')) for i, d in enumerate(dicoms))
+    encoder = MultipartEncoder(fields, boundary=boundary)
+    return encoder.to_string(), 'multipart/related; boundary={}'.format(boundary)
+
+class GatewayTestCase(unittest.TestCase):
+    dicoms = [b'\x01' * 10, b'\x02' * 5000]
+
+    def setUp(self):
+        self.app = Gateway(__name__)
+        self.app.config['MULTIPART_SPILL_THRESHOLD'] = 1024
+        self.app.add_inference_route('/', mask_handler)
+        self.client = self.app.test_client()
+
+    def post(self, route='/', dicoms=None, request_json=None, **kwargs):
+        body, content_type = make_request_body(self.dicoms if dicoms is None else dicoms, request_json)
+        return self.client.post(route, data=body, content_type=content_type, **kwargs)
+
+    def decode(self, response):
+        return MultipartDecoder(response.get_data(), response.headers['Content-Type']).parts
+
+class TestGateway(GatewayTestCase):
+    def testInference(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+
+        parts = self.decode(response)
+        self.assertEqual(len(parts), len(self.dicoms) + 2)
+        response_json = json.loads(parts[0].text)
+        self.assertEqual(len(response_json['parts']), len(self.dicoms))
+        self.assertEqual(parts[1].content, bytes([10] * 12))
+        self.assertEqual(parts[2].content, bytes([5000 % 256] * 12))
+
+        # Digests are the hash of the concatenated digests of the parts
+        body, content_type = make_request_body(self.dicoms)
+        input_hash = hashlib.sha256()
+        for part in MultipartDecoder(body, content_type).parts:
+            input_hash.update(hashlib.sha256(part.content).digest())
+        input_digest, output_digest = parts[-1].text.split(':')
+        self.assertEqual(parts[-1].headers[b'Content-Type'], b'text/plain')
+        self.assertEqual(input_digest, input_hash.hexdigest())
+
+        output_hash = hashlib.sha256()
+        output_hash.update(hashlib.sha256(json.dumps(response_json).encode('utf-8')).digest())
+        for part in parts[1:-1]:
+            output_hash.update(hashlib.sha256(part.content).digest())
+        self.assertEqual(output_digest, output_hash.hexdigest())
+
+    def testHashAlgorithm(self):
+        self.app.config['HASH_ALGORITHM'] = 'blake2b'
+        response = self.post()
+        parts = self.decode(response)
+
+        body, content_type = make_request_body(self.dicoms)
+        input_digest, output_digest = parts[-1].text.split(':')
+        self.assertEqual(input_digest, digest.message_digest(
+            [part.content for part in MultipartDecoder(body, content_type).parts], 'blake2b'
+        ))
+        self.assertEqual(output_digest, digest.message_digest(
+            [part.content for part in parts[:-1]], 'blake2b'
+        ))
+
+    def testParallelHashing(self):
+        self.app._part_hasher.min_parallel_size = 0
+        dicoms = [bytes([i]) * 100000 for i in range(8)]
+        first = self.decode(self.post(dicoms=dicoms))[-1].text
+        self.app._part_hasher.min_parallel_size = digest.DEFAULT_MIN_PARALLEL_SIZE
+        second = self.decode(self.post(dicoms=dicoms))[-1].text
+        self.assertEqual(first, second)
+
+    def testInvalidContentType(self):
+        response = self.client.post('/', data='{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def testTruncatedBody(self):
+        body, content_type = make_request_body(self.dicoms)
+        response = self.client.post('/', data=body[:-30], content_type=content_type)
+        self.assertEqual(response.status_code, 400)
+
+    def testPartsClosedOnError(self):
+        created = []
+        init = multipart.BodyPart.__init__
+
+        def tracking_init(part, *args, **kwargs):
+            init(part, *args, **kwargs)
+            created.append(part)
+
+        multipart.BodyPart.__init__ = tracking_init
+        self.addCleanup(setattr, multipart.BodyPart, '__init__', init)
+        # The compressed stream ends while the last part is being written
+        response = self.postCompressed(lambda body: gzip.compress(body)[:-12])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(created), len(self.dicoms) + 1)
+        self.assertTrue(all(part._file is None and part._memory is None for part in created))
+
+    def testPartsSentWhileHashed(self):
+        release = threading.Event()
+        hasher = self.app._serializer.part_hasher
+        submit = hasher.submit
+        futures = []
+
+        def blocked_submit(data, *args, **kwargs):
+            future = concurrent.futures.Future()
+            hashed = submit(data, *args, **kwargs)
+            threading.Thread(target=lambda: (release.wait(5), future.set_result(hashed.result()))).start()
+            futures.append(future)
+            return future
+
+        hasher.submit = blocked_submit
+        response = self.post()
+        chunks = response.iter_encoded()
+        body = next(chunks)
+        # The response started before the output was hashed
+        self.assertFalse(any(f.done() for f in futures))
+        release.set()
+        body += b''.join(chunks)
+        response.close()
+        parts = MultipartDecoder(body, response.headers['Content-Type']).parts
+        self.assertEqual(len(parts), len(self.dicoms) + 2)
+        self.assertEqual(len(futures), len(self.dicoms) + 1)
+
+
+    def postCompressed(self, compress, encoding='gzip'):
+        body, content_type = make_request_body(self.dicoms)
+        return self.client.post(
+            '/', data=compress(body), content_type=content_type, headers={'Content-Encoding': encoding}
+        )
+
+    def testGzipBody(self):
+        self.app.config['MULTIPART_CHUNK_SIZE'] = 1000
+        plain = self.decode(self.post())
+        compressed = self.decode(self.postCompressed(gzip.compress))
+        # The digests are those of the decompressed parts
+        self.assertEqual(compressed[-1].text, plain[-1].text)
+        self.assertEqual([p.content for p in compressed], [p.content for p in plain])
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def testZstdBody(self):
+        self.app.config['MULTIPART_CHUNK_SIZE'] = 1000
+        plain = self.decode(self.post())
+        compressed = self.decode(self.postCompressed(compression.zstandard.ZstdCompressor().compress, 'zstd'))
+        self.assertEqual([p.content for p in compressed], [p.content for p in plain])
+
+    def testDecompressedSizeOverBudget(self):
+        body, _ = make_request_body(self.dicoms)
+        # The compressed body fits in the budget, the decompressed one does not
+        self.assertLess(len(gzip.compress(body)), len(body) // 2)
+        self.app.memory_governor = MemoryGovernor(max_bytes=len(body) // 2)
+        response = self.postCompressed(gzip.compress)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.app.memory_governor.stats()['reserved_bytes'], 0)
+
+        self.app.memory_governor = MemoryGovernor(max_bytes=len(body) * 2)
+        response = self.postCompressed(gzip.compress)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(self.app.memory_governor.stats()['reserved_bytes'], 0)
+
+    def testInvalidBodies(self):
+        self.assertEqual(self.postCompressed(lambda body: gzip.compress(body)[:-4]).status_code, 400)
+        self.assertEqual(self.postCompressed(lambda body: body).status_code, 400)
+        self.assertEqual(self.postCompressed(gzip.compress, 'br').status_code, 400)
+
+class TestStudyPathRequests(GatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.app.config['STUDY_PATH_ROOTS'] = [self.root]
+        self.dicoms = [read_test_dicom('1.dcm'), read_test_dicom('2.dcm')]
+        for i, d in enumerate(self.dicoms):
+            with open(os.path.join(self.root, '{}.dcm'.format(i)), 'wb') as f:
+                f.write(d)
+
+    def postStudyPath(self, study_path, route='/'):
+        body = json.dumps({'studyPath': study_path, 'inference_command': 'seg'})
+        return self.client.post(route, data=body, content_type='application/json')
+
+    def testSameInstancesAsUpload(self):
+        received = []
+
+        def header_handler(json_input, dicom_instances, input_digest):
+            received.append((json_input, [(i.sop_instance_uid, i.digest) for i in dicom_instances]))
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/lazy', header_handler, lazy_instances=True)
+        response = self.postStudyPath(self.root, '/lazy')
+        self.assertEqual(response.status_code, 200)
+        self.post('/lazy', request_json={'studyPath': self.root, 'inference_command': 'seg'})
+
+        self.assertEqual(received[0], received[1])
+        parts = self.decode(response)
+        self.assertEqual(parts[1].content, bytes([len(self.dicoms[0]) % 256] * 12))
+        input_digest = parts[-1].text.split(':')[0]
+        self.assertEqual(input_digest, digest.message_digest(
+            [json.dumps({'studyPath': self.root, 'inference_command': 'seg'}).encode('utf-8')] + self.dicoms
+        ))
+
+    def testOutputDir(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        self.app.config['OUTPUT_DIR'] = output_dir
+
+        parts = self.decode(self.postStudyPath(self.root))
+        self.assertEqual(len(parts), len(self.dicoms) + 2)
+        output_digest = parts[-1].text.split(':')[1]
+        for i, part in enumerate(parts[1:-1]):
+            self.assertEqual(part.headers[b'Content-Type'], b'application/x-path-reference+json')
+            reference = json.loads(part.text)
+            self.assertEqual(reference['path'], os.path.join(output_dir, output_digest, 'elem_{}.bin'.format(i)))
+            with open(reference['path'], 'rb') as f:
+                content = f.read()
+            self.assertEqual(content, bytes([len(self.dicoms[i]) % 256] * 12))
+            self.assertEqual(reference['digest'], hashlib.sha256(content).hexdigest())
+
+        # Uploads are answered inline
+        parts = self.decode(self.post())
+        self.assertEqual(parts[1].headers[b'Content-Type'], b'application/binary')
+
+    def testInvalidStudyPaths(self):
+        self.assertEqual(self.postStudyPath(os.path.join(self.root, '..')).status_code, 400)
+        self.assertEqual(self.postStudyPath(os.path.join(self.root, 'missing')).status_code, 400)
+        self.assertEqual(self.client.post('/', json={'studyPath': 1}).status_code, 400)
+
+        self.app.config['STUDY_PATH_ROOTS'] = ()
+        self.assertEqual(self.postStudyPath(self.root).status_code, 400)
+
+class TestResultCache(GatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+        self.cache = ResultCache()
+
+        def counting_handler(*args):
+            self.calls += 1
+            return mask_handler(*args)
+
+        self.app.add_inference_route('/cached', counting_handler, result_cache=self.cache)
+
+    def testReplay(self):
+        first = self.post('/cached')
+        second = self.post('/cached')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        self.post('/cached', dicoms=[b'\x03'])
+        self.assertEqual(self.calls, 2)
+
+class TestInstanceCache(GatewayTestCase):
+    def testSharedAcrossRequests(self):
+        self.app.instance_cache = InstanceCache()
+        dicoms = [read_test_dicom('1.dcm'), read_test_dicom('2.dcm')]
+        rows = []
+
+        def cached_handler(json_input, dicom_instances, input_digest):
+            for d in dicom_instances:
+                rows.append(self.app.instance_cache.read(d).pixel_array.shape[0])
+            return mask_handler(json_input, dicom_instances, input_digest)
+
+        self.app.add_inference_route('/instances', cached_handler)
+        self.assertEqual(self.post('/instances', dicoms=dicoms).status_code, 200)
+        self.assertEqual(self.post('/instances', dicoms=dicoms[1:], request_json={'a': 1}).status_code, 200)
+
+        self.assertEqual(rows, [512, 512, 512])
+        stats = self.app.instance_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+        self.assertIn('inference_instance_cache_hits_total 1', self.client.get('/metrics').get_data(as_text=True))
+
+class TestLazyInstances(GatewayTestCase):
+    def testHeadersOnly(self):
+        dicoms = [read_test_dicom('1.dcm'), read_test_dicom('2.dcm')]
+        received = []
+
+        def header_handler(json_input, dicom_instances, input_digest):
+            received.extend(dicom_instances)
+            uid = dicom_instances.series_uids()[0]
+            return {'protocol_version': '1.0', 'parts': [], 'series': uid}, []
+
+        self.app.add_inference_route('/lazy', header_handler, lazy_instances=True)
+        response = self.post('/lazy', dicoms=dicoms)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.decode(response)[0].text)['series'], received[0].series_instance_uid)
+        self.assertEqual([i.digest for i in received], [hashlib.sha256(d).hexdigest() for d in dicoms])
+        self.assertFalse(any(i._pixels_decoded for i in received))
+
+class TestDecodePool(GatewayTestCase):
+    def testVolumeDecoding(self):
+        self.app.decode_pool = DecodePool(workers=2)
+        self.addCleanup(self.app.decode_pool.shutdown)
+        shapes = []
+
+        def volume_handler(json_input, dicom_instances, input_digest):
+            volume, = volumes.assemble_volumes(dicom_instances, decode_pool=self.app.decode_pool)
+            shapes.append(volume.pixels.shape)
+            return {'protocol_version': '1.0', 'parts': [volume.mask_part('seg')]}, [volume.new_mask()]
+
+        self.app.add_inference_route('/volume', volume_handler, lazy_instances=True)
+        dicoms = [read_test_dicom(name) for name in ['1.dcm', '2.dcm', '3.dcm']]
+        self.assertEqual(self.post('/volume', dicoms=dicoms).status_code, 200)
+        self.assertEqual(shapes, [(1, 3, 512, 512)])
+
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('inference_decode_frames_total{transfer_syntax="1.2.840.10008.1.2.1"} 3', metrics)
+
+class TestResponseCompression(GatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['COMPRESS_RESPONSE_PARTS'] = True
+        self.app.config['COMPRESSION_MIN_SIZE'] = 1024
+
+        def large_mask_handler(json_input, dicom_instances, input_digest):
+            shape = {'width': 256, 'height': 256}
+            return (
+                {'protocol_version': '1.0', 'parts': [{'binary_type': 'probability_mask', 'binary_data_shape': shape}]},
+                [numpy.zeros((256, 256), dtype=numpy.uint8)]
+            )
+
+        self.app.add_inference_route('/large', large_mask_handler)
+
+    def testGzipParts(self):
+        response = self.post('/large', headers={'Accept-Encoding': 'br, gzip;q=0.5'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        parts = self.decode(response)
+        self.assertEqual(parts[1].headers[b'Content-Encoding'], b'gzip')
+        self.assertLess(len(parts[1].content), 1024)
+        mask = zlib.decompress(parts[1].content, 16 + zlib.MAX_WBITS)
+        self.assertEqual(mask, bytes(256 * 256))
+
+        # The output digest is computed on the raw parts
+        identity = self.decode(self.post('/large'))
+        self.assertNotIn(b'Content-Encoding', identity[1].headers)
+        self.assertEqual(parts[-1].text, identity[-1].text)
+
+        lines = self.client.get('/metrics').get_data(as_text=True).splitlines()
+        self.assertIn('inference_compression_ratio_count{route="/large",encoding="gzip"} 1', lines)
+        self.assertIn(
+            'inference_compression_bytes_total{{route="/large",encoding="gzip",direction="out"}} {}'.format(
+                len(parts[1].content)
+            ), lines
+        )
+
+    def testSmallPartsAndDisabled(self):
+        parts = self.decode(self.post(headers={'Accept-Encoding': 'gzip'}))
+        self.assertNotIn(b'Content-Encoding', parts[1].headers)
+
+        self.app.config['COMPRESS_RESPONSE_PARTS'] = False
+        parts = self.decode(self.post('/large', headers={'Accept-Encoding': 'gzip'}))
+        self.assertNotIn(b'Content-Encoding', parts[1].headers)
+        self.assertEqual(parts[1].content, bytes(256 * 256))
+
+class TestSparseMasks(GatewayTestCase):
+    def testSameResponseAsDenseMasks(self):
+        self.app.add_inference_route('/sparse', sparse_mask_handler)
+        self.assertEqual(self.post('/sparse').get_data(), self.post('/').get_data())
+
+    def testCachedAndCompressed(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.app.config['COMPRESS_RESPONSE_PARTS'] = True
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+
+        def large_sparse_handler(json_input, dicom_instances, input_digest):
+            mask = SparseMask((100, 256, 256))
+            mask.fill_box(50, 10, 10, 20, 20)
+            shape = {'depth': 100, 'width': 256, 'height': 256}
+            return (
+                {'protocol_version': '1.0', 'parts': [{'binary_type': 'probability_mask', 'binary_data_shape': shape}]},
+                [mask]
+            )
+
+        self.app.add_inference_route('/sparse', large_sparse_handler, result_cache=ResultCache(directory=cache_dir))
+        expected = numpy.zeros((100, 256, 256), dtype=numpy.uint8)
+        expected[50, 10:20, 10:20] = 255
+        for _ in range(2):
+            parts = self.decode(self.post('/sparse', headers={'Accept-Encoding': 'gzip'}))
+            self.assertEqual(zlib.decompress(parts[1].content, 16 + zlib.MAX_WBITS), expected.tobytes())
+            self.assertEqual(parts[-1].text.split(':')[1], digest.message_digest([parts[0].content, expected]))
+
+    def testProcessPoolRoute(self):
+        self.app.add_process_pool_inference_route('/pool', sparse_mask_handler, processes=1)
+        self.addCleanup(self.app.shutdown_process_pools)
+        self.assertEqual(self.post('/pool').get_data(), self.post('/').get_data())
+
+class TestBitPackedMasks(GatewayTestCase):
+    def setUp(self):
+        super().setUp()
+
+        def boolean_mask_handler(json_input, dicom_instances, input_digest):
+            response_json, masks = mask_handler(json_input, dicom_instances, input_digest)
+            for part in response_json['parts']:
+                part['binary_type'] = 'boolean_mask'
+                part['bit_packed'] = True
+            return response_json, [mask % 2 for mask in masks]
+
+        self.app.add_inference_route('/packed', boolean_mask_handler)
+
+    def testPackedParts(self):
+        parts = self.decode(self.post('/packed'))
+        response_json = json.loads(parts[0].text)
+        expected = [mask % 2 for mask in mask_handler(None, [io.BytesIO(d) for d in self.dicoms], None)[1]]
+        self.assertEqual(len(response_json['parts']), len(expected))
+        for part, json_part, mask in zip(parts[1:], response_json['parts'], expected):
+            self.assertTrue(json_part['bit_packed'])
+            self.assertEqual(len(part.content), 2)
+            numpy.testing.assert_array_equal(bit_masks.unpack(part.content, (3, 4)), mask != 0)
+        self.assertEqual(
+            parts[-1].text.split(':')[1],
+            digest.message_digest([p.content for p in parts[:-1]])
+        )
+
+    def testPackedMaskReturnedByHandler(self):
+        self.app.add_process_pool_inference_route('/pool', packed_mask_handler, processes=1)
+        self.addCleanup(self.app.shutdown_process_pools)
+        parts = self.decode(self.post('/pool'))
+        self.assertTrue(json.loads(parts[0].text)['parts'][0]['bit_packed'])
+        self.assertEqual(parts[1].content, bytes([0, 0b00001110, 0b11100000]))
+
+class TestBatchRoute(GatewayTestCase):
+    def testBatchRoute(self):
+        def batch_handler(requests):
+            return [mask_handler(*request) for request in requests]
+
+        self.app.add_batch_inference_route('/batch', batch_handler, max_batch_size=2, max_wait=0.01)
+        response = self.post('/batch')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.decode(response)[1].content, bytes([10] * 12))
+        self.assertEqual(self.app.batch_size_histogram('/batch'), {1: 1})
+
+class TestProcessPoolRoute(GatewayTestCase):
+    def testProcessPoolRoute(self):
+        self.app.add_process_pool_inference_route('/pool', mask_handler, processes=1)
+        self.addCleanup(self.app.shutdown_process_pools)
+        response = self.post('/pool')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), self.post('/').get_data())
+        self.assertEqual(self.app.worker_restarts('/pool'), 0)
+
+class TestAdmission(GatewayTestCase):
+    def testLoadShedding(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_handler(*args):
+            started.set()
+            release.wait()
+            return mask_handler(*args)
+
+        admission = AdmissionController(max_concurrent=1, max_queue=0, retry_after=3)
+        self.app.add_inference_route('/limited', blocking_handler, admission=admission)
+        self.app.add_healthcheck_route(lambda: 'NOT READY' if self.app.saturated else 'READY')
+        self.assertEqual(self.client.get('/healthcheck').get_data(), b'READY')
+
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(self.post('/limited')))
+        thread.start()
+        started.wait()
+
+        rejected = self.post('/limited')
+        self.assertEqual(rejected.status_code, 503)
+        self.assertEqual(rejected.headers['Retry-After'], '3')
+        self.assertEqual(self.client.get('/healthcheck').get_data(), b'NOT READY')
+        self.assertEqual(self.app.admission_stats()['/limited']['active'], 1)
+
+        release.set()
+        thread.join()
+        self.assertEqual(responses[0].status_code, 200)
+        responses[0].close()
+        self.assertEqual(self.app.admission_stats()['/limited'], {
+            'active': 0, 'queued': 0, 'rejected': 1, 'max_concurrent': 1, 'max_queue': 0,
+        })
+        self.assertEqual(self.post('/limited').status_code, 200)
+
+    def testMemoryBudget(self):
+        body, _ = make_request_body(self.dicoms)
+        self.app.memory_governor = MemoryGovernor(max_bytes=len(body) - 1)
+        response = self.post()
+        self.assertEqual(response.status_code, 413)
+        self.assertNotIn('Retry-After', response.headers)
+
+        self.app.memory_governor = MemoryGovernor(max_bytes=len(body) + 10, max_wait=0.01)
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        # The response holds memory until it is sent
+        response_bytes = len(self.decode(response)[0].content) + len(self.dicoms) * 12
+        self.assertEqual(self.app.memory_governor.stats()['reserved_bytes'], response_bytes)
+        self.assertEqual(self.post().status_code, 503)
+        response.close()
+        self.assertEqual(self.app.memory_governor.stats()['reserved_bytes'], 0)
+        self.assertEqual(self.app.memory_governor.stats()['rejected'], 1)
+
+class TestMetrics(GatewayTestCase):
+    def testMetrics(self):
+        self.app.add_inference_route('/cached', mask_handler, result_cache=ResultCache())
+        response = self.post()
+        response.get_data()
+        response.close()
+        self.post('/cached').close()
+        response = self.client.post('/', data='{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response.close()
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.get_data(as_text=True).splitlines()
+
+        self.assertIn('inference_requests_total{route="/",status="200"} 1', lines)
+        self.assertIn('inference_requests_total{route="/",status="400"} 1', lines)
+        self.assertIn('inference_requests_in_flight{route="/"} 0', lines)
+        for stage in ['receive', 'decode', 'input_hash', 'model', 'output_hash', 'serialize', 'encode']:
+            self.assertIn('inference_stage_seconds_count{{route="/",stage="{}"}} 1'.format(stage), lines)
+        self.assertIn('inference_request_parts_count{route="/"} 1', lines)
+        self.assertIn('inference_request_parts_bucket{route="/",le="5"} 1', lines)
+        body, _ = make_request_body(self.dicoms)
+        self.assertIn('inference_request_bytes_sum{{route="/"}} {}'.format(len(body)), lines)
+        self.assertIn('inference_result_cache_misses_total{route="/cached"} 1', lines)
+        self.assertIn('inference_coalesced_requests_total 0', lines)
+
+class TestTracing(GatewayTestCase):
+    def testServerTimingAndTrace(self):
+        def traced_handler(json_input, dicom_instances, input_digest):
+            test_logger = TaggedLogger(logging.getLogger('test'))
+            test_logger.add_tags({ 'input_hash': input_digest })
+            with test_logger.span('forward pass'):
+                return mask_handler(json_input, dicom_instances, input_digest)
+
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir)
+        self.app.config['TRACE_SAMPLE_RATE'] = 1.0
+        self.app.config['TRACE_DIR'] = trace_dir
+        self.app.add_inference_route('/traced', traced_handler)
+
+        response = self.post('/traced')
+        self.assertEqual(response.status_code, 200)
+        timing = [t.split(';')[0] for t in response.headers['Server-Timing'].split(', ')]
+        # The output is hashed while it is sent, after the headers
+        self.assertEqual(timing, ['decode', 'model', 'serialize', 'total'])
+        response.get_data()
+        response.close()
+
+        input_digest = self.decode(response)[-1].text.split(':')[0]
+        with open(os.path.join(trace_dir, input_digest + '.json')) as f:
+            trace = json.load(f)
+        self.assertEqual(trace['otherData']['input_hash'], input_digest)
+        self.assertEqual(trace['otherData']['route'], '/traced')
+        events = {e['name']: e for e in trace['traceEvents']}
+        self.assertEqual(events['forward pass']['args'], { 'input_hash': input_digest })
+        self.assertEqual([e['args']['size'] for e in trace['traceEvents'] if e['name'] == 'part'], [2, 10, 5000])
+        self.assertIn('encode', events)
+        self.assertIn('output_hash', events)
+        self.assertEqual(trace['otherData']['output_hash'], self.decode(response)[-1].text.split(':')[1])
+
+    def testNotSampled(self):
+        self.app.config['TRACE_DIR'] = os.path.join(tempfile.mkdtemp(), 'traces')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.app.config['TRACE_DIR']))
+        response = self.post()
+        response.get_data()
+        response.close()
+        self.assertFalse(os.path.exists(self.app.config['TRACE_DIR']))
+
+class TestAsyncJobs(GatewayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.add_async_inference_route('/', mask_handler)
+
+    def wait_for_result(self, location):
+        for _ in range(500):
+            response = self.client.get(location + '/result')
+            if response.status_code != 202:
+                return response
+            time.sleep(0.01)
+        self.fail('job did not finish')
+
+    def testSubmitAndFetch(self):
+        response = self.post('/jobs')
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        self.assertEqual(response.headers['Location'], '/jobs/' + job_id)
+
+        result = self.wait_for_result('/jobs/' + job_id)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_data(), self.post('/').get_data())
+
+        status = self.client.get('/jobs/' + job_id)
+        self.assertEqual(status.get_json()['status'], 'succeeded')
+
+    def testMaxPendingJobs(self):
+        release = threading.Event()
+
+        def blocking_handler(*args):
+            release.wait(5)
+            return mask_handler(*args)
+
+        job_manager = JobManager(max_workers=1, max_pending=1, retry_after=2)
+        self.addCleanup(job_manager.shutdown)
+        self.app.add_async_inference_route('/limited', blocking_handler, job_manager=job_manager)
+        self.assertEqual(self.post('/limited/jobs').status_code, 202)
+        rejected = self.post('/limited/jobs')
+        self.assertEqual(rejected.status_code, 503)
+        self.assertEqual(rejected.headers['Retry-After'], '2')
+        release.set()
+
+    def testJobAdmission(self):
+        release = threading.Event()
+
+        def blocking_handler(*args):
+            release.wait(5)
+            return mask_handler(*args)
+
+        self.app.memory_governor = MemoryGovernor(max_bytes=10 ** 9)
+        admission = AdmissionController(max_concurrent=1, retry_after=3)
+        self.app.add_async_inference_route('/limited', blocking_handler, admission=admission)
+        response = self.post('/limited/jobs')
+        self.assertEqual(response.status_code, 202)
+        # The queued job holds its slot and the memory of its request
+        rejected = self.post('/limited/jobs')
+        self.assertEqual(rejected.status_code, 503)
+        self.assertEqual(rejected.headers['Retry-After'], '3')
+        self.assertGreater(self.app.memory_governor.stats()['reserved_bytes'], 0)
+        self.assertEqual(self.app.admission_stats()['/limited/jobs']['rejected'], 1)
+
+        release.set()
+        location = response.headers['Location']
+        self.assertEqual(self.wait_for_result(location).status_code, 200)
+        # The job releases them right after its status is updated
+        for _ in range(500):
+            if self.app.admission_stats()['/limited/jobs']['active'] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.app.admission_stats()['/limited/jobs']['active'], 0)
+        self.assertEqual(self.app.memory_governor.stats()['reserved_bytes'], 0)
+        self.assertEqual(self.post('/limited/jobs').status_code, 202)
+
+    def testUnknownJob(self):
+        self.assertEqual(self.client.get('/jobs/unknown').status_code, 404)
+        self.assertEqual(self.client.get('/jobs/unknown/result').status_code, 404)
+        self.assertEqual(self.client.delete('/jobs/unknown').status_code, 404)
+
+if __name__ == "__main__":
+    unittest.main()
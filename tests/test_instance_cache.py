@@ -0,0 +1,67 @@
+import io
+import os
+import threading
+import unittest
+
+import numpy
+import pydicom
+
+from utils import buffers
+from utils.instance_cache import InstanceCache
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'test_3d')
+
+def read_data(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        return f.read()
+
+class TestInstanceCache(unittest.TestCase):
+    def setUp(self):
+        self.data = read_data('1.dcm')
+        self.cache = InstanceCache()
+
+    def testReadPixels(self):
+        instance = self.cache.read(io.BytesIO(self.data))
+        expected = pydicom.dcmread(io.BytesIO(self.data))
+        self.assertEqual(instance.dataset.SOPInstanceUID, expected.SOPInstanceUID)
+        self.assertNotIn('PixelData', instance.dataset)
+        numpy.testing.assert_array_equal(instance.pixel_array, expected.pixel_array)
+        self.assertFalse(instance.pixel_array.flags.writeable)
+
+        self.assertIs(self.cache.read(io.BytesIO(self.data)), instance)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['bytes'], instance.nbytes)
+        self.assertGreater(instance.header_bytes, 0)
+
+    def testHeaderOnly(self):
+        header = self.cache.read(buffers.BufferReader(self.data, 'abc'), pixels=False)
+        self.assertIsNone(header.pixel_array)
+        self.assertIs(self.cache.get('abc', pixels=False), header)
+
+        # The pixels are decoded when they are needed
+        instance = self.cache.read(buffers.BufferReader(self.data, 'abc'))
+        self.assertIsNotNone(instance.pixel_array)
+        self.assertIs(self.cache.get('abc', pixels=False), instance)
+
+    def testEviction(self):
+        instance = self.cache.read(io.BytesIO(self.data))
+        self.cache.max_bytes = instance.nbytes * 3 // 2
+        self.cache.read(io.BytesIO(read_data('2.dcm')))
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (1, 1))
+
+    def testConcurrentReadsParseOnce(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.read(io.BytesIO(self.data))))
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len({id(r) for r in results}), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from utils import jobs
+from utils.admission import AdmissionRejected
+
+class TestJobManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = jobs.JobManager(max_workers=1)
+        self.addCleanup(self.manager.shutdown)
+        self.release = threading.Event()
+
+    def wait_done(self, job):
+        for _ in range(500):
+            if job.done:
+                return
+            time.sleep(0.01)
+        self.fail('job did not finish')
+
+    def blocking(self, result):
+        def fn():
+            self.release.wait(5)
+            return result
+        return fn
+
+    def testSuccess(self):
+        cleaned = []
+        job = self.manager.submit(lambda: 42, 'digest', cleanup=lambda: cleaned.append(True))
+        self.wait_done(job)
+        self.assertEqual(job.status, jobs.SUCCEEDED)
+        self.assertEqual(job.result, 42)
+        self.assertIs(self.manager.get(job.id), job)
+        self.assertEqual(job.to_json()['input_hash'], 'digest')
+        self.assertEqual(cleaned, [True])
+
+    def testFailure(self):
+        def fail():
+            raise RuntimeError('model failed')
+        job = self.manager.submit(fail, 'digest')
+        self.wait_done(job)
+        self.assertEqual(job.status, jobs.FAILED)
+        self.assertEqual(job.error, 'model failed')
+
+    def testCancelQueuedJob(self):
+        cleaned = []
+        running = self.manager.submit(self.blocking(1), 'a')
+        queued = self.manager.submit(self.blocking(2), 'b', cleanup=lambda: cleaned.append(True))
+        self.manager.cancel(queued.id)
+        self.assertEqual(queued.status, jobs.CANCELLED)
+        self.assertEqual(cleaned, [True])
+        self.release.set()
+        self.wait_done(running)
+        self.assertEqual(running.status, jobs.SUCCEEDED)
+
+    def testCancelRunningJobDiscardsResult(self):
+        job = self.manager.submit(self.blocking(1), 'a')
+        while job.status == jobs.QUEUED:
+            time.sleep(0.01)
+        self.manager.cancel(job.id)
+        self.release.set()
+        self.wait_done(job)
+        self.assertEqual(job.status, jobs.CANCELLED)
+        self.assertIsNone(job.result)
+
+    def testRetention(self):
+        self.manager.retention = 0
+        job = self.manager.submit(lambda: 1, 'a')
+        self.wait_done(job)
+        time.sleep(0.01)
+        self.assertIsNone(self.manager.get(job.id))
+
+    def testMaxPending(self):
+        manager = jobs.JobManager(max_workers=1, max_pending=2, retry_after=5)
+        self.addCleanup(manager.shutdown)
+        running = manager.submit(self.blocking(1), 'a')
+        queued = manager.submit(self.blocking(2), 'b')
+        with self.assertRaises(AdmissionRejected) as raised:
+            manager.submit(self.blocking(3), 'c')
+        self.assertEqual(raised.exception.retry_after, 5)
+        self.assertEqual(manager.stats()['pending'], 2)
+
+        # Cancelled and finished jobs are not pending anymore
+        manager.cancel(queued.id)
+        manager.submit(self.blocking(3), 'c')
+        self.release.set()
+        self.wait_done(running)
+        self.assertEqual(running.result, 1)
+
+    def testResultBytes(self):
+        class Result():
+            nbytes = 40
+
+        manager = jobs.JobManager(max_workers=1, max_result_bytes=100)
+        self.addCleanup(manager.shutdown)
+        done = []
+        for _ in range(3):
+            done.append(manager.submit(Result, 'a'))
+            self.wait_done(done[-1])
+        self.assertEqual(manager.stats()['result_bytes'], 80)
+        # The oldest result is evicted first
+        self.assertIsNone(manager.get(done[0].id))
+        self.assertIs(manager.get(done[2].id), done[2])
+
+        manager.retention = 0
+        time.sleep(0.01)
+        manager.get(done[2].id)
+        self.assertEqual(manager.stats()['result_bytes'], 0)
+
+    def testShutdownCancelsQueuedJobs(self):
+        cleaned = []
+        manager = jobs.JobManager(max_workers=1)
+        running = manager.submit(self.blocking(1), 'a')
+        queued = manager.submit(self.blocking(2), 'b', cleanup=lambda: cleaned.append(True))
+        self.release.set()
+        manager.shutdown()
+        self.assertEqual(running.status, jobs.SUCCEEDED)
+        self.assertEqual(queued.status, jobs.CANCELLED)
+        self.assertEqual(cleaned, [True])
+
+    def testUnknownJob(self):
+        self.assertIsNone(self.manager.get('unknown'))
+        self.assertIsNone(self.manager.cancel('unknown'))
+
+if __name__ == "__main__":
+    unittest.main()
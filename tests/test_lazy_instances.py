@@ -0,0 +1,62 @@
+import io
+import os
+import unittest
+
+import numpy
+import pydicom
+
+from utils import buffers
+from utils.instance_cache import InstanceCache
+from utils.lazy_instances import LazyInstance, InstanceList, to_instance_list
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def read_data(directory, name):
+    with open(os.path.join(DATA_DIR, directory, name), 'rb') as f:
+        return f.read()
+
+class TestLazyInstance(unittest.TestCase):
+    def setUp(self):
+        self.data = read_data('test_3d', '1.dcm')
+        self.expected = pydicom.dcmread(io.BytesIO(self.data))
+
+    def testHeaderOnly(self):
+        instance = LazyInstance(self.data)
+        self.assertEqual(instance.sop_instance_uid, self.expected.SOPInstanceUID)
+        self.assertNotIn('PixelData', instance.header)
+        self.assertFalse(instance._pixels_decoded)
+
+        numpy.testing.assert_array_equal(instance.pixel_array, self.expected.pixel_array)
+        self.assertIs(instance.pixel_array, instance.pixel_array)
+
+    def testStillFileLike(self):
+        instance = LazyInstance(self.data)
+        instance.header
+        self.assertEqual(instance.tell(), 0)
+        self.assertEqual(pydicom.dcmread(instance).SOPInstanceUID, self.expected.SOPInstanceUID)
+
+    def testInstanceCache(self):
+        cache = InstanceCache()
+        first = LazyInstance(self.data, 'abc', cache)
+        second = LazyInstance(self.data, 'abc', cache)
+        self.assertIs(first.pixel_array, second.pixel_array)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+class TestInstanceList(unittest.TestCase):
+    def testIndex(self):
+        files = [buffers.BufferReader(read_data('test_3d', n)) for n in ['1.dcm', '2.dcm']]
+        files.append(buffers.BufferReader(read_data('test_2d', '1.dcm')))
+        instances = to_instance_list(files)
+        self.assertIsInstance(instances, InstanceList)
+        self.assertEqual(len(instances), 3)
+
+        series_uids = instances.series_uids()
+        self.assertEqual(len(series_uids), 2)
+        self.assertEqual(instances.series(series_uids[0]), instances[:2])
+        self.assertIs(instances.by_sop_instance_uid(instances[2].sop_instance_uid), instances[2])
+        with self.assertRaises(KeyError):
+            instances.series('1.2.3')
+        self.assertFalse(any(i._pixels_decoded for i in instances))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from utils.metrics import Registry, StageTimer
+
+class TestRegistry(unittest.TestCase):
+    def testRender(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', ['route', 'status'])
+        in_flight = registry.gauge('in_flight', 'Requests in flight')
+        latency = registry.histogram('latency_seconds', 'Latency', ['route'], buckets=[0.1, 1])
+        registry.add_collector(lambda: [('cache_hits_total', 'counter', 'Hits', [({'route': '/'}, 3)])])
+
+        requests.labels(route='/', status=200).inc()
+        requests.labels(route='/', status=200).inc()
+        requests.labels(route='/"a"', status=503).inc()
+        in_flight.labels().inc(2)
+        in_flight.labels().dec()
+        latency.labels(route='/').observe(0.05)
+        latency.labels(route='/').observe(0.5)
+        latency.labels(route='/').observe(5)
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{route="/",status="200"} 2',
+            r'requests_total{route="/\"a\"",status="503"} 1',
+            '# HELP in_flight Requests in flight',
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/",le="0.1"} 1',
+            'latency_seconds_bucket{route="/",le="1"} 2',
+            'latency_seconds_bucket{route="/",le="+Inf"} 3',
+            'latency_seconds_sum{route="/"} 5.55',
+            'latency_seconds_count{route="/"} 3',
+            '# HELP cache_hits_total Hits',
+            '# TYPE cache_hits_total counter',
+            'cache_hits_total{route="/"} 3',
+        ])
+
+class TestStageTimer(unittest.TestCase):
+    def testStages(self):
+        timer = StageTimer()
+        with timer.stage('decode'):
+            pass
+        timer.add('decode', 1)
+        timer.add('model', 2)
+        self.assertGreaterEqual(timer.durations['decode'], 1)
+        self.assertEqual(timer.durations['model'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
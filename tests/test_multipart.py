@@ -0,0 +1,107 @@
+import hashlib
+import io
+import unittest
+
+from requests_toolbelt import MultipartEncoder, MultipartDecoder
+
+from utils import multipart
+
+def encode_fields(fields, boundary='test-boundary'):
+    encoder = MultipartEncoder(fields, boundary=boundary)
+    return encoder.to_string()
+
+class TestMultipartParser(unittest.TestCase):
+    fields = [
+        ('request_json', ('request', b'{"studyUID": "1.2.3"}', 'text/json')),
+        ('1', ('1.dcm', bytes(range(256)) * 300, 'application/dicom')),
+        ('2', ('2.dcm', b'\r\n--test-boundar' * 10, 'application/dicom')),
+        ('3', ('3.dcm', b'', 'application/dicom')),
+    ]
+
+    def parse(self, body, chunk_size, **kwargs):
+        parts = []
+        for part in multipart.iter_parts(io.BytesIO(body), 'test-boundary', chunk_size=chunk_size, **kwargs):
+            self.addCleanup(part.close)
+            parts.append(part)
+        return parts
+
+    def testMatchesMultipartDecoder(self):
+        body = encode_fields(self.fields)
+        expected = MultipartDecoder(body, 'multipart/related; boundary=test-boundary').parts
+
+        for chunk_size in (1, 7, 1024, len(body)):
+            parts = self.parse(body, chunk_size)
+            self.assertEqual(len(parts), len(expected))
+            for part, expected_part in zip(parts, expected):
+                self.assertEqual(bytes(part.buffer), expected_part.content)
+                self.assertEqual(part.size, len(expected_part.content))
+                self.assertEqual(part.content_type.encode(), expected_part.headers[b'Content-Type'])
+
+    def testPartDigests(self):
+        body = encode_fields(self.fields)
+        expected = MultipartDecoder(body, 'multipart/related; boundary=test-boundary').parts
+
+        parts = self.parse(body, 100, hash_algorithm='sha256', spill_threshold=1024)
+        self.assertTrue(parts[1].spilled)
+        self.assertEqual(
+            [part.digest for part in parts],
+            [hashlib.sha256(part.content).hexdigest() for part in expected]
+        )
+        self.assertIsNone(self.parse(body, 100)[0].digest)
+
+    def testUnsupportedHashAlgorithm(self):
+        with self.assertRaises(ValueError):
+            multipart.MultipartParser(b'test-boundary', hash_algorithm='unknown')
+
+    def testSpillToDisk(self):
+        body = encode_fields(self.fields)
+        parts = self.parse(body, 4096, spill_threshold=1024)
+        self.assertFalse(parts[0].spilled)
+        self.assertTrue(parts[1].spilled)
+        self.assertTrue(parts[1].buffer.readonly)
+        self.assertEqual(parts[1].open().read(), bytes(range(256)) * 300)
+
+    def testText(self):
+        parts = self.parse(encode_fields(self.fields), 64)
+        self.assertEqual(parts[0].text, '{"studyUID": "1.2.3"}')
+
+    def testTruncatedBody(self):
+        body = encode_fields(self.fields)
+        with self.assertRaises(multipart.MultipartError):
+            self.parse(body[:-20], 64)
+
+    def testMissingBoundary(self):
+        with self.assertRaises(multipart.MultipartError):
+            multipart.MultipartParser(b'')
+
+class TestMultipartEncode(unittest.TestCase):
+    def testMatchesMultipartEncoder(self):
+        content = bytes(range(256)) * 300
+        expected = encode_fields([
+            ('json-body', ('json-body', '{"parts": []}', 'application/json')),
+            ('elem_0', ('elem_0', content, 'application/binary')),
+            ('elem_1', ('elem_1', content, 'application/dicom')),
+            ('hashes', ('hashes', 'a:b', 'text/plain')),
+        ])
+        fields = [
+            ('json-body', '{"parts": []}', 'application/json'),
+            ('elem_0', bytearray(content), 'application/binary'),
+            ('elem_1', io.BytesIO(content), 'application/dicom'),
+            ('hashes', 'a:b', 'text/plain'),
+        ]
+        chunks = list(multipart.iter_encode(fields, 'test-boundary', chunk_size=1000))
+        self.assertEqual(b''.join(chunks), expected)
+        self.assertLessEqual(max(len(c) for c in chunks), 1000)
+
+    def testPartHeadersAndIterators(self):
+        fields = [
+            ('elem_0', iter([b'abc', b'def']), 'application/binary', {'Content-Encoding': 'gzip'}),
+        ]
+        body = b''.join(multipart.iter_encode(fields, 'test-boundary'))
+        part, = MultipartDecoder(body, 'multipart/related; boundary=test-boundary').parts
+        self.assertEqual(part.content, b'abcdef')
+        self.assertEqual(part.headers[b'Content-Encoding'], b'gzip')
+        self.assertEqual(part.headers[b'Content-Type'], b'application/binary')
+
+if __name__ == "__main__":
+    unittest.main()
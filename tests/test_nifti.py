@@ -0,0 +1,103 @@
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+from utils import nifti
+
+
+def write_nifti(path, array, datatype, byte_order='<', scl_slope=1.0, scl_inter=0.0):
+    """Write a NIfTI-1 file of an array in numpy order."""
+    header = bytearray(352)
+    struct.pack_into(byte_order + 'i', header, 0, 348)
+    dim = [array.ndim] + list(reversed(array.shape)) + [1] * (7 - array.ndim)
+    struct.pack_into(byte_order + '8h', header, 40, *dim)
+    struct.pack_into(byte_order + 'hh', header, 70, datatype, array.dtype.itemsize * 8)
+    struct.pack_into(byte_order + 'fff', header, 108, 352, scl_slope, scl_inter)
+    header[344:348] = b'n+1\0'
+    data = bytes(header) + array.astype(array.dtype.newbyteorder(byte_order)).tobytes()
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(data)
+
+
+class TestNifti(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        rng = numpy.random.RandomState(0)
+        self.labels = rng.choice([0, 0, 0, 1, 3], size=(2, 5, 6, 7)).astype(numpy.uint8)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def testReadHeader(self):
+        write_nifti(self.path('a.nii.gz'), self.labels.astype(numpy.int16), 4, '>')
+        header = nifti.read_header(self.path('a.nii.gz'))
+        self.assertEqual(header.shape, (2, 5, 6, 7))
+        self.assertEqual(header.dtype, numpy.dtype('>i2'))
+        self.assertEqual(header.vox_offset, 352)
+        self.assertEqual(header.slice_count, 10)
+        self.assertTrue(header.compressed)
+
+    def testNumericLabelMaskMemoryMapped(self):
+        write_nifti(self.path('a.nii'), self.labels, 2)
+        mask, label_map = nifti.numeric_label_mask(self.path('a.nii'), {3: 'Tumor'}, chunk_bytes=100)
+        self.assertIsInstance(mask, numpy.memmap)
+        numpy.testing.assert_array_equal(mask, self.labels)
+        self.assertEqual(label_map, {'1': '1', '3': 'Tumor'})
+
+    def testNumericLabelMaskCompressed(self):
+        for dtype, datatype in [(numpy.int16, 4), (numpy.float32, 16)]:
+            path = self.path('{}.nii.gz'.format(datatype))
+            write_nifti(path, self.labels.astype(dtype), datatype)
+            # Slabs of 3 slices, the last one is shorter
+            mask, label_map = nifti.numeric_label_mask(path, chunk_bytes=3 * 6 * 7 * numpy.dtype(dtype).itemsize)
+            self.assertEqual(mask.dtype, numpy.uint8)
+            numpy.testing.assert_array_equal(mask, self.labels)
+            self.assertEqual(label_map, {'1': '1', '3': '3'})
+
+    def testOneHotMasks(self):
+        for name in ['a.nii', 'a.nii.gz']:
+            write_nifti(self.path(name), self.labels, 2)
+            masks = nifti.one_hot_masks(self.path(name), [1, 2, 3], chunk_bytes=100)
+            expected = numpy.array([(self.labels == label) * 255 for label in [1, 2, 3]], dtype=numpy.uint8)
+            numpy.testing.assert_array_equal(masks, expected)
+
+    def testInvalidLabels(self):
+        write_nifti(self.path('a.nii'), numpy.array([[0, 300]], dtype=numpy.int16), 4)
+        with self.assertRaises(ValueError):
+            nifti.numeric_label_mask(self.path('a.nii'))
+        write_nifti(self.path('b.nii'), numpy.array([[0, 0.5]], dtype=numpy.float32), 16)
+        with self.assertRaises(ValueError):
+            nifti.numeric_label_mask(self.path('b.nii'))
+        write_nifti(self.path('c.nii'), self.labels, 2, scl_slope=2.0)
+        with self.assertRaises(ValueError):
+            nifti.read_header(self.path('c.nii'))
+        write_nifti(self.path('d.nii'), self.labels, 2, scl_inter=1.0)
+        with self.assertRaises(ValueError):
+            nifti.read_header(self.path('d.nii'))
+
+    def testUnscaled(self):
+        # A slope of 0 or not finite means no scaling, whatever the intercept
+        for scl_slope, scl_inter in [(float('nan'), float('nan')), (0.0, 5.0), (float('inf'), 0.0), (1.0, float('nan'))]:
+            write_nifti(self.path('a.nii'), self.labels, 2, scl_slope=scl_slope, scl_inter=scl_inter)
+            mask, _ = nifti.numeric_label_mask(self.path('a.nii'))
+            numpy.testing.assert_array_equal(mask, self.labels)
+
+    def testTruncated(self):
+        write_nifti(self.path('a.nii.gz'), self.labels, 2)
+        with gzip.open(self.path('a.nii.gz')) as f:
+            data = f.read()
+        with gzip.open(self.path('b.nii.gz'), 'wb') as f:
+            f.write(data[:-10])
+        with self.assertRaises(ValueError):
+            nifti.numeric_label_mask(self.path('b.nii.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
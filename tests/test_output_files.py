@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import numpy
+
+from utils import output_files
+from utils.result_cache import CachedResult
+
+
+class TestOutputFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def testWritePart(self):
+        path = os.path.join(self.directory, 'mask.bin')
+        mask = numpy.arange(1000, dtype=numpy.uint16).reshape(10, 100)
+        output_files.write_part(path, mask)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), mask.tobytes())
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        self.assertEqual(os.listdir(self.directory), ['mask.bin'])
+
+    def testWritePartFailure(self):
+        with self.assertRaises(TypeError):
+            output_files.write_part(os.path.join(self.directory, 'mask.bin'), object())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testWriteResult(self):
+        mask = bytes(range(256)) * 4
+        dicom = b'\x01' * 100
+        result = CachedResult('{"parts": []}', [('application/binary', mask), ('application/dicom', dicom)], 'abc')
+        written = output_files.write_result(result, self.directory)
+
+        self.assertEqual((written.json_text, written.output_digest), (result.json_text, 'abc'))
+        references = []
+        for content_type, part in written.parts:
+            self.assertEqual(content_type, output_files.PATH_REFERENCE_CONTENT_TYPE)
+            references.append(json.loads(part))
+        self.assertEqual(
+            [r['path'] for r in references],
+            [os.path.join(self.directory, 'abc', 'elem_0.bin'), os.path.join(self.directory, 'abc', 'elem_1.dcm')]
+        )
+        for reference, content in zip(references, [mask, dicom]):
+            with open(reference['path'], 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertEqual(reference['size'], len(content))
+            self.assertEqual(reference['digest'], hashlib.sha256(content).hexdigest())
+            self.assertEqual(reference['algorithm'], 'sha256')
+
+    def testExistingFilesAreKept(self):
+        result = CachedResult('{}', [('application/binary', b'mask')], 'abc', ['digest'])
+        output_files.write_result(result, self.directory)
+        path = os.path.join(self.directory, 'abc', 'elem_0.bin')
+        os.utime(path, (0, 0))
+        reference = json.loads(output_files.write_result(result, self.directory).parts[0][1])
+        self.assertEqual(os.stat(path).st_mtime, 0)
+        self.assertEqual(reference['digest'], 'digest')
+
+
+if __name__ == '__main__':
+    unittest.main()
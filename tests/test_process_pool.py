@@ -0,0 +1,124 @@
+import errno
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from utils import bit_masks
+from utils import buffers
+from utils.sparse_masks import SparseMask
+from utils.process_pool import ProcessPool, WorkerCrashedError, _read_shared, _write_shared
+
+warmed_up = False
+
+def warmup():
+    global warmed_up
+    warmed_up = True
+
+def echo_handler(json_input, dicom_instances, input_digest):
+    response_json = {
+        'pid': os.getpid(), 'warmed_up': warmed_up, 'digest': input_digest,
+        'part_digests': [d.digest for d in dicom_instances]
+    }
+    arrays = [numpy.frombuffer(d.getbuffer(), dtype=numpy.uint8).reshape(-1, 2) * 2 for d in dicom_instances]
+    return response_json, arrays + [b'raw', numpy.zeros(0, dtype=numpy.float32)]
+
+def crashing_handler(json_input, dicom_instances, input_digest):
+    if json_input.get('crash'):
+        os._exit(1)
+    return {}, []
+
+class TestSharedMemory(unittest.TestCase):
+    def testRoundTrip(self):
+        components = [
+            numpy.arange(12, dtype=numpy.int16).reshape(3, 4),
+            b'abc',
+            numpy.zeros(0, dtype=numpy.uint8),
+            numpy.ones((2, 2, 2), dtype=bool),
+        ]
+        path, layout = _write_shared(components, None)
+        self.assertTrue(os.path.exists(path))
+        read = _read_shared(path, layout)
+        self.assertFalse(os.path.exists(path))
+
+        numpy.testing.assert_array_equal(read[0], components[0])
+        self.assertEqual(read[0].dtype, numpy.int16)
+        self.assertFalse(read[0].flags['WRITEABLE'])
+        self.assertEqual(bytes(read[1]), b'abc')
+        self.assertEqual(read[2].shape, (0,))
+        numpy.testing.assert_array_equal(read[3], components[3])
+
+    def testChunkedBuffers(self):
+        sparse = SparseMask((2, 3, 4))
+        sparse.fill_box(1, 0, 1, 2, 3, 7)
+        packed = bit_masks.pack(sparse)
+        path, layout = _write_shared([sparse, packed], None)
+        # Their content is in the file, not pickled with the layout
+        self.assertEqual([entry[0] for entry in layout], ['array', 'packed'])
+        self.assertLess(len(pickle.dumps(layout)), 200)
+        read = _read_shared(path, layout)
+
+        numpy.testing.assert_array_equal(read[0], sparse.toarray())
+        self.assertIsInstance(read[1], bit_masks.PackedMask)
+        numpy.testing.assert_array_equal(read[1].toarray(), sparse.toarray() != 0)
+
+    def testFullShmDir(self):
+        shm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shm_dir)
+        allocate = os.posix_fallocate
+        calls = []
+
+        def full_shm(fd, offset, size):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            allocate(fd, offset, size)
+
+        with mock.patch('os.posix_fallocate', full_shm), self.assertLogs('process_pool', 'WARNING'):
+            path, layout = _write_shared([b'abc'], shm_dir)
+        self.assertEqual(len(calls), 2)
+        self.assertNotEqual(os.path.dirname(path), shm_dir)
+        self.assertEqual(os.listdir(shm_dir), [])
+        self.assertEqual(bytes(_read_shared(path, layout)[0]), b'abc')
+
+    def testEmpty(self):
+        path, layout = _write_shared([b''], None)
+        self.assertIsNone(path)
+        self.assertEqual(bytes(_read_shared(path, layout)[0]), b'')
+
+class TestProcessPool(unittest.TestCase):
+    def testCallInWorker(self):
+        pool = ProcessPool(echo_handler, processes=2, warmup_fn=warmup)
+        self.addCleanup(pool.shutdown)
+        dicoms = [buffers.BufferReader(bytes(range(4)), 'a'), buffers.BufferReader(b'\x05' * 6)]
+        response_json, components = pool({}, dicoms, 'digest')
+
+        self.assertNotEqual(response_json['pid'], os.getpid())
+        self.assertTrue(response_json['warmed_up'])
+        self.assertEqual(response_json['digest'], 'digest')
+        self.assertEqual(response_json['part_digests'], ['a', None])
+        numpy.testing.assert_array_equal(components[0], [[0, 2], [4, 6]])
+        numpy.testing.assert_array_equal(components[1], numpy.full((3, 2), 10))
+        self.assertEqual(bytes(components[2]), b'raw')
+        self.assertEqual(components[3].dtype, numpy.float32)
+
+    def testRestartAfterCrash(self):
+        pool = ProcessPool(crashing_handler, processes=1)
+        self.addCleanup(pool.shutdown)
+        with self.assertLogs('process_pool', 'ERROR'):
+            with self.assertRaises(WorkerCrashedError):
+                pool({'crash': True}, [], 'digest')
+        self.assertEqual(pool.restarts, 1)
+        self.assertEqual(pool({}, [], 'digest'), ({}, []))
+
+    def testInvalidSize(self):
+        with self.assertRaises(ValueError):
+            ProcessPool(echo_handler, processes=0)
+
+if __name__ == '__main__':
+    unittest.main()
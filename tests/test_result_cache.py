@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+from utils.result_cache import CachedResult, ResultCache
+
+def make_result(size, digest='out'):
+    return CachedResult('{"parts": []}', [('application/binary', b'\x01' * size)], digest)
+
+class TestResultCache(unittest.TestCase):
+    def testPendingDigests(self):
+        calls = []
+
+        def digests():
+            calls.append(1)
+            return 'out', ['part']
+
+        result = CachedResult('{}', [], digests=digests)
+        self.assertEqual(calls, [])
+        self.assertEqual((result.output_digest, result.part_digests), ('out', ['part']))
+        self.assertEqual(result.output_digest, 'out')
+        self.assertEqual(calls, [1])
+
+    def testMissThenHit(self):
+        cache = ResultCache()
+        self.assertIsNone(cache.get('/:abc'))
+        result = make_result(10)
+        cache.put('/:abc', result)
+        self.assertIs(cache.get('/:abc'), result)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def testLeastRecentlyUsedEviction(self):
+        entry_size = make_result(100).nbytes
+        cache = ResultCache(max_bytes=entry_size * 2)
+        cache.put('a', make_result(100))
+        cache.put('b', make_result(100))
+        cache.get('a')
+        cache.put('c', make_result(100))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], entry_size * 2)
+
+    def testLargeResultIsNotKeptInMemory(self):
+        cache = ResultCache(max_bytes=10)
+        cache.put('a', make_result(100))
+        self.assertIsNone(cache.get('a'))
+
+    def testDiskTierSurvivesRestart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory=directory)
+            cache.put('/:abc', CachedResult('{"a": 1}', [('application/binary', memoryview(b'xyz')),
+                                                         ('application/dicom', b'')],
+                                           'digest', ['d1', 'd2']))
+
+            restarted = ResultCache(directory=directory)
+            result = restarted.get('/:abc')
+            self.assertEqual(result.json_text, '{"a": 1}')
+            self.assertEqual(result.parts, [('application/binary', b'xyz'), ('application/dicom', b'')])
+            # Mapped from the file rather than read into memory
+            self.assertIsInstance(result.parts[0][1], memoryview)
+            self.assertEqual(result.output_digest, 'digest')
+            self.assertEqual(result.part_digests, ['d1', 'd2'])
+            self.assertEqual(restarted.stats()['disk_hits'], 1)
+
+    def testTruncatedFileIsIgnored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ResultCache(directory=directory).put('a', make_result(100))
+            restarted = ResultCache(directory=directory)
+            with open(restarted._path('a'), 'r+b') as f:
+                f.truncate(os.path.getsize(restarted._path('a')) - 10)
+            with self.assertLogs('result_cache', 'WARNING'):
+                self.assertIsNone(restarted.get('a'))
+
+    def testDiskBudget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(max_bytes=0, directory=directory, max_disk_bytes=500)
+            cache.put('a', make_result(200))
+            cache.put('b', make_result(200))
+            self.assertEqual(cache.stats()['disk_evictions'], 1)
+            self.assertIsNotNone(cache.get('b'))
+
+if __name__ == "__main__":
+    unittest.main()
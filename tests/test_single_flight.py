@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+from utils.single_flight import SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def blocking_fn(self, result=None, error=None):
+        def fn():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return fn
+
+    def run_follower(self, key, outcomes):
+        def follower():
+            try:
+                outcomes.append(self.single_flight.do(key, self.blocking_fn('follower')))
+            except Exception as e:
+                outcomes.append(e)
+        thread = threading.Thread(target=follower)
+        thread.start()
+        return thread
+
+    def wait_for_followers(self, count):
+        for _ in range(500):
+            if self.single_flight.coalesced >= count:
+                return
+            threading.Event().wait(0.01)
+
+    def testFollowersShareResult(self):
+        outcomes = []
+        leader = self.run_follower('a', outcomes)
+        self.started.wait(5)
+        followers = [self.run_follower('a', outcomes) for _ in range(3)]
+        self.wait_for_followers(3)
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(shared for _, shared in outcomes), [False, True, True, True])
+        self.assertEqual({result for result, _ in outcomes}, {'follower'})
+        self.assertEqual(self.single_flight.coalesced, 3)
+        self.assertEqual(self.single_flight.in_flight(), 0)
+
+    def testErrorPropagatesToFollowers(self):
+        outcomes = []
+        error = RuntimeError('model failed')
+
+        def leader():
+            try:
+                self.single_flight.do('a', self.blocking_fn(error=error))
+            except Exception as e:
+                outcomes.append(e)
+
+        leader_thread = threading.Thread(target=leader)
+        leader_thread.start()
+        self.started.wait(5)
+        follower = self.run_follower('a', outcomes)
+        self.wait_for_followers(1)
+        self.release.set()
+        leader_thread.join(5)
+        follower.join(5)
+
+        self.assertEqual(outcomes, [error, error])
+
+    def testDifferentKeysDoNotCoalesce(self):
+        self.release.set()
+        self.assertEqual(self.single_flight.do('a', self.blocking_fn(1)), (1, False))
+        self.assertEqual(self.single_flight.do('b', self.blocking_fn(2)), (2, False))
+        self.assertEqual(self.single_flight.do('a', self.blocking_fn(3)), (3, False))
+        self.assertEqual(self.calls, 3)
+
+if __name__ == "__main__":
+    unittest.main()
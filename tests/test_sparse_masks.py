@@ -0,0 +1,74 @@
+import pickle
+import unittest
+
+import numpy
+
+from utils import buffers
+from utils import digest
+from utils.sparse_masks import SparseMask
+
+
+class TestSparseMask(unittest.TestCase):
+    def testCropsAndBoxes(self):
+        mask = SparseMask((2, 3, 8, 10))
+        mask.add_crop((0, 1), 2, 3, numpy.arange(6, dtype=numpy.uint8).reshape(2, 3))
+        mask.fill_box((1, 2), 0, 8, 8, 10, 7)
+        # Later crops overwrite earlier ones
+        mask.fill_box((0, 1), 3, 4, 4, 6, 9)
+
+        expected = numpy.zeros((2, 3, 8, 10), dtype=numpy.uint8)
+        expected[0, 1, 2:4, 3:6] = numpy.arange(6).reshape(2, 3)
+        expected[1, 2, :, 8:] = 7
+        expected[0, 1, 3, 4:6] = 9
+        numpy.testing.assert_array_equal(mask.toarray(), expected)
+        numpy.testing.assert_array_equal(mask.get_slice((1, 2)), expected[1, 2])
+        self.assertEqual(mask.nbytes, expected.nbytes)
+        # Boxes store a single value
+        self.assertEqual(mask.stored_nbytes, 6 + 1 + 1)
+
+    def testRuns(self):
+        mask = SparseMask((4, 5, 6), numpy.uint16)
+        mask.add_runs(2, [0, 10, 29], [3, 4, 1], 300)
+
+        expected = numpy.zeros((4, 5, 6), dtype=numpy.uint16)
+        flat = expected[2].reshape(-1)
+        flat[0:3] = flat[10:14] = flat[29] = 300
+        numpy.testing.assert_array_equal(mask.toarray(), expected)
+
+    def testFromDense(self):
+        dense = numpy.zeros((5, 64, 64), dtype=numpy.uint8)
+        dense[1, 10:20, 30:35] = 255
+        dense[3, 0, 63] = 1
+        mask = SparseMask.from_dense(dense)
+        numpy.testing.assert_array_equal(mask.toarray(), dense)
+        self.assertEqual(mask.stored_nbytes, 10 * 5 + 1)
+
+    def testChunksMatchDenseBytes(self):
+        dense = numpy.zeros((3, 16, 16), dtype=numpy.uint8)
+        dense[2, 4:8, 4:8] = 255
+        mask = SparseMask.from_dense(dense)
+        self.assertIsInstance(mask, buffers.ChunkedBuffer)
+        self.assertEqual(b''.join(bytes(c) for c in buffers.iter_chunks(mask, 100)), dense.tobytes())
+        self.assertLessEqual(max(len(c) for c in buffers.iter_chunks(mask, 100)), 100)
+        self.assertEqual(digest.hash_part(mask), digest.hash_part(dense))
+        self.assertEqual(buffers.nbytes(mask), dense.nbytes)
+
+    def testPickle(self):
+        mask = SparseMask((2, 4, 4))
+        mask.fill_box(1, 0, 0, 2, 2)
+        numpy.testing.assert_array_equal(pickle.loads(pickle.dumps(mask)).toarray(), mask.toarray())
+
+    def testInvalidCrops(self):
+        mask = SparseMask((2, 4, 4))
+        with self.assertRaises(ValueError):
+            mask.add_crop(0, 3, 0, numpy.ones((2, 2)))
+        with self.assertRaises(ValueError):
+            mask.add_runs(0, [15], [2])
+        with self.assertRaises(IndexError):
+            mask.fill_box((0, 1), 0, 0, 1, 1)
+        with self.assertRaises(ValueError):
+            SparseMask((4,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils import study_files
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'test_3d')
+
+
+class StudyFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.study = os.path.join(self.root, 'study')
+        os.makedirs(os.path.join(self.study, 'series'))
+        os.makedirs(os.path.join(self.study, '.cache'))
+        shutil.copy(os.path.join(DATA_DIR, '1.dcm'), os.path.join(self.study, 'b.dcm'))
+        shutil.copy(os.path.join(DATA_DIR, '2.dcm'), os.path.join(self.study, 'series', 'a.dcm'))
+        shutil.copy(os.path.join(DATA_DIR, '3.dcm'), os.path.join(self.study, '.cache', 'c.dcm'))
+        with open(os.path.join(self.study, 'notes.txt'), 'w') as f:
+            f.write('not a DICOM file')
+
+
+class TestResolve(StudyFilesTestCase):
+    def testUnderRoot(self):
+        self.assertEqual(study_files.resolve(self.study, [self.root]), os.path.realpath(self.study))
+        self.assertEqual(
+            study_files.resolve(os.path.join(self.root, 'other', '..', 'study'), [self.root]),
+            os.path.realpath(self.study)
+        )
+
+    def testOutsideRoot(self):
+        with self.assertRaises(ValueError):
+            study_files.resolve(os.path.join(self.study, '..', '..'), [self.root])
+        with self.assertRaises(ValueError):
+            study_files.resolve(self.root + '-other', [self.root])
+        with self.assertRaises(ValueError):
+            study_files.resolve(os.path.join(self.study, 'notes.txt'), [self.root])
+
+
+class TestStudyLoader(StudyFilesTestCase):
+    def testLoad(self):
+        loader = study_files.StudyLoader(max_workers=2)
+        self.addCleanup(loader.shutdown)
+        parts = loader.load(self.study)
+        for part in parts:
+            self.addCleanup(part.close)
+
+        # Sorted by path, hidden and non-DICOM files skipped
+        self.assertEqual(
+            [os.path.relpath(p.path, self.study) for p in parts],
+            ['b.dcm', os.path.join('series', 'a.dcm')]
+        )
+        with open(os.path.join(DATA_DIR, '2.dcm'), 'rb') as f:
+            content = f.read()
+        self.assertEqual(bytes(parts[1].buffer), content)
+        self.assertEqual(parts[1].size, len(content))
+        self.assertEqual(parts[1].content_type, 'application/dicom')
+        self.assertEqual(parts[1].open().read(), content)
+
+    def testClose(self):
+        part = study_files.open_file(os.path.join(self.study, 'b.dcm'))
+        part.close()
+        self.assertIsNone(part.buffer)
+        self.assertIsNone(study_files.open_file(os.path.join(self.study, 'notes.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
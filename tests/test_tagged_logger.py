@@ -1,6 +1,7 @@
 import unittest
 import logging
 
+from utils import tracing
 from utils.tagged_logger import TaggedLogger
 
 class TestLogHandler(logging.Handler):
@@ -99,5 +100,17 @@ class TestTaggedLogger(unittest.TestCase):
         self.assertLevel("DEBUG")
         self.assertMessage('{"a": 1, "b": 2, "c": 3, "i": "i", "j": "j", "k": "k", "x": "x", "y": "y", "z": "z"} - abcijkxyz tagged message')
 
+    def testSpan(self):
+        self.tagged_logger.add_tags({ 'input_hash': 'abc' })
+        trace = tracing.Trace()
+        with trace.activate():
+            with self.tagged_logger.span("preprocessing") as span:
+                pass
+        self.assertEqual(trace.spans, [span])
+        self.assertEqual(span.name, "preprocessing")
+        self.assertEqual(span.attributes, { 'input_hash': 'abc' })
+        self.assertLevel("DEBUG")
+        self.assertTrue(self.handler.record.msg.startswith('{"input_hash": "abc"} - preprocessing took '))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from utils import tracing
+
+class TestTrace(unittest.TestCase):
+    def testNestedSpans(self):
+        trace = tracing.Trace()
+        with trace.span('model') as model:
+            with tracing.span('forward', layer=3) as forward:
+                pass
+        with trace.span('model'):
+            pass
+
+        self.assertIsNone(model.parent)
+        self.assertIs(forward.parent, model)
+        self.assertEqual(forward.attributes, {'layer': 3})
+        self.assertIsNone(tracing.current_trace())
+
+        timing = trace.server_timing().split(', ')
+        self.assertEqual([t.split(';')[0] for t in timing], ['model', 'total'])
+
+    def testSpanOutsideOfTrace(self):
+        with tracing.span('orphan') as span:
+            self.assertIsNone(span)
+
+    def testThreadsDoNotShareCurrentSpan(self):
+        trace = tracing.Trace()
+        spans = []
+        with trace.span('request'):
+            with trace.activate():
+                thread = threading.Thread(target=lambda: spans.append(tracing.current_trace()))
+                thread.start()
+                thread.join()
+        self.assertEqual(spans, [None])
+
+    def testChromeTrace(self):
+        trace = tracing.Trace()
+        trace.tags['input_hash'] = 'abc'
+        with trace.span('decode', size=10):
+            pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = trace.write(directory, 'abc')
+            self.assertEqual(os.listdir(directory), ['abc.json'])
+            with open(path) as f:
+                chrome_trace = json.load(f)
+
+        self.assertEqual(chrome_trace['otherData'], {'input_hash': 'abc'})
+        event, = chrome_trace['traceEvents']
+        self.assertEqual(event['name'], 'decode')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args'], {'size': 10})
+        self.assertGreaterEqual(event['dur'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import io
+import os
+import unittest
+
+import numpy
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from utils import buffers
+from utils.volumes import assemble_volume, assemble_volumes
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'test_3d')
+
+def make_dicom(series_uid, position, instance_number, value, rows=3, columns=4):
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    dataset.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dataset.SOPClassUID = dataset.file_meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = dataset.file_meta.MediaStorageSOPInstanceUID
+    dataset.SeriesInstanceUID = series_uid
+    dataset.InstanceNumber = instance_number
+    dataset.ImagePositionPatient = list(position)
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [0.5, 0.25]
+    dataset.Rows, dataset.Columns = rows, columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit = 16, 16, 15
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = numpy.full((rows, columns), value, dtype=numpy.uint16).tobytes()
+    f = io.BytesIO()
+    pydicom.dcmwrite(f, dataset, write_like_original=False)
+    return buffers.BufferReader(f.getvalue())
+
+class TestVolumes(unittest.TestCase):
+    def testSortBySlicePosition(self):
+        files = []
+        for name in ['3.dcm', '1.dcm', '2.dcm']:
+            with open(os.path.join(DATA_DIR, name), 'rb') as f:
+                files.append(buffers.BufferReader(f.read()))
+        volume, = assemble_volumes(files)
+
+        z = [float(i.header.ImagePositionPatient[2]) for i in volume.instances]
+        self.assertEqual(z, sorted(z))
+        self.assertEqual(volume.shape, (1, 3, 512, 512))
+        self.assertEqual(volume.pixels.shape, (1, 3, 512, 512))
+        numpy.testing.assert_array_equal(volume.pixels[0, 0], volume.instances[0].pixel_array)
+        self.assertEqual(volume.spacing[1:], (0.625, 0.625))
+        self.assertAlmostEqual(volume.origin[2], min(z))
+
+    def testTimepoints(self):
+        files = []
+        # Two timepoints of three slices, sent out of order
+        for z, t in [(2, 1), (0, 0), (1, 1), (2, 0), (0, 1), (1, 0)]:
+            files.append(make_dicom('1.2.3', (0, 0, z * 2.5), t * 10 + z, t * 10 + z))
+        files.append(make_dicom('4.5.6', (0, 0, 0), 1, 99))
+
+        volume, other = assemble_volumes(files)
+        self.assertEqual(volume.shape, (2, 3, 3, 4))
+        numpy.testing.assert_array_equal(volume.pixels[:, :, 0, 0], [[0, 1, 2], [10, 11, 12]])
+        self.assertEqual(volume.spacing, (2.5, 0.5, 0.25))
+        self.assertEqual(volume.binary_data_shape(), {'timepoints': 2, 'depth': 3, 'width': 4, 'height': 3})
+        self.assertEqual(volume.new_mask().shape, (2, 3, 3, 4))
+        self.assertEqual(volume.mask_part('seg')['SeriesInstanceUID'], '1.2.3')
+        self.assertEqual(other.shape, (1, 1, 3, 4))
+
+    def testHeadersOnly(self):
+        files = [make_dicom('1.2.3', (0, 0, z), z, z) for z in [1, 0]]
+        volume = assemble_volumes(files, pixels=False)[0]
+        self.assertIsNone(volume.pixels)
+        self.assertEqual([i.header.InstanceNumber for i in volume.instances], [0, 1])
+
+    def testInvalidTimepoints(self):
+        files = [make_dicom('1.2.3', (0, 0, z), i, 0) for i, z in enumerate([0, 0, 1])]
+        with self.assertRaises(ValueError):
+            assemble_volumes(files)
+
+    def testUnevenTimepoints(self):
+        # 2, 1 and 3 instances per position, a multiple of the 2 timepoints
+        # of the first position
+        positions = [0, 0, 1, 2, 2, 2]
+        files = [make_dicom('1.2.3', (0, 0, z), i, 0) for i, z in enumerate(positions)]
+        with self.assertRaises(ValueError):
+            assemble_volumes(files)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+Admission control of inference requests.
+
+Each route can limit how many requests it processes at the same time. Requests
+over the limit wait in a bounded queue, and are rejected right away once the
+queue is full, so a burst of requests is shed with fast 503 responses instead
+of overcommitting the memory of the container.
+
+Since request sizes vary widely, the gateway can also limit the estimated
+bytes used by all requests in flight with a memory budget.
+"""
+
+import collections
+import threading
+
+DEFAULT_RETRY_AFTER = 1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted.
+
+    :param int retry_after: seconds after which the client should retry.
+    :param int status: HTTP status code of the response.
+    """
+
+    def __init__(self, message, retry_after=DEFAULT_RETRY_AFTER, status=503):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class AdmissionController():
+    """Limit the number of requests processed concurrently.
+
+    :param int max_concurrent: number of requests processed at the same time.
+    :param int max_queue: number of requests that can wait for one of them to
+     finish, further requests are rejected.
+    :param float queue_timeout: optional maximum time in seconds a request
+     waits in the queue before it is rejected.
+    :param int retry_after: seconds clients are told to wait before retrying
+     a rejected request.
+    """
+
+    def __init__(self, max_concurrent, max_queue=0, queue_timeout=None,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._rejected = 0
+
+    def acquire(self):
+        """Wait until the request can be processed.
+
+        :raises AdmissionRejected: if the queue is full, or the request waited
+         for longer than queue_timeout.
+        """
+        with self._condition:
+            if self._active < self.max_concurrent and self._queued == 0:
+                self._active += 1
+                return
+            if self._queued >= self.max_queue:
+                self._rejected += 1
+                raise AdmissionRejected('too many requests in queue', self.retry_after)
+
+            self._queued += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self._active < self.max_concurrent, self.queue_timeout
+                )
+            finally:
+                self._queued -= 1
+            if not admitted:
+                self._rejected += 1
+                raise AdmissionRejected('timed out in queue', self.retry_after)
+            self._active += 1
+
+    def release(self):
+        """Mark a request admitted with ``acquire`` as finished."""
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    @property
+    def saturated(self):
+        """True if the next request would be rejected."""
+        with self._condition:
+            return self._active >= self.max_concurrent and self._queued >= self.max_queue
+
+    def stats(self):
+        """Return the current active and queued counts, the number of rejected
+        requests so far, and the limits, as a dictionary."""
+        with self._condition:
+            return {
+                'active': self._active,
+                'queued': self._queued,
+                'rejected': self._rejected,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+            }
+
+
+class MemoryGovernor():
+    """Limit the estimated number of bytes used by requests in flight.
+
+    Requests reserve their estimated size before their body is read, and
+    wait, in arrival order, until the reservation fits in the budget.
+
+    :param int max_bytes: budget shared by all requests.
+    :param float max_wait: optional maximum time in seconds a request waits
+     for its reservation to fit before it is rejected.
+    :param int retry_after: seconds clients are told to wait before retrying
+     a rejected request.
+    """
+
+    def __init__(self, max_bytes, max_wait=None, retry_after=DEFAULT_RETRY_AFTER):
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._waiting = collections.deque()
+        self._rejected = 0
+
+    def reserve(self, nbytes):
+        """Wait until nbytes fit in the budget and reserve them.
+
+        :return: a Reservation, to release once the request is finished.
+        :raises AdmissionRejected: with status 413 if nbytes is larger than
+         the whole budget, or 503 if it did not fit within max_wait.
+        """
+        with self._condition:
+            if nbytes > self.max_bytes:
+                self._rejected += 1
+                raise AdmissionRejected(
+                    'request of {} bytes exceeds the memory budget'.format(nbytes),
+                    self.retry_after, status=413
+                )
+
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self._waiting[0] is ticket and self._reserved + nbytes <= self.max_bytes,
+                    self.max_wait
+                )
+            finally:
+                self._waiting.remove(ticket)
+                # The next request in line may fit now
+                self._condition.notify_all()
+            if not admitted:
+                self._rejected += 1
+                raise AdmissionRejected('timed out waiting for memory', self.retry_after)
+            self._reserved += nbytes
+        return Reservation(self, nbytes)
+
+    @property
+    def saturated(self):
+        """True if requests are waiting for memory."""
+        with self._condition:
+            return len(self._waiting) > 0
+
+    def stats(self):
+        """Return the reserved bytes, the number of waiting and rejected
+        requests and the budget, as a dictionary."""
+        with self._condition:
+            return {
+                'reserved_bytes': self._reserved,
+                'waiting': len(self._waiting),
+                'rejected': self._rejected,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _grow(self, reservation, nbytes):
+        with self._condition:
+            if nbytes > self.max_bytes:
+                self._rejected += 1
+                raise AdmissionRejected(
+                    'request of {} bytes exceeds the memory budget'.format(nbytes),
+                    self.retry_after, status=413
+                )
+        if nbytes > reservation.nbytes:
+            self._resize(reservation, nbytes)
+
+    def _resize(self, reservation, nbytes):
+        with self._condition:
+            self._reserved += nbytes - reservation.nbytes
+            reservation.nbytes = nbytes
+            self._condition.notify_all()
+
+
+class Reservation():
+    """Bytes reserved by a request with ``MemoryGovernor.reserve``."""
+
+    def __init__(self, governor, nbytes):
+        self._governor = governor
+        self.nbytes = nbytes
+
+    def resize(self, nbytes):
+        """Update the reservation with a better estimate, without waiting.
+
+        The memory is already in use when the estimate is known, so growing a
+        reservation can take it over the budget. Later requests wait until it
+        is back within the budget.
+        """
+        self._governor._resize(self, nbytes)
+
+    def grow(self, nbytes):
+        """Grow the reservation to nbytes as a request uses more memory, e.g.
+        while its body is decompressed, without waiting.
+
+        :raises AdmissionRejected: with status 413 if nbytes is larger than
+         the whole budget, the reservation is unchanged then.
+        """
+        self._governor._grow(self, nbytes)
+
+    def release(self):
+        self.resize(0)
@@ -0,0 +1,131 @@
+"""
+Dynamic batching of concurrent inference requests.
+
+Requests submitted by the HTTP handler threads are collected until either the
+maximum batch size is reached or the oldest request has waited for the maximum
+wait time. The batch is then passed to the model in a single call, and each
+caller receives its own element of the result.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('batching')
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT = 0.05
+
+
+class BatchScheduler():
+    """Collect requests into batches for a batch-capable model function.
+
+    :param callable batch_fn: called with a list of (json_input,
+     dicom_instances, input_digest) tuples, must return a list with one
+     (response_json, binary_components) tuple for each of them, in order.
+    :param int max_batch_size: maximum number of requests in one call.
+    :param float max_wait: maximum time in seconds a request waits for other
+     requests to join its batch.
+    :param str name: name of the worker thread.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT, name='batch-scheduler'):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self._batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = None
+        self._batch_sizes = collections.Counter()
+
+    def __call__(self, json_input, dicom_instances, input_digest):
+        """Submit one request and wait for its result.
+
+        Has the signature of a regular model_fn, so the scheduler can be
+        registered with ``Gateway.add_inference_route``.
+
+        :raises RuntimeError: if the worker thread has stopped.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._ensure_worker()
+            self._queue.put(((json_input, dicom_instances, input_digest), future))
+        return future.result()
+
+    def batch_size_histogram(self):
+        """Return a dictionary mapping batch sizes to the number of batches."""
+        with self._lock:
+            return dict(self._batch_sizes)
+
+    def _ensure_worker(self):
+        # Called with the lock held
+        if self._stopped is not None or (self._thread is not None and not self._thread.is_alive()):
+            raise RuntimeError('batch scheduler worker stopped') from self._stopped
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                self._run_batch(self._collect())
+        except BaseException as e:
+            # Fail the requests nobody will collect anymore, later ones are
+            # refused by _ensure_worker
+            with self._lock:
+                self._stopped = e
+                pending = []
+                while not self._queue.empty():
+                    pending.append(self._queue.get_nowait())
+            for _, future in pending:
+                future.set_exception(RuntimeError('batch scheduler worker stopped'))
+            raise
+
+    def _run_batch(self, batch):
+        requests = [request for request, _ in batch]
+        futures = [future for _, future in batch]
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+
+        try:
+            results = list(self._batch_fn(requests))
+            if len(results) != len(requests):
+                raise ValueError(
+                    'batch model returned {} results for {} requests'
+                    .format(len(results), len(requests))
+                )
+        except Exception as e:
+            logger.exception('batch of %d requests failed' % len(requests))
+            for future in futures:
+                future.set_exception(e)
+            return
+        except BaseException as e:
+            # The worker stops, but its callers must not wait forever
+            logger.error('batch of %d requests interrupted' % len(requests))
+            for future in futures:
+                future.set_exception(e)
+            raise
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
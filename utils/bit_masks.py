@@ -0,0 +1,149 @@
+"""
+Bit-packed boolean masks.
+
+A ``boolean_mask`` part is sent as one uint8 per voxel, of which only one bit
+carries information. A part with ``"bit_packed": true`` is instead sent with
+8 voxels per byte, in the row-major order of the mask, the first voxel in the
+most significant bit of its byte as ``numpy.packbits`` does, and the last
+byte padded with zeros. Clients unpack it with ``unpack``, or
+``numpy.unpackbits(data, count=voxels)``.
+
+Handlers either set ``bit_packed`` on the part and return the mask as usual,
+dense or sparse, or return the PackedMask of ``pack``. The gateway packs the
+masks before it hashes them, so the digests are those of the sent bytes.
+"""
+
+import numpy
+
+from utils import buffers
+
+# Field of the JSON part of a mask sent bit-packed
+BIT_PACKED_FIELD = 'bit_packed'
+# Number of voxels packed at a time, a multiple of 8, to bound the
+# temporary arrays made from masks that are not of integer type
+PACK_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+class PackedMask(buffers.ChunkedBuffer):
+    """A mask packed 8 voxels per byte, see ``pack``.
+
+    :param tuple shape: shape of the mask.
+    :param numpy.ndarray packed: packed bytes of a dense mask, or None.
+    :param buffers.ChunkedBuffer source: chunked mask, e.g. a SparseMask,
+     packed one chunk at a time each time the content is read, or None.
+    """
+
+    def __init__(self, shape, packed=None, source=None):
+        if (packed is None) == (source is None):
+            raise ValueError('a PackedMask needs either packed bytes or a source')
+        self.shape = tuple(int(n) for n in shape)
+        self.count = int(numpy.prod(self.shape, dtype=numpy.int64))
+        self._packed = packed
+        self._source = source
+        if packed is not None and packed.nbytes != packed_size(self.count):
+            raise ValueError('{} packed bytes do not hold a mask of shape {}'.format(packed.nbytes, self.shape))
+
+    @property
+    def nbytes(self):
+        return packed_size(self.count)
+
+    def iter_chunks(self):
+        if self._packed is not None:
+            return iter([self._packed])
+        return _iter_packed(self._source.iter_chunks())
+
+    def toarray(self):
+        """Return the unpacked mask, as a bool array."""
+        return unpack(b''.join(bytes(chunk) for chunk in self.iter_chunks()), self.shape)
+
+
+def packed_size(count):
+    """Return the number of bytes of a packed mask of count voxels."""
+    return (count + 7) // 8
+
+
+def pack(mask):
+    """Pack a mask, every non-zero value being positive.
+
+    :param mask: numpy array of any shape and numeric dtype, a
+     buffers.ChunkedBuffer with a ``shape``, e.g. a SparseMask, or a
+     PackedMask, returned as is. A SparseMask is packed slice by slice when
+     it is sent, so the dense mask is never allocated.
+    :return: PackedMask
+    """
+    if isinstance(mask, PackedMask):
+        return mask
+    if isinstance(mask, buffers.ChunkedBuffer):
+        return PackedMask(getattr(mask, 'shape', (mask.nbytes,)), source=mask)
+    array = numpy.asarray(mask)
+    flat = array.reshape(-1)
+    packed = numpy.empty(packed_size(flat.size), dtype=numpy.uint8)
+    for start in range(0, flat.size, PACK_BLOCK_SIZE):
+        block = _to_packable(flat[start:start + PACK_BLOCK_SIZE])
+        packed[start // 8:start // 8 + packed_size(block.size)] = numpy.packbits(block)
+    return PackedMask(array.shape, packed=packed)
+
+
+def unpack(data, shape):
+    """Unpack a packed mask.
+
+    :param data: bytes-like object holding the packed mask.
+    :param shape: shape of the mask, e.g. (timepoints, depth, height, width).
+    :return: bool numpy array of the given shape.
+    :raises ValueError: if data is not the size of a packed mask of shape.
+    """
+    count = int(numpy.prod(shape, dtype=numpy.int64))
+    packed = numpy.frombuffer(data, dtype=numpy.uint8)
+    if packed.size != packed_size(count):
+        raise ValueError('{} packed bytes do not hold a mask of shape {}'.format(packed.size, tuple(shape)))
+    return numpy.unpackbits(packed, count=count).view(bool).reshape(shape)
+
+
+def _to_packable(values):
+    """Return the values as an integer or bool array numpy.packbits accepts,
+    where non-zero values are packed as 1."""
+    if values.dtype.kind in 'biu':
+        return values
+    return values != 0
+
+
+def _iter_packed(chunks):
+    """Pack chunks of any size, carrying the voxels past the last multiple
+    of 8 of a chunk over to the next one."""
+    carry = numpy.empty(0, dtype=numpy.uint8)
+    for chunk in chunks:
+        values = chunk if isinstance(chunk, numpy.ndarray) else numpy.frombuffer(chunk, dtype=numpy.uint8)
+        values = _to_packable(values.reshape(-1))
+        if carry.size:
+            values = numpy.concatenate([carry, values != 0])
+        end = values.size - values.size % 8
+        carry = (values[end:] != 0).astype(numpy.uint8)
+        if end:
+            yield numpy.packbits(values[:end])
+    if carry.size:
+        yield numpy.packbits(carry)
+
+
+def pack_parts(json_parts, components):
+    """Pack the masks of the parts of a response marked as bit-packed.
+
+    Parts whose mask is already a PackedMask are marked as bit-packed.
+
+    :param list json_parts: "parts" field of the JSON response, updated in
+     place.
+    :param list components: binary components of the response.
+    :return: list of the components, packed where needed.
+    :raises ValueError: if a part that is not a ``boolean_mask`` is packed.
+    """
+    packed = []
+    for json_part, component in zip(json_parts, components):
+        if isinstance(component, PackedMask):
+            json_part[BIT_PACKED_FIELD] = True
+        if json_part.get(BIT_PACKED_FIELD):
+            if json_part.get('binary_type') != 'boolean_mask':
+                raise ValueError('only boolean_mask parts can be bit-packed, got {}'.format(
+                    json_part.get('binary_type')
+                ))
+            component = pack(component)
+        packed.append(component)
+    return packed + list(components[len(packed):])
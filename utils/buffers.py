@@ -0,0 +1,166 @@
+"""
+Buffer protocol helpers used to pass request and response data around without
+copying it.
+"""
+
+import io
+import threading
+
+import numpy
+
+
+class CopyCounter():
+    """Thread-safe counter of the buffer copies made while handling a request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.copies = 0
+        self.bytes_copied = 0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.copies += 1
+            self.bytes_copied += nbytes
+
+
+class BufferReader(io.BufferedIOBase):
+    """Read-only file-like object over a memoryview.
+
+    Handlers can use it like a ``BytesIO`` (e.g. with ``pydicom.dcmread``), or
+    call ``getbuffer`` to access the underlying memory without copying it.
+
+    :param str digest: optional hex digest of the content, set for the parts
+     of requests.
+    """
+
+    def __init__(self, buffer, digest=None):
+        super().__init__()
+        self._buffer = memoryview(buffer).cast('B').toreadonly()
+        self._pos = 0
+        self.digest = digest
+
+    def getbuffer(self):
+        """Return a read-only memoryview of the whole content."""
+        return self._buffer
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._buffer) + offset
+        else:
+            raise ValueError('invalid whence {}'.format(whence))
+        if pos < 0:
+            raise ValueError('negative seek position {}'.format(pos))
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(self._pos + size, len(self._buffer))
+        data = self._buffer[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, b):
+        with memoryview(b).cast('B') as target:
+            data = self._buffer[self._pos:self._pos + len(target)]
+            target[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    readinto1 = readinto
+
+
+class ChunkedBuffer():
+    """Binary content produced chunk by chunk instead of held in memory.
+
+    Handlers can return a subclass, e.g. a ``SparseMask``, in place of an
+    array, and the gateway hashes and sends its content one chunk at a time.
+    Subclasses implement ``nbytes`` and ``iter_chunks``.
+    """
+
+    @property
+    def nbytes(self):
+        """Size of the content."""
+        raise NotImplementedError
+
+    def iter_chunks(self):
+        """Return an iterator over the content, as bytes-like objects that
+        are not modified once yielded."""
+        raise NotImplementedError
+
+
+def nbytes(obj):
+    """Return the size of a bytes-like object or ChunkedBuffer."""
+    if isinstance(obj, ChunkedBuffer):
+        return obj.nbytes
+    return byte_view(obj).nbytes
+
+
+def iter_chunks(obj, chunk_size):
+    """Iterate over the content of a bytes-like object or ChunkedBuffer, as
+    flat byte memoryviews of at most chunk_size bytes, without copying it."""
+    chunks = obj.iter_chunks() if isinstance(obj, ChunkedBuffer) else [obj]
+    for chunk in chunks:
+        view = byte_view(chunk)
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size]
+
+
+def as_buffer(obj, copy_counter=None):
+    """Return an object exposing the bytes of a binary response component.
+
+    numpy arrays are returned as-is when C-contiguous and copied otherwise,
+    bytes-like objects and ChunkedBuffer objects are returned unchanged, and
+    file-like objects are exposed through ``getbuffer`` when they have one,
+    or read otherwise. Every copy made is recorded in ``copy_counter``.
+
+    :param obj: a numpy array, a bytes-like object, a ChunkedBuffer or a
+     file-like object.
+    :param CopyCounter copy_counter: counter to record copies in.
+    """
+    if isinstance(obj, numpy.ndarray):
+        if obj.flags['C_CONTIGUOUS']:
+            return obj
+        obj = numpy.ascontiguousarray(obj)
+        data = obj
+    elif hasattr(obj, 'getbuffer'):
+        return obj.getbuffer()
+    elif hasattr(obj, 'read'):
+        data = obj.read()
+    else:
+        return obj
+
+    if copy_counter is not None:
+        copy_counter.add(data.nbytes if isinstance(data, numpy.ndarray) else len(data))
+    return data
+
+
+def byte_view(obj):
+    """Return a flat, unsigned byte memoryview of a buffer without copying it.
+
+    :param obj: a C-contiguous numpy array or any bytes-like object, see
+     ``as_buffer``.
+    """
+    if isinstance(obj, numpy.ndarray):
+        return memoryview(obj.reshape(-1).view(numpy.uint8))
+    view = memoryview(obj)
+    if view.format == 'B' and view.ndim == 1:
+        return view
+    return view.cast('B')
@@ -0,0 +1,233 @@
+"""
+Streaming compression of the parts of inference messages.
+
+Masks are mostly zeros and compress very well, so the gateway can send the
+binary parts of its responses with a per-part Content-Encoding negotiated
+from the Accept-Encoding header of the request, and accept request bodies
+sent with a Content-Encoding. gzip is always available, zstd when the
+``zstandard`` package is installed.
+"""
+
+import time
+import zlib
+
+from utils import buffers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings in order of preference when the client accepts several
+AVAILABLE_ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+DEFAULT_LEVELS = {'gzip': 1, 'zstd': 3}
+DEFAULT_MIN_SIZE = 64 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# zlib window bits of the gzip format
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_CODEC_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+
+
+class UnsupportedEncodingError(ValueError):
+    """Raised for a content encoding that is not available."""
+
+
+class DecompressionError(ValueError):
+    """Raised when a compressed stream is corrupted or truncated."""
+
+
+class CompressionStats():
+    """Sizes and CPU time of the compression of one part."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0
+
+    @property
+    def ratio(self):
+        """Compressed size over raw size."""
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+
+def negotiate(accept_encoding, encodings=AVAILABLE_ENCODINGS):
+    """Choose the encoding of a response from an Accept-Encoding header.
+
+    :param str accept_encoding: value of the header, e.g. 'gzip;q=0.8, zstd'.
+    :param encodings: encodings the server is willing to use, in order of
+     preference.
+    :return: the accepted encoding with the highest quality, preferring the
+     first of encodings on ties, or None if none is accepted.
+    """
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def iter_compress(data, encoding, chunk_size=DEFAULT_CHUNK_SIZE, level=None, stats=None):
+    """Compress a buffer, one chunk at a time.
+
+    :param data: bytes-like object or buffers.ChunkedBuffer.
+    :param str encoding: 'gzip' or 'zstd'.
+    :param int chunk_size: number of input bytes compressed at a time.
+    :param int level: compression level, defaults to a fast level.
+    :param CompressionStats stats: optional stats updated as the chunks are
+     produced.
+    :return: iterator over the compressed chunks.
+    """
+    compressor = _compressor(encoding, level)
+    if stats is None:
+        stats = CompressionStats(encoding)
+    for chunk in buffers.iter_chunks(data, chunk_size):
+        start = time.thread_time()
+        compressed = compressor.compress(chunk)
+        stats.cpu_seconds += time.thread_time() - start
+        stats.raw_bytes += len(chunk)
+        if compressed:
+            stats.compressed_bytes += len(compressed)
+            yield compressed
+    start = time.thread_time()
+    compressed = compressor.flush()
+    stats.cpu_seconds += time.thread_time() - start
+    stats.compressed_bytes += len(compressed)
+    yield compressed
+
+
+def decompressor(encoding):
+    """Return an object decompressing a stream chunk by chunk with its
+    ``decompress`` method.
+
+    :raises UnsupportedEncodingError: if the encoding is not available.
+    """
+    if encoding == 'gzip':
+        return zlib.decompressobj(_GZIP_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise UnsupportedEncodingError('unsupported content encoding {}'.format(encoding))
+
+
+class StreamDecompressor():
+    """Decompress a stream chunk by chunk, e.g. a request body.
+
+    The compressed stream is pulled from a read function as it is needed,
+    and decompressed at most max_length bytes at a time, so a small chunk of
+    a highly compressed body never expands into a huge buffer. A zstd stream
+    may hold several frames.
+
+    :param str encoding: 'gzip' or 'zstd'.
+    :param callable read: function returning the next compressed bytes of
+     the stream, or empty bytes at its end, e.g. the ``read`` method of a
+     file-like object.
+    :param int max_length: maximum size of the decompressed chunks.
+    :raises UnsupportedEncodingError: if the encoding is not available.
+    """
+
+    def __init__(self, encoding, read, max_length=DEFAULT_CHUNK_SIZE):
+        self.encoding = encoding
+        self.max_length = max_length
+        self.compressed_bytes = 0
+        self.raw_bytes = 0
+        self._read = read
+        self._ended = False
+        self._tail = b''
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        elif encoding == 'zstd' and zstandard is not None:
+            # The reader fills its output before it returns, and pulls the
+            # stream only when it needs more input
+            self._decompressor = zstandard.ZstdDecompressor().stream_reader(
+                _ReadFunction(self._read_compressed), read_across_frames=True
+            )
+        else:
+            raise UnsupportedEncodingError('unsupported content encoding {}'.format(encoding))
+
+    def read(self):
+        """Return the next decompressed chunk of the stream.
+
+        :return: bytes of at most max_length, empty at the end of the
+         compressed data.
+        :raises DecompressionError: if the stream is corrupted.
+        """
+        try:
+            if self.encoding == 'gzip':
+                chunk = self._inflate()
+            else:
+                chunk = self._decompressor.read(self.max_length)
+        except _CODEC_ERRORS as e:
+            raise DecompressionError('invalid {} stream: {}'.format(self.encoding, e)) from e
+        self.raw_bytes += len(chunk)
+        return chunk
+
+    def close(self):
+        """Read the rest of the stream, past the end of the compressed data,
+        and check that the compressed data was complete.
+
+        The zstd reader does not tell whether its last frame was complete, a
+        truncated zstd body is detected by the multipart parser instead, as
+        its closing boundary is missing.
+
+        :raises DecompressionError: if a gzip stream is truncated.
+        """
+        complete = self.encoding != 'gzip' or self._decompressor.eof
+        while not self._ended:
+            self._read_compressed()
+        if not complete:
+            raise DecompressionError('truncated {} stream'.format(self.encoding))
+
+    def _inflate(self):
+        while not self._decompressor.eof:
+            if not self._tail:
+                self._tail = self._read_compressed()
+                if not self._tail:
+                    break
+            chunk = self._decompressor.decompress(self._tail, self.max_length)
+            self._tail = self._decompressor.unconsumed_tail
+            if chunk:
+                return chunk
+        return b''
+
+    def _read_compressed(self):
+        data = b'' if self._ended else self._read()
+        self._ended = not data
+        self.compressed_bytes += len(data)
+        return data
+
+
+class _ReadFunction():
+    """File-like object reading from a function, whatever the size asked."""
+
+    def __init__(self, read):
+        self._read = read
+
+    def read(self, size=-1):
+        return self._read()
+
+
+def _compressor(encoding, level):
+    if level is None:
+        level = DEFAULT_LEVELS.get(encoding)
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise UnsupportedEncodingError('unsupported content encoding {}'.format(encoding))
@@ -0,0 +1,257 @@
+"""
+Parallel decoding of the pixel data of DICOM instances.
+
+Compressed transfer syntaxes (JPEG 2000, JPEG-LS, RLE...) are decoded one
+instance at a time by pydicom, which makes decoding a large series as slow as
+running some models. A DecodePool decodes the instances of a series
+concurrently, in threads or in worker processes, straight into one
+preallocated array, and keeps counters of the decoded frames, bytes and
+seconds per transfer syntax to compare the throughput of the decoders.
+"""
+
+import collections
+import concurrent.futures
+import errno
+import logging
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import numpy
+
+from utils import buffers
+from utils import process_pool
+from utils.instance_cache import parse_instance
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+logger = logging.getLogger('decoding')
+
+
+class DecodePool():
+    """Decode the pixels of DICOM instances in a pool of threads or processes.
+
+    Threads suit decoders that release the GIL, e.g. GDCM, processes the
+    pure Python ones. In worker processes, the instances and the output array
+    are shared through memory files, like in a ``ProcessPool``, and decoded
+    pixels are not stored in the instance cache.
+
+    :param int workers: number of threads or processes.
+    :param bool processes: whether to decode in worker processes.
+    :param str shm_dir: directory of the shared memory files of processes.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, processes=False,
+                 shm_dir=process_pool.DEFAULT_SHM_DIR):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self.processes = processes
+        self._shm_dir = shm_dir
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = set()
+        self._counters = collections.defaultdict(collections.Counter)
+        self.restarts = 0
+
+    def decode(self, instances, shape, dtype):
+        """Decode the pixels of instances into a new array.
+
+        :param list instances: LazyInstance objects, in output order.
+        :param tuple shape: shape of the output, its first axes hold the
+         pixels of each instance in turn, e.g. (timepoints, depth, height,
+         width) for the instances of a volume.
+        :param dtype: numpy dtype of the output.
+        :return: numpy.ndarray of the given shape.
+        :raises process_pool.WorkerCrashedError: if a worker process died, the
+         pool is restarted for the next calls.
+        """
+        if self.processes:
+            return self._decode_in_processes(instances, shape, dtype)
+
+        volume = numpy.empty(shape, dtype=dtype)
+        slots = volume.reshape(len(instances), -1)
+
+        def decode_one(i):
+            start = time.perf_counter()
+            pixels = instances[i].read_pixels()
+            seconds = time.perf_counter() - start
+            slots[i] = numpy.asarray(pixels).reshape(-1)
+            return seconds
+
+        executor = self._get_executor()
+        seconds = self._wait([executor.submit(decode_one, i) for i in range(len(instances))])
+        self._record(instances, seconds, slots[0].nbytes)
+        return volume
+
+    def stats(self):
+        """Return a dictionary of the decoded frames, bytes and seconds
+        spent decoding, keyed by transfer syntax UID."""
+        with self._lock:
+            return {
+                transfer_syntax: {'frames': 0, 'bytes': 0, 'seconds': 0, **counters}
+                for transfer_syntax, counters in self._counters.items()
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            # Decodes waiting for a worker are cancelled, so that shutdown
+            # only waits for the running ones
+            for future in self._futures:
+                future.cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.processes:
+                    # Spawned rather than forked, see ProcessPool
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix='decode'
+                    )
+            return self._executor
+
+    def _decode_in_processes(self, instances, shape, dtype):
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape, dtype=numpy.int64)) * dtype.itemsize
+        slot_bytes = nbytes // len(instances)
+
+        input_path, input_layout = process_pool._write_shared(
+            [instance.getbuffer() for instance in instances], self._shm_dir
+        )
+        try:
+            output_path, output = _create_output(max(nbytes, 1), self._shm_dir)
+        except BaseException:
+            if input_path is not None:
+                os.remove(input_path)
+            raise
+
+        try:
+            executor = self._get_executor()
+            futures = [
+                executor.submit(
+                    _decode_shared, input_path, offset, size, output_path,
+                    i * slot_bytes, slot_bytes, dtype.str
+                )
+                for i, (_, offset, size) in enumerate(input_layout)
+            ]
+            try:
+                seconds = self._wait(futures)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                self._restart(executor)
+                raise process_pool.WorkerCrashedError('worker process exited while decoding') from e
+        except BaseException:
+            output.close()
+            raise
+        finally:
+            os.remove(output_path)
+            if input_path is not None:
+                os.remove(input_path)
+
+        self._record(instances, seconds, slot_bytes)
+        # The mapping is released when the array is garbage collected
+        return numpy.frombuffer(output, dtype=dtype, count=nbytes // dtype.itemsize).reshape(shape)
+
+    def _restart(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            for future in self._futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            self._executor = None
+            self.restarts += 1
+
+    def _wait(self, futures):
+        """Return the results of futures, tracked meanwhile so that shutdown
+        can cancel the ones that did not start."""
+        with self._lock:
+            self._futures.update(futures)
+        try:
+            return [f.result() for f in futures]
+        finally:
+            with self._lock:
+                self._futures.difference_update(futures)
+
+    def _record(self, instances, seconds, slot_bytes):
+        with self._lock:
+            for instance, instance_seconds in zip(instances, seconds):
+                header = instance.header
+                counters = self._counters[str(header.file_meta.TransferSyntaxUID)]
+                counters['frames'] += int(header.get('NumberOfFrames', 1) or 1)
+                counters['bytes'] += slot_bytes
+                counters['seconds'] += instance_seconds
+
+
+def _create_output(size, shm_dir):
+    """Create the output memory file of a decode, in the temporary directory
+    if shm_dir is full.
+
+    :return: (path, mmap) tuple.
+    """
+    try:
+        return _map_output(size, shm_dir)
+    except OSError as e:
+        if e.errno != errno.ENOSPC or shm_dir is None:
+            raise
+        logger.warning('%s is full, decoding %d bytes in the temporary directory' % (shm_dir, size))
+        return _map_output(size, None)
+
+
+def _map_output(size, directory):
+    fd, path = tempfile.mkstemp(dir=directory, prefix='decode-')
+    try:
+        # Workers writing to pages that cannot be allocated die with SIGBUS
+        process_pool._allocate(fd, size)
+        return path, mmap.mmap(fd, size)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        os.close(fd)
+
+
+def _decode_shared(input_path, offset, size, output_path, output_offset, output_size, dtype):
+    """Decode one instance in a worker process, from the input memory file
+    into its slot of the output memory file.
+
+    :return: the seconds spent decoding.
+    """
+    with open(input_path, 'rb') as f:
+        shared_input = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(output_path, 'r+b') as f:
+        shared_output = mmap.mmap(f.fileno(), 0)
+
+    input_view = memoryview(shared_input)[offset:offset + size]
+    try:
+        start = time.perf_counter()
+        pixels = parse_instance(buffers.BufferReader(input_view), pixels=True).pixel_array
+        seconds = time.perf_counter() - start
+
+        pixels = numpy.ascontiguousarray(pixels, dtype=numpy.dtype(dtype))
+        if pixels.nbytes != output_size:
+            raise ValueError('decoded {} bytes for a slot of {} bytes'.format(pixels.nbytes, output_size))
+        slot = numpy.frombuffer(
+            shared_output, dtype=numpy.uint8, count=output_size, offset=output_offset
+        )
+        slot[:] = buffers.byte_view(pixels)
+        del slot
+    finally:
+        try:
+            input_view.release()
+            shared_input.close()
+            shared_output.close()
+        except BufferError:
+            # A view of the input is still referenced, leave it to the GC
+            pass
+    return seconds
@@ -0,0 +1,146 @@
+"""
+Digests of inference requests and responses.
+
+The gateway sends the digests of each request and of its response in the last
+part of the response, as ``input:output``, for auditing. Each part of a message
+is hashed on its own, and the digest of the message is the hash of the
+concatenated digests of its parts:
+
+    digest = H(H(part_1) + H(part_2) + ... + H(part_n))
+
+The parts of a request are its multipart parts, JSON part included. The parts
+of a response are its JSON text, UTF-8 encoded, followed by its binary
+parts. H is any algorithm supported by ``hashlib.new``, sha256 by default.
+
+Request parts are hashed by the multipart parser as they are received.
+Response parts, and the files of ``studyPath`` requests, are hashed in a
+thread pool, since hashlib releases the GIL while it hashes large buffers.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+
+from utils import buffers
+
+DEFAULT_ALGORITHM = 'sha256'
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+# Handing a buffer to the pool costs more than hashing it below this size
+DEFAULT_MIN_PARALLEL_SIZE = 256 * 1024
+
+
+def new(algorithm=DEFAULT_ALGORITHM):
+    """Return a new hashlib object.
+
+    :raises ValueError: if the algorithm is not supported, or has no fixed
+     digest size like the SHAKE algorithms.
+    """
+    try:
+        content_hash = hashlib.new(algorithm)
+    except (TypeError, ValueError):
+        raise ValueError('unsupported hash algorithm {}'.format(algorithm))
+    if content_hash.digest_size == 0:
+        raise ValueError('hash algorithm {} has no fixed digest size'.format(algorithm))
+    return content_hash
+
+
+def hash_part(data, algorithm=DEFAULT_ALGORITHM):
+    """Return the raw digest of a bytes-like object or of the chunks of a
+    buffers.ChunkedBuffer."""
+    content_hash = new(algorithm)
+    if isinstance(data, buffers.ChunkedBuffer):
+        for chunk in data.iter_chunks():
+            content_hash.update(chunk)
+    else:
+        content_hash.update(data)
+    return content_hash.digest()
+
+
+def combine(part_digests, algorithm=DEFAULT_ALGORITHM):
+    """Return the hex digest of a message from the raw digests of its parts."""
+    content_hash = new(algorithm)
+    for part_digest in part_digests:
+        content_hash.update(part_digest)
+    return content_hash.hexdigest()
+
+
+def message_digest(parts, algorithm=DEFAULT_ALGORITHM):
+    """Return the hex digest of a message from the content of its parts.
+
+    Hashes the parts one after the other, e.g. to check the digests sent by
+    the gateway.
+    """
+    return combine([hash_part(part, algorithm) for part in parts], algorithm)
+
+
+class PartHasher():
+    """Hash parts of messages in a thread pool.
+
+    :param int max_workers: number of hashing threads.
+    :param int min_parallel_size: parts smaller than this many bytes are
+     hashed in the calling thread.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 min_parallel_size=DEFAULT_MIN_PARALLEL_SIZE):
+        self.max_workers = max_workers
+        self.min_parallel_size = min_parallel_size
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, data, algorithm=DEFAULT_ALGORITHM, timer=None, stage='hash', parent=None):
+        """Start hashing a part.
+
+        The content of data must not change until the returned future is done.
+
+        :param data: bytes-like object or buffers.ChunkedBuffer.
+        :param str algorithm: name of the hash algorithm.
+        :param metrics.StageTimer timer: optional timer the hashing time is
+         added to, as the given stage. The hashing is also recorded as a span
+         of the trace of the timer, with the given parent span.
+        :return: concurrent.futures.Future of the raw digest.
+        """
+        nbytes = buffers.nbytes(data)
+        if nbytes < self.min_parallel_size:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(_timed_hash(data, algorithm, timer, stage, parent, nbytes))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self._get_executor().submit(
+            _timed_hash, data, algorithm, timer, stage, parent, nbytes
+        )
+
+    def digest(self, parts, algorithm=DEFAULT_ALGORITHM):
+        """Return the hex digest of a message from the content of its parts,
+        hashing the parts concurrently."""
+        futures = [self.submit(part, algorithm) for part in parts]
+        return combine([f.result() for f in futures], algorithm)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='hash'
+                )
+            return self._executor
+
+
+def _timed_hash(data, algorithm, timer, stage, parent, nbytes):
+    start = time.perf_counter()
+    part_digest = hash_part(data, algorithm)
+    if timer is not None:
+        end = time.perf_counter()
+        timer.add(stage, end - start)
+        if timer.trace is not None:
+            timer.trace.add_span(stage, start, end, parent=parent, size=nbytes)
+    return part_digest
@@ -3,6 +3,8 @@ import SimpleITK as sitk
 from pydicom import dcmread
 from pydicom.filebase import DicomBytesIO
 
+from utils import nifti
+
 ARTERYS_PROBABILITY_MASK='probability_mask'
 ARTERYS_BINARY='binary'
 ARTERYS_MULTI_CLASS='multi_class'
@@ -39,11 +41,25 @@ def get_masks_from_nifti_file(nifti_file, data_type=ARTERYS_PROBABILITY_MASK, nu
     - nifti_file: the path to the Nifti file
     - data_type: Defines how the nifti file contents will be processed. It can be 'probability_mask' (default), 'binary' or 'multi_class'
     - num_classes: if `data_type` is 'multi_class' then pass the number of possible output classes to `num_classes`. (Excluding background)
+      Each class gets its own mask, use `get_numeric_label_mask_from_nifti_file` to get a single mask of all the classes instead.
 
     The function expects the mask to be in uint8. 
     Returns the segmentation mask as numpy array.
     """
 
+    if data_type == ARTERYS_MULTI_CLASS and _is_nifti_path(nifti_file):
+        try:
+            header = nifti.read_header(nifti_file)
+        except ValueError:
+            # e.g. scaled values, left to SimpleITK like other files
+            header = None
+        if header is not None:
+            if header.dtype != np.uint8:
+                print("Unsupported output dtype", header.dtype)
+                return None
+            # One vectorized pass over the label volume, without a copy per class
+            return nifti.one_hot_masks(nifti_file, range(1, num_classes + 1))
+
     arr = load_nifti_file(nifti_file)
     if arr.dtype != np.uint8:
         # Only uint8 is supported as segmentation mask output format.
@@ -53,12 +69,26 @@ def get_masks_from_nifti_file(nifti_file, data_type=ARTERYS_PROBABILITY_MASK, nu
     if data_type == ARTERYS_BINARY:
         arr *= 255
     elif data_type == ARTERYS_MULTI_CLASS:
-        output = []
-        for label in range(num_classes):
-            label_arr = np.copy(arr)
-            label_arr[arr == label + 1] = 255
-            label_arr[label_arr != 255] = 0
-            output.append(label_arr)
-        return np.array(output)
+        labels = np.arange(1, num_classes + 1, dtype=np.uint8).reshape((-1,) + (1,) * arr.ndim)
+        output = np.equal(arr[np.newaxis], labels).view(np.uint8)
+        output *= 255
+        return output
     
     return [arr]
+
+
+def get_numeric_label_mask_from_nifti_file(nifti_file, label_names=None):
+    """Read a Nifti label volume and return it as a single 'numeric_label_mask' with its label map.
+
+    - nifti_file: the path to a .nii or .nii.gz file holding label values from 0 (background) to 255
+    - label_names: optional dictionary mapping label values to their names, e.g. {1: 'Liver', 2: 'Spleen'}
+
+    The volume is read once, memory-mapped if it is not compressed or a slab of slices at a time otherwise.
+    Returns a tuple (mask, label_map): the uint8 mask in the order of `load_nifti_file`, and the `label_map` of
+    the labels present in the volume, to set on the 'numeric_label_mask' part.
+    """
+    return nifti.numeric_label_mask(nifti_file, label_names)
+
+
+def _is_nifti_path(path):
+    return isinstance(path, str) and (path.endswith('.nii') or path.endswith('.nii.gz'))
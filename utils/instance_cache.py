@@ -0,0 +1,153 @@
+"""
+Content-addressed cache of parsed DICOM instances.
+
+Follow-up requests for a patient often send mostly the same instances again,
+e.g. priors for a comparison, or the same study with another inference
+command. Instances are keyed by the digest of their content, so a parsed
+header and decoded pixel array are shared by every request that sends the
+same bytes, and the least recently used ones are evicted past a byte budget.
+"""
+
+import collections
+import threading
+
+import pydicom
+
+from utils import digest
+from utils.single_flight import SingleFlight
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class CachedInstance():
+    """A parsed DICOM instance, shared by all the requests that send it.
+
+    It must not be modified: the pixel array is read-only, and the dataset
+    should be copied before changing any of its elements.
+
+    :param pydicom.Dataset dataset: header of the instance, without the pixel
+     data element.
+    :param numpy.ndarray pixel_array: decoded pixels, or None if they were not
+     decoded or the instance has no pixel data.
+    :param int header_bytes: estimated size of the header.
+    :param bool pixels_decoded: whether the pixel data was decoded.
+    """
+
+    def __init__(self, dataset, pixel_array, header_bytes, pixels_decoded):
+        self.dataset = dataset
+        self.pixel_array = pixel_array
+        self.header_bytes = header_bytes
+        self.pixels_decoded = pixels_decoded
+
+    @property
+    def nbytes(self):
+        pixel_bytes = self.pixel_array.nbytes if self.pixel_array is not None else 0
+        return self.header_bytes + pixel_bytes
+
+
+class InstanceCache():
+    """LRU cache of parsed DICOM instances keyed by content digest.
+
+    :param int max_bytes: budget of the cache, instances larger than the
+     budget are not stored.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._single_flight = SingleFlight()
+
+    def read(self, dicom_file, pixels=True):
+        """Return the parsed instance of a DICOM file, parsing it on a miss.
+
+        :param dicom_file: file-like object, e.g. one of the dicom_instances
+         passed to a handler. Those carry the digest computed by the gateway
+         in their ``digest`` attribute, the content of other files is hashed.
+        :param bool pixels: whether the pixel data is needed. Instances cached
+         with their header only are parsed again when it is.
+        :return: CachedInstance
+        """
+        key = getattr(dicom_file, 'digest', None)
+        if key is None:
+            key = digest.hash_part(_content(dicom_file)).hex()
+
+        instance = self.get(key, pixels)
+        if instance is not None:
+            return instance
+
+        # Requests sending the same instance at the same time parse it once
+        instance, _ = self._single_flight.do(
+            '{}:{}'.format(key, pixels), lambda: self._parse(key, dicom_file, pixels)
+        )
+        return instance
+
+    def get(self, key, pixels=True):
+        """Return the CachedInstance stored for a digest, or None."""
+        with self._lock:
+            instance = self._entries.get(key)
+            if instance is None or (pixels and not instance.pixels_decoded):
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return instance
+
+    def put(self, key, instance):
+        """Store a CachedInstance, replacing the one stored for the digest."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            if instance.nbytes > self.max_bytes:
+                return
+            self._entries[key] = instance
+            self._bytes += instance.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._counters['evictions'] += 1
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        with self._lock:
+            stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+            stats.update(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def _parse(self, key, dicom_file, pixels):
+        instance = parse_instance(dicom_file, pixels)
+        self.put(key, instance)
+        return instance
+
+
+def parse_instance(dicom_file, pixels=True):
+    """Parse a DICOM file into a CachedInstance.
+
+    :param dicom_file: seekable file-like object, read from the start.
+    :param bool pixels: whether to decode the pixel data, otherwise parsing
+     stops before it.
+    """
+    dicom_file.seek(0)
+    dataset = pydicom.dcmread(dicom_file, stop_before_pixels=not pixels)
+    header_bytes = dicom_file.tell()
+    pixel_array = None
+    if pixels and 'PixelData' in dataset:
+        header_bytes -= len(dataset.PixelData)
+        pixel_array = dataset.pixel_array
+        pixel_array.flags.writeable = False
+        # Only the decoded pixels are kept
+        del dataset.PixelData
+    dicom_file.seek(0)
+    return CachedInstance(dataset, pixel_array, header_bytes, pixels)
+
+
+def _content(dicom_file):
+    if hasattr(dicom_file, 'getbuffer'):
+        return dicom_file.getbuffer()
+    dicom_file.seek(0)
+    return dicom_file.read()
@@ -0,0 +1,236 @@
+"""
+Asynchronous inference jobs.
+
+Jobs are run by a bounded pool of worker threads. Their results are kept for a
+retention period after they finish so clients can poll for the status and
+fetch the result later, instead of holding an HTTP connection open while the
+model runs. The number of jobs waiting or running and the size of the kept
+results are bounded, so a burst of submissions cannot use unbounded memory.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+from utils.admission import AdmissionRejected
+from utils.admission import DEFAULT_RETRY_AFTER
+
+logger = logging.getLogger('jobs')
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_RETENTION = 60 * 60
+DEFAULT_MAX_PENDING = 64
+DEFAULT_MAX_RESULT_BYTES = 1024 * 1024 * 1024
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job():
+    """State of a single asynchronous job."""
+
+    def __init__(self, input_digest, context=None):
+        self.id = uuid.uuid4().hex
+        self.input_digest = input_digest
+        self.context = context
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.result_bytes = 0
+        self.error = None
+        self.cancel_requested = False
+        self.future = None
+
+    @property
+    def done(self):
+        return self.status in {SUCCEEDED, FAILED, CANCELLED}
+
+    def to_json(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'input_hash': self.input_digest,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+        }
+
+
+class JobManager():
+    """Run jobs in a bounded worker pool and keep their results.
+
+    :param int max_workers: number of jobs that run at the same time, other
+     jobs wait in a queue.
+    :param float retention: seconds a finished job is kept before it is
+     removed together with its result.
+    :param int max_pending: number of jobs that can be queued or running,
+     further submissions are rejected.
+    :param int max_result_bytes: total size of the results kept, the oldest
+     finished jobs are removed first to stay within it.
+    :param int retry_after: seconds clients are told to wait before retrying
+     a rejected submission.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, retention=DEFAULT_RETENTION,
+                 max_pending=DEFAULT_MAX_PENDING, max_result_bytes=DEFAULT_MAX_RESULT_BYTES,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        self.retention = retention
+        self.max_pending = max_pending
+        self.max_result_bytes = max_result_bytes
+        self.retry_after = retry_after
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='inference-job'
+        )
+        self._jobs = {}
+        self._pending = 0
+        self._result_bytes = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, input_digest, context=None, cleanup=None):
+        """Queue fn to run as a job.
+
+        :param callable fn: function without arguments computing the result.
+        :param str input_digest: digest of the job input, reported in the
+         job status.
+        :param context: any data the caller needs to keep with the job.
+        :param callable cleanup: called once the job will not run anymore,
+         whether it ran, failed or was cancelled.
+        :return: the new Job.
+        :raises AdmissionRejected: if max_pending jobs are queued or running.
+        """
+        self._prune()
+        job = Job(input_digest, context)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise AdmissionRejected('too many pending jobs', self.retry_after)
+            self._pending += 1
+            self._jobs[job.id] = job
+            # Submitted under the lock so shutdown sees every future
+            job.future = self._executor.submit(self._run, job, fn, cleanup)
+
+        def cleanup_cancelled(future):
+            # A job cancelled before it started never reaches _run
+            if future.cancelled() and cleanup is not None:
+                cleanup()
+
+        job.future.add_done_callback(cleanup_cancelled)
+        return job
+
+    def get(self, job_id):
+        """Return the Job with the given id, or None if it is unknown or
+        past its retention period."""
+        self._prune()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job.
+
+        A queued job is removed from the queue. A running job cannot be
+        interrupted, but its result is discarded when it finishes.
+
+        :return: the Job, or None if it is unknown.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self._lock:
+            if job.done:
+                return job
+            job.cancel_requested = True
+            if job.future.cancel():
+                self._finish(job, CANCELLED)
+        return job
+
+    def shutdown(self, wait=True):
+        # Queued jobs are cancelled first so that shutdown only waits for the
+        # running ones
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.done and job.future.cancel():
+                    self._finish(job, CANCELLED)
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """Return the number of pending jobs, the size of the kept results
+        and the limits, as a dictionary."""
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'result_bytes': self._result_bytes,
+                'max_pending': self.max_pending,
+                'max_result_bytes': self.max_result_bytes,
+            }
+
+    def _run(self, job, fn, cleanup):
+        try:
+            with self._lock:
+                if job.cancel_requested:
+                    self._finish(job, CANCELLED)
+                    return
+                job.status = RUNNING
+                job.started = time.time()
+            try:
+                result = fn()
+            except Exception as e:
+                logger.exception('job %s failed' % job.id)
+                with self._lock:
+                    job.error = str(e)
+                    self._finish(job, FAILED)
+                return
+            with self._lock:
+                if job.cancel_requested:
+                    self._finish(job, CANCELLED)
+                else:
+                    job.result = result
+                    job.result_bytes = getattr(result, 'nbytes', 0)
+                    self._result_bytes += job.result_bytes
+                    self._finish(job, SUCCEEDED)
+                    self._evict()
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    def _finish(self, job, status):
+        # Called with the lock held
+        job.status = status
+        job.finished = time.time()
+        self._pending -= 1
+
+    def _remove(self, job_id):
+        # Called with the lock held
+        job = self._jobs.pop(job_id)
+        self._result_bytes -= job.result_bytes
+
+    def _evict(self):
+        # Called with the lock held. Dicts keep insertion order, not finish
+        # order, so finished jobs are sorted
+        if self._result_bytes <= self.max_result_bytes:
+            return
+        finished = sorted(
+            (job for job in self._jobs.values() if job.result_bytes),
+            key=lambda job: job.finished
+        )
+        for job in finished:
+            if self._result_bytes <= self.max_result_bytes:
+                break
+            logger.info('evicting the result of job %s' % job.id)
+            self._remove(job.id)
+
+    def _prune(self):
+        expiry = time.time() - self.retention
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.done and job.finished < expiry
+            ]
+            for job_id in expired:
+                self._remove(job_id)
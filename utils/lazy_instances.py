@@ -0,0 +1,146 @@
+"""
+Lazily parsed DICOM instances of a request.
+
+Routes added with ``lazy_instances=True`` pass handlers an InstanceList of
+LazyInstance objects instead of plain file-like objects. An instance parses
+its header, without the pixel data, the first time it is accessed, and
+decodes its pixels only if they are asked for, so a model that reads headers
+only never pays for pixel decoding. The list is indexed by
+SeriesInstanceUID and SOPInstanceUID.
+
+LazyInstance is still a read-only file-like object, so handlers written for
+plain instances, e.g. calling ``pydicom.dcmread`` on them, keep working.
+"""
+
+import collections
+import threading
+
+from utils import buffers
+from utils.instance_cache import parse_instance
+
+
+class LazyInstance(buffers.BufferReader):
+    """A DICOM part of a request, parsed on demand.
+
+    :param buffer: content of the part.
+    :param str digest: hex digest of the content.
+    :param utils.instance_cache.InstanceCache instance_cache: optional cache
+     the parsed header and pixels are shared through.
+    """
+
+    def __init__(self, buffer, digest=None, instance_cache=None):
+        super().__init__(buffer, digest)
+        self._instance_cache = instance_cache
+        self._lock = threading.Lock()
+        self._header = None
+        self._pixel_array = None
+        self._pixels_decoded = False
+
+    @property
+    def header(self):
+        """pydicom Dataset of the instance without its pixel data, parsed on
+        first access. Shared with the instance cache, do not modify it."""
+        if self._header is None:
+            self._load(pixels=False)
+        return self._header
+
+    @property
+    def pixel_array(self):
+        """Read-only numpy array of the decoded pixels, or None if the
+        instance has none. Decoded on first access."""
+        if not self._pixels_decoded:
+            self._load(pixels=True)
+        return self._pixel_array
+
+    def read_pixels(self):
+        """Return the decoded pixels without keeping them in this instance,
+        e.g. to copy them into a larger array.
+
+        Pixels already decoded, or shared through the instance cache, are
+        returned as they are.
+        """
+        if self._pixels_decoded or self._instance_cache is not None:
+            return self.pixel_array
+        return parse_instance(buffers.BufferReader(self.getbuffer()), pixels=True).pixel_array
+
+    @property
+    def series_instance_uid(self):
+        return self.header.SeriesInstanceUID
+
+    @property
+    def sop_instance_uid(self):
+        return self.header.SOPInstanceUID
+
+    def _load(self, pixels):
+        with self._lock:
+            if self._pixels_decoded or (self._header is not None and not pixels):
+                return
+            # A separate reader keeps the position of this file unchanged
+            reader = buffers.BufferReader(self.getbuffer(), self.digest)
+            if self._instance_cache is not None:
+                instance = self._instance_cache.read(reader, pixels)
+            else:
+                instance = parse_instance(reader, pixels)
+            self._header = instance.dataset
+            if pixels:
+                self._pixel_array = instance.pixel_array
+                self._pixels_decoded = True
+
+
+class InstanceList(list):
+    """List of the LazyInstance objects of a request, in request order.
+
+    The index by series and SOP instance UID is built on first use, from the
+    headers of the instances only.
+    """
+
+    def __init__(self, instances=()):
+        super().__init__(instances)
+        self._lock = threading.Lock()
+        self._series = None
+        self._sop_instances = None
+
+    def series_uids(self):
+        """Return the SeriesInstanceUIDs of the instances, in the order they
+        first appear."""
+        return list(self._index()[0])
+
+    def series(self, series_instance_uid):
+        """Return the instances of a series, in request order.
+
+        :raises KeyError: if no instance belongs to the series.
+        """
+        return list(self._index()[0][series_instance_uid])
+
+    def by_sop_instance_uid(self, sop_instance_uid):
+        """Return the instance with a SOPInstanceUID.
+
+        :raises KeyError: if there is no such instance.
+        """
+        return self._index()[1][sop_instance_uid]
+
+    def _index(self):
+        with self._lock:
+            if self._series is None:
+                series = collections.OrderedDict()
+                sop_instances = {}
+                for instance in self:
+                    header = instance.header
+                    series.setdefault(header.SeriesInstanceUID, []).append(instance)
+                    sop_instances[header.SOPInstanceUID] = instance
+                self._series, self._sop_instances = series, sop_instances
+            return self._series, self._sop_instances
+
+
+def to_instance_list(dicom_instances, instance_cache=None):
+    """Wrap the dicom_instances passed to a handler in an InstanceList.
+
+    :param list dicom_instances: file-like objects with a ``getbuffer``
+     method, e.g. the dicom_instances of a handler of a process pool route.
+    :param utils.instance_cache.InstanceCache instance_cache: optional cache
+     of the parsed instances.
+    """
+    return InstanceList(
+        LazyInstance(d.getbuffer(), getattr(d, 'digest', None), instance_cache)
+        for d in dicom_instances
+    )
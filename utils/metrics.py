@@ -0,0 +1,231 @@
+"""
+Metrics of the gateway, exposed in the Prometheus text format.
+
+A small registry of counters, gauges and histograms with labels, so the
+gateway does not need a metrics client library. Metrics kept by other
+components, e.g. the result cache counters, are added to the output by
+collector functions called on each scrape.
+"""
+
+import contextlib
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(12))
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+RATIO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5)
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels):
+        """Return the child metric for the given label values."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def samples(self):
+        """Return a list of (suffix, labels, value) tuples."""
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for key, child in children:
+            labels = dict(zip(self.labelnames, key))
+            samples.extend(child.samples(labels))
+        return samples
+
+
+class _Value():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def samples(self, labels):
+        return [('', labels, self.value)]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of requests."""
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. the number of requests in flight."""
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue():
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            self._sum += value
+            self._count += 1
+
+    def samples(self, labels):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+        samples.append(('_bucket', dict(labels, le='+Inf'), count))
+        samples.append(('_sum', labels, total))
+        samples.append(('_count', labels, count))
+        return samples
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies, in buckets."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+class Registry():
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Add a function called on each scrape.
+
+        :param callable collector: function without arguments returning a
+         list of (name, type, help, samples) tuples, where samples is a list of
+         (labels dictionary, value) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            _render_family(lines, metric.name, metric.type, metric.help, metric.samples())
+        for collector in collectors:
+            for name, type, help, samples in collector():
+                _render_family(lines, name, type, help, [('', l, v) for l, v in samples])
+        return ''.join(line + '\n' for line in lines)
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+class StageTimer():
+    """Accumulate the time a request spends in each processing stage.
+
+    :param utils.tracing.Trace trace: optional trace of the request, stages
+     are recorded in it as spans.
+    """
+
+    def __init__(self, trace=None):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.trace = trace
+
+    @contextlib.contextmanager
+    def stage(self, name, span=True):
+        """Context manager adding the time spent in its block to a stage.
+
+        :param bool span: whether to also record the block as a span of the
+         trace. Disable it for blocks run for every chunk of a body.
+        """
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if span and self.trace is not None:
+                stack.enter_context(self.trace.span(name))
+            try:
+                yield
+            finally:
+                self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0) + seconds
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _render_family(lines, name, type, help, samples):
+    lines.append('# HELP {} {}'.format(name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+    lines.append('# TYPE {} {}'.format(name, type))
+    for suffix, labels, value in samples:
+        if labels:
+            label_text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+            lines.append('{}{}{{{}}} {}'.format(name, suffix, label_text, _format_value(value)))
+        else:
+            lines.append('{}{} {}'.format(name, suffix, _format_value(value)))
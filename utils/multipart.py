@@ -0,0 +1,323 @@
+"""
+Streaming multipart/related parsing and encoding for inference requests.
+
+The parser consumes the request body in chunks as it arrives on the socket and
+emits each part as soon as its closing boundary has been seen. Small parts are
+kept in memory, larger parts roll over to a memory-mapped temporary file, so a
+large study is never held in memory as a single bytes object. The encoder does the reverse
+for responses and yields the body chunk by chunk.
+"""
+
+import email.parser
+import mmap
+import tempfile
+import time
+
+from utils import buffers
+from utils import digest
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_SPILL_THRESHOLD = 8 * 1024 * 1024
+
+
+class MultipartError(ValueError):
+    """Raised when a multipart body is malformed or truncated."""
+
+
+class BodyPart():
+    """A single part of a multipart body.
+
+    The content is written incrementally by the parser, in memory until it
+    grows past the spill threshold and to a temporary file after that. Once
+    the part is complete, ``buffer`` is a read-only memoryview of the content,
+    backed either by the in-memory buffer or by a memory map of the file.
+    ``digest`` is the hex digest of the content, once it has been hashed,
+    either by the parser as the content is written or later on.
+    """
+
+    def __init__(self, headers, encoding, spill_threshold, spill_dir=None):
+        self.headers = headers
+        self.encoding = encoding
+        self.size = 0
+        self.buffer = None
+        self.digest = None
+        self._spill_threshold = spill_threshold
+        self._spill_dir = spill_dir
+        self._memory = bytearray()
+        self._file = None
+        self._mmap = None
+
+    @property
+    def content_type(self):
+        return self.headers.get('content-type', '')
+
+    @property
+    def spilled(self):
+        """Whether the content was written to a temporary file."""
+        return self._file is not None
+
+    @property
+    def text(self):
+        """Content of the part decoded with the body encoding."""
+        return str(self.buffer, self.encoding)
+
+    def open(self):
+        """Return a new read-only file-like object over the content."""
+        return buffers.BufferReader(self.buffer, self.digest)
+
+    def write(self, data):
+        if self._file is None and self.size + len(data) > self._spill_threshold:
+            self._file = tempfile.TemporaryFile(dir=self._spill_dir)
+            self._file.write(self._memory)
+            self._memory = None
+        if self._file is None:
+            self._memory += data
+        else:
+            self._file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        if self._file is None:
+            self.buffer = memoryview(self._memory).toreadonly()
+        else:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self._mmap)
+
+    def close(self):
+        try:
+            if self.buffer is not None:
+                self.buffer.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            # A handler still holds a view of the content, the memory is
+            # freed once that view is garbage collected
+            pass
+        self.buffer = None
+        self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = None
+
+
+class MultipartParser():
+    """Incremental multipart body parser.
+
+    Feed chunks of the body with ``feed``; each call returns the list of parts
+    completed by that chunk. Call ``close`` after the last chunk to check that
+    the closing boundary was seen.
+
+    :param bytes boundary: the multipart boundary, without the leading dashes.
+    :param str encoding: encoding used for part headers and text content.
+    :param int spill_threshold: size in bytes above which a part is moved from
+     memory to a temporary file.
+    :param str spill_dir: directory for spilled parts, defaults to the system
+     temporary directory.
+    :param str hash_algorithm: optional name of a hash algorithm, see
+     ``digest.new``. Each part is then hashed as its content is written, so
+     spilled parts are never read back to be hashed, and its ``digest`` is
+     set once it is complete. ``hash_seconds`` is the time spent hashing.
+    """
+
+    _PREAMBLE, _DELIMITER, _HEADERS, _BODY, _EPILOGUE = range(5)
+
+    def __init__(self, boundary, encoding='utf-8',
+                 spill_threshold=DEFAULT_SPILL_THRESHOLD, spill_dir=None,
+                 hash_algorithm=None):
+        if isinstance(boundary, str):
+            boundary = boundary.encode('latin-1')
+        if not boundary:
+            raise MultipartError('missing multipart boundary')
+
+        self._delimiter = b'\r\n--' + boundary
+        self._encoding = encoding
+        self._spill_threshold = spill_threshold
+        self._spill_dir = spill_dir
+        self._hash_algorithm = hash_algorithm
+        if hash_algorithm is not None:
+            # Raises ValueError early for an unsupported algorithm
+            digest.new(hash_algorithm)
+        self._part_hash = None
+        self.hash_seconds = 0
+        # The first boundary is not preceded by a line break
+        self._buffer = bytearray(b'\r\n')
+        self._state = self._PREAMBLE
+        self._part = None
+
+    @property
+    def finished(self):
+        return self._state == self._EPILOGUE
+
+    def feed(self, data):
+        """Consume a chunk of the body and return the parts it completed."""
+        self._buffer += data
+        parts = []
+        progress = True
+        while progress:
+            progress = self._step(parts)
+        return parts
+
+    def close(self):
+        """Signal the end of the body.
+
+        :raises MultipartError: if the closing boundary was never received.
+        """
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+        if not self.finished:
+            raise MultipartError('multipart body ended before closing boundary')
+
+    def _step(self, parts):
+        buf = self._buffer
+
+        if self._state == self._PREAMBLE:
+            idx = buf.find(self._delimiter)
+            if idx < 0:
+                # Keep enough to match a delimiter split across chunks
+                del buf[:max(0, len(buf) - len(self._delimiter) + 1)]
+                return False
+            del buf[:idx + len(self._delimiter)]
+            self._state = self._DELIMITER
+            return True
+
+        if self._state == self._DELIMITER:
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b'--':
+                self._state = self._EPILOGUE
+            else:
+                self._state = self._HEADERS
+            return True
+
+        if self._state == self._HEADERS:
+            # The line break after the boundary is kept so that a part without
+            # headers still ends with an empty line
+            idx = buf.find(b'\r\n\r\n')
+            if idx < 0:
+                return False
+            headers = self._parse_headers(bytes(buf[:idx]))
+            del buf[:idx + 4]
+            self._part = BodyPart(
+                headers, self._encoding, self._spill_threshold,
+                self._spill_dir
+            )
+            if self._hash_algorithm is not None:
+                self._part_hash = digest.new(self._hash_algorithm)
+            self._state = self._BODY
+            return True
+
+        if self._state == self._BODY:
+            idx = buf.find(self._delimiter)
+            if idx < 0:
+                # Everything except a possible partial delimiter is content
+                self._write(len(buf) - len(self._delimiter) + 1)
+                return False
+            self._write(idx)
+            del buf[:len(self._delimiter)]
+            self._part.finish()
+            if self._part_hash is not None:
+                self._part.digest = self._part_hash.hexdigest()
+                self._part_hash = None
+            parts.append(self._part)
+            self._part = None
+            self._state = self._DELIMITER
+            return True
+
+        # Epilogue is ignored
+        buf.clear()
+        return False
+
+    def _write(self, length):
+        if length <= 0:
+            return
+        with memoryview(self._buffer) as view:
+            chunk = view[:length]
+            self._part.write(chunk)
+            if self._part_hash is not None:
+                start = time.perf_counter()
+                self._part_hash.update(chunk)
+                self.hash_seconds += time.perf_counter() - start
+            chunk.release()
+        del self._buffer[:length]
+
+    def _parse_headers(self, raw):
+        text = raw.decode(self._encoding).strip()
+        headers = email.parser.HeaderParser().parsestr(text)
+        return {k.lower(): v for k, v in headers.items()}
+
+
+def iter_parts(stream, boundary, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+    """Parse a multipart body from a file-like stream.
+
+    Yields each part as soon as it is complete. Keyword arguments are passed
+    to ``MultipartParser``.
+
+    :param stream: readable file-like object, e.g. the WSGI input stream.
+    :param bytes boundary: the multipart boundary.
+    :param int chunk_size: number of bytes to read from the stream at a time.
+    """
+    parser = MultipartParser(boundary, **kwargs)
+    while not parser.finished:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+def iter_encode(fields, boundary, encoding='utf-8',
+                chunk_size=DEFAULT_CHUNK_SIZE):
+    """Encode parts as a multipart body, one chunk at a time.
+
+    The output matches the layout of ``requests_toolbelt.MultipartEncoder``
+    but no part is ever joined with the rest of the body, so a response can be
+    written to the socket while later parts are still being produced.
+
+    :param fields: iterable of (name, content, content_type) tuples, or
+     (name, content, content_type, headers) tuples with a dictionary of extra
+     part headers, e.g. Content-Encoding. The content can be a str, a
+     bytes-like object, a buffers.ChunkedBuffer, a readable file-like object
+     or an iterator of bytes chunks. The iterable is consumed lazily.
+    :param str boundary: the multipart boundary, without the leading dashes.
+    :param str encoding: encoding used for headers and str content.
+    :param int chunk_size: maximum size of the chunks yielded for buffer and
+     file content.
+    """
+    for name, content, content_type, *headers in fields:
+        header = (
+            '--{boundary}\r\n'
+            'Content-Disposition: form-data; name="{name}"; filename="{name}"\r\n'
+            'Content-Type: {content_type}\r\n'
+        ).format(boundary=boundary, name=name, content_type=content_type)
+        for key, value in (headers[0] if headers else {}).items():
+            header += '{}: {}\r\n'.format(key, value)
+        header += '\r\n'
+        yield header.encode(encoding)
+        yield from _iter_content(content, encoding, chunk_size)
+        yield b'\r\n'
+    yield '--{}--\r\n'.format(boundary).encode(encoding)
+
+
+def _iter_content(content, encoding, chunk_size):
+    if isinstance(content, str):
+        yield content.encode(encoding)
+    elif isinstance(content, bytes):
+        yield content
+    elif hasattr(content, 'read'):
+        while True:
+            chunk = content.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    elif hasattr(content, '__next__'):
+        yield from content
+    elif isinstance(content, buffers.ChunkedBuffer):
+        for chunk in buffers.iter_chunks(content, chunk_size):
+            yield bytes(chunk)
+    else:
+        with memoryview(content) as view, view.cast('B') as data:
+            for offset in range(0, len(data), chunk_size):
+                yield bytes(data[offset:offset + chunk_size])
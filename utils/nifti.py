@@ -0,0 +1,237 @@
+"""
+Streaming reads of NIfTI label volumes.
+
+Segmentation models often write their output as a NIfTI volume of label
+values. Loading it with SimpleITK and building one mask per class copies the
+volume once per class. The functions of this module read the volume once
+instead: uncompressed ``.nii`` files are memory-mapped, ``.nii.gz`` files are
+decompressed a slab of slices at a time, and each slab is converted with
+vectorized numpy operations straight into the output mask, either a single
+``numeric_label_mask`` or, on request, one mask per label.
+
+Arrays are in numpy order, i.e. (timepoints, depth, height, width) for a 4D
+volume, the layout of the masks returned to the gateway.
+"""
+
+import gzip
+import math
+import struct
+
+import numpy
+
+# Size of the slabs of slices read at a time from compressed files, and
+# converted at a time from any file
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# NIfTI datatype code -> numpy dtype, native byte order
+DATATYPES = {
+    2: numpy.uint8,
+    4: numpy.int16,
+    8: numpy.int32,
+    16: numpy.float32,
+    64: numpy.float64,
+    256: numpy.int8,
+    512: numpy.uint16,
+    768: numpy.uint32,
+    1024: numpy.int64,
+    1280: numpy.uint64,
+}
+
+# sizeof_hdr -> (magic of single-file volumes, its offset, format of
+# datatype, its offset, format of dim, its offset, format of vox_offset,
+# scl_slope and scl_inter, their offset)
+_HEADER_LAYOUTS = {
+    348: (b'n+1\0', 344, 'h', 70, '8h', 40, 'fff', 108),
+    540: (b'n+2\0', 4, 'h', 12, '8q', 16, 'qdd', 168),
+}
+
+
+class NiftiHeader():
+    """The fields of a NIfTI-1 or NIfTI-2 header needed to read its data.
+
+    :param str path: path of the file.
+    :param tuple shape: shape of the data in numpy order.
+    :param numpy.dtype dtype: dtype of the data, with the byte order of the
+     file.
+    :param int vox_offset: offset of the data in the (decompressed) file.
+    :param bool compressed: whether the file is gzip compressed.
+    """
+
+    def __init__(self, path, shape, dtype, vox_offset, compressed):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.vox_offset = vox_offset
+        self.compressed = compressed
+
+    @property
+    def slice_shape(self):
+        """Shape of the slices, the last two axes of the volume."""
+        return self.shape[-2:] if len(self.shape) >= 2 else (1,) + self.shape
+
+    @property
+    def slice_count(self):
+        return int(numpy.prod(self.shape, dtype=numpy.int64)) // int(numpy.prod(self.slice_shape))
+
+
+def _open(path):
+    """Open a NIfTI file, decompressing it if its name ends with .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_header(path):
+    """Read the header of a single-file NIfTI-1 or NIfTI-2 volume.
+
+    :param str path: path of a .nii or .nii.gz file.
+    :return: NiftiHeader
+    :raises ValueError: if the file is not a NIfTI volume that can be read as
+     labels, e.g. with an unsupported datatype or scaled values.
+    """
+    with _open(path) as f:
+        data = f.read(540)
+
+    for byte_order in '<>':
+        if len(data) >= 4 and struct.unpack(byte_order + 'i', data[:4])[0] in _HEADER_LAYOUTS:
+            break
+    else:
+        raise ValueError('{} is not a NIfTI file'.format(path))
+    sizeof_hdr = struct.unpack(byte_order + 'i', data[:4])[0]
+    if len(data) < sizeof_hdr:
+        raise ValueError('{} has a truncated NIfTI header'.format(path))
+    (magic, magic_offset, datatype_format, datatype_offset, dim_format, dim_offset,
+     offset_format, offset_offset) = _HEADER_LAYOUTS[sizeof_hdr]
+    if data[magic_offset:magic_offset + len(magic)] != magic:
+        raise ValueError('{} is not a single-file NIfTI volume'.format(path))
+
+    datatype, = struct.unpack_from(byte_order + datatype_format, data, datatype_offset)
+    if datatype not in DATATYPES:
+        raise ValueError('{} has the unsupported NIfTI datatype {}'.format(path, datatype))
+    dim = struct.unpack_from(byte_order + dim_format, data, dim_offset)
+    if not 1 <= dim[0] <= 7:
+        raise ValueError('{} has an invalid number of dimensions {}'.format(path, dim[0]))
+    vox_offset, scl_slope, scl_inter = struct.unpack_from(byte_order + offset_format, data, offset_offset)
+    # Values are not scaled when scl_slope is 0 or not finite, nibabel
+    # writes NaN by default
+    if math.isfinite(scl_slope) and scl_slope != 0:
+        if scl_slope != 1 or (math.isfinite(scl_inter) and scl_inter != 0):
+            raise ValueError('{} has scaled values, which cannot be labels'.format(path))
+
+    # NIfTI stores the first axis fastest, numpy the last one
+    shape = tuple(int(n) for n in reversed(dim[1:dim[0] + 1]))
+    dtype = numpy.dtype(DATATYPES[datatype]).newbyteorder(byte_order)
+    return NiftiHeader(path, shape, dtype, int(vox_offset), path.endswith('.gz'))
+
+
+def memmap(header):
+    """Return a read-only memory map of the data of an uncompressed file."""
+    if header.compressed:
+        raise ValueError('{} is compressed and cannot be memory-mapped'.format(header.path))
+    return numpy.memmap(header.path, dtype=header.dtype, mode='r', offset=header.vox_offset, shape=header.shape)
+
+
+def iter_slabs(header, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Iterate over the data of a volume, a slab of slices at a time.
+
+    Uncompressed files are memory-mapped and the slabs are views of the map,
+    compressed files are decompressed into a buffer reused for every slab.
+
+    :param NiftiHeader header: header of the file.
+    :param int chunk_bytes: approximate size of the slabs.
+    :return: iterator over (first slice, array of shape (slices, height,
+     width)) tuples, in the order of the flattened leading axes. A slab is
+     only valid until the next one is read.
+    """
+    slice_size = int(numpy.prod(header.slice_shape)) * header.dtype.itemsize
+    slices_per_slab = max(1, chunk_bytes // max(slice_size, 1))
+    slice_count = header.slice_count
+
+    if not header.compressed:
+        slices = memmap(header).reshape((slice_count,) + header.slice_shape)
+        for start in range(0, slice_count, slices_per_slab):
+            yield start, slices[start:start + slices_per_slab]
+        return
+
+    buffer = numpy.empty((min(slices_per_slab, slice_count),) + header.slice_shape, dtype=header.dtype)
+    with _open(header.path) as f:
+        f.seek(header.vox_offset)
+        for start in range(0, slice_count, slices_per_slab):
+            slab = buffer[:min(slices_per_slab, slice_count - start)]
+            view = memoryview(slab.reshape(-1).view(numpy.uint8))
+            read = 0
+            while read < len(view):
+                n = f.readinto(view[read:])
+                if not n:
+                    raise ValueError('{} is truncated'.format(header.path))
+                read += n
+            yield start, slab
+
+
+def numeric_label_mask(path, label_names=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Read a NIfTI label volume as a ``numeric_label_mask``.
+
+    The label values of the volume are the values of the mask, 0 being the
+    background, so they must be integers from 0 to 255. The volume is read
+    once, and the values present in it are counted as it is converted.
+
+    :param str path: path of a .nii or .nii.gz file.
+    :param dict label_names: optional names of the label values, e.g.
+     ``{1: 'Liver', 2: 'Spleen'}``. Values without a name are named after
+     their value.
+    :param int chunk_bytes: approximate size of the slabs converted at a time.
+    :return: (mask, label_map) tuple, where mask is a uint8 array in numpy
+     order and label_map the ``label_map`` of the part, holding the values
+     present in the volume. The mask of an uncompressed uint8 file is a
+     read-only memory map of the file.
+    :raises ValueError: if the file cannot be read or a value is not a label.
+    """
+    header = read_header(path)
+    counts = numpy.zeros(256, dtype=numpy.int64)
+    if header.dtype == numpy.uint8 and not header.compressed:
+        mask = memmap(header)
+        for _, slab in iter_slabs(header, chunk_bytes):
+            counts += numpy.bincount(slab.reshape(-1), minlength=256)
+    else:
+        mask = numpy.empty(header.shape, dtype=numpy.uint8)
+        slices = mask.reshape((header.slice_count,) + header.slice_shape)
+        for start, slab in iter_slabs(header, chunk_bytes):
+            labels = slices[start:start + len(slab)]
+            _to_labels(slab, labels, path)
+            counts += numpy.bincount(labels.reshape(-1), minlength=256)
+
+    label_names = label_names or {}
+    label_map = {
+        str(value): label_names.get(value, str(value)) for value in numpy.flatnonzero(counts[1:]) + 1
+    }
+    return mask, label_map
+
+
+def one_hot_masks(path, labels, value=255, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Read a NIfTI label volume as one mask per label.
+
+    :param str path: path of a .nii or .nii.gz file.
+    :param labels: label values of the masks, in order.
+    :param int value: value of the voxels of a label in its mask.
+    :param int chunk_bytes: approximate size of the slabs converted at a time.
+    :return: uint8 array of shape (len(labels),) + the shape of the volume.
+    :raises ValueError: if the file cannot be read.
+    """
+    header = read_header(path)
+    labels = numpy.asarray(labels).reshape(-1, 1, 1, 1)
+    masks = numpy.empty((len(labels),) + header.shape, dtype=numpy.uint8)
+    slices = masks.reshape((len(labels), header.slice_count) + header.slice_shape)
+    for start, slab in iter_slabs(header, chunk_bytes):
+        out = slices[:, start:start + len(slab)]
+        numpy.equal(slab[numpy.newaxis], labels, out=out.view(bool))
+        out *= numpy.uint8(value)
+    return masks
+
+
+def _to_labels(slab, out, path):
+    """Convert a slab of label values to uint8 into out."""
+    if slab.size and (slab.min() < 0 or slab.max() > 255):
+        raise ValueError('{} has label values outside of 0 to 255'.format(path))
+    numpy.copyto(out, slab, casting='unsafe')
+    if slab.dtype.kind == 'f' and not numpy.array_equal(out, slab):
+        raise ValueError('{} has label values that are not integers'.format(path))
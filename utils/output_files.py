@@ -0,0 +1,90 @@
+"""
+Binary parts of responses written to a shared directory.
+
+When a study is read from a mounted volume, see ``study_files``, sending
+multi-GB masks back in the response body is as wasteful as uploading the
+study. The gateway can instead write the binary parts of those responses to
+a directory on the shared mount, and send in place of each part a small JSON
+reference to its file, with its size and digest.
+"""
+
+import json
+import os
+import tempfile
+
+from utils import buffers
+from utils import digest
+from utils.result_cache import CachedResult
+
+PATH_REFERENCE_CONTENT_TYPE = 'application/x-path-reference+json'
+# Larger writes are split, Linux writes at most 2 GiB at a time
+WRITE_SIZE = 64 * 1024 * 1024
+
+_EXTENSIONS = {'application/dicom': '.dcm', 'application/binary': '.bin'}
+
+
+def write_part(path, data):
+    """Write a buffer to a file atomically.
+
+    The buffer is written straight from memory to a temporary file in the
+    same directory, which is then renamed, so readers never see a partial
+    file.
+
+    :param str path: path of the file.
+    :param data: bytes-like object or buffers.ChunkedBuffer.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        try:
+            # Clients of the shared volume may run as other users
+            os.fchmod(fd, 0o644)
+            for chunk in buffers.iter_chunks(data, WRITE_SIZE):
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_result(result, directory, algorithm=digest.DEFAULT_ALGORITHM):
+    """Write the binary parts of a result to files and replace them with
+    references to the files.
+
+    The files are written to ``<directory>/<output digest>/elem_<i>.bin``,
+    or ``.dcm`` for DICOM parts, so a result already written, e.g. a cached
+    result sent again, is not written twice.
+
+    :param CachedResult result: the serialized model output.
+    :param str directory: output directory, e.g. on a shared volume.
+    :param str algorithm: hash algorithm of the digests of the parts, if the
+     result does not carry them.
+    :return: CachedResult with one PATH_REFERENCE_CONTENT_TYPE part for
+     each binary part, holding the JSON reference to its file.
+    :raises OSError: if a file cannot be written.
+    """
+    result_dir = os.path.join(directory, result.output_digest)
+    os.makedirs(result_dir, exist_ok=True)
+
+    part_digests = result.part_digests
+    if part_digests is None:
+        part_digests = [digest.hash_part(part, algorithm).hex() for _, part in result.parts]
+
+    references = []
+    for i, ((content_type, part), part_digest) in enumerate(zip(result.parts, part_digests)):
+        nbytes = buffers.nbytes(part)
+        path = os.path.join(result_dir, 'elem_{}{}'.format(i, _EXTENSIONS.get(content_type, '')))
+        if not (os.path.exists(path) and os.path.getsize(path) == nbytes):
+            write_part(path, part)
+        reference = {
+            'path': path,
+            'size': nbytes,
+            'digest': part_digest,
+            'algorithm': algorithm,
+            'content_type': content_type,
+        }
+        references.append((PATH_REFERENCE_CONTENT_TYPE, json.dumps(reference).encode('utf-8')))
+    return CachedResult(result.json_text, references, result.output_digest, part_digests)
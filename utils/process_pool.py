@@ -0,0 +1,288 @@
+"""
+Execution of model functions in a pool of worker processes.
+
+CPU-bound models and pixel decoding in Python hold the GIL, so handler threads
+of the gateway run them one at a time. A ProcessPool runs the model function in
+worker processes instead. Request parts and binary response components are
+passed between processes through shared memory files (``/dev/shm`` by default)
+mapped on both sides, so only small JSON objects are pickled. The space of a
+file is reserved before it is written, so a full ``/dev/shm`` raises an error
+instead of crashing the gateway, and the file is then written to the
+temporary directory instead.
+"""
+
+import concurrent.futures
+import errno
+import logging
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+
+import numpy
+
+from utils import bit_masks
+from utils import buffers
+
+logger = logging.getLogger('process_pool')
+
+DEFAULT_PROCESSES = 2
+DEFAULT_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Offsets of the components in a shared memory file are aligned for numpy
+_ALIGNMENT = 64
+# Size of the chunks of ChunkedBuffer components copied at a time
+_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised when a worker process exits while running a request."""
+
+
+class ProcessPool():
+    """Run a model function in a pool of worker processes.
+
+    :param callable model_fn: model function, must be importable by name from
+     the worker processes (i.e. defined at module level).
+    :param int processes: number of worker processes.
+    :param callable warmup_fn: optional function without arguments called once
+     in each worker process when it starts, e.g. to load the model weights.
+    :param str shm_dir: directory of the shared memory files. Defaults to
+     ``/dev/shm`` when it exists, the temporary directory otherwise.
+    """
+
+    def __init__(self, model_fn, processes=DEFAULT_PROCESSES, warmup_fn=None, shm_dir=DEFAULT_SHM_DIR):
+        if processes < 1:
+            raise ValueError('processes must be at least 1')
+        self._model_fn = model_fn
+        self.processes = processes
+        self._warmup_fn = warmup_fn
+        self._shm_dir = shm_dir
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = set()
+        self.restarts = 0
+
+    def __call__(self, json_input, dicom_instances, input_digest):
+        """Run the model function in a worker process.
+
+        Has the signature of a regular model_fn, so the pool can be registered
+        with ``Gateway.add_inference_route``.
+
+        :raises WorkerCrashedError: if the worker process died, the pool is
+         restarted for the next requests.
+        """
+        input_path, input_layout = _write_shared(
+            [buffers.as_buffer(d) for d in dicom_instances], self._shm_dir
+        )
+        input_digests = [getattr(d, 'digest', None) for d in dicom_instances]
+        try:
+            executor = self.start()
+            future = executor.submit(
+                _call_model, self._model_fn, json_input, input_path, input_layout,
+                input_digests, input_digest, self._shm_dir
+            )
+            with self._lock:
+                self._futures.add(future)
+            try:
+                response_json, output_path, output_layout = future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                self._restart(executor)
+                raise WorkerCrashedError('worker process exited while running the model') from e
+            finally:
+                with self._lock:
+                    self._futures.discard(future)
+        finally:
+            if input_path is not None:
+                os.remove(input_path)
+
+        return response_json, _read_shared(output_path, output_layout)
+
+    def start(self):
+        """Start the worker processes and wait until they are warmed up.
+
+        Called on the first request if it was not called before.
+
+        :return: the underlying ``concurrent.futures.ProcessPoolExecutor``.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return self._executor
+            # Worker processes are spawned rather than forked, forking a
+            # process running handler threads can deadlock
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=self._warmup_fn
+            )
+            # Workers are spawned on demand, one per task submitted while
+            # none is idle, so this starts and warms up all of them
+            warmups = [executor.submit(os.getpid) for _ in range(self.processes)]
+            try:
+                pids = {f.result() for f in warmups}
+            except concurrent.futures.process.BrokenProcessPool:
+                executor.shutdown(wait=False)
+                raise
+            logger.info('started %d worker processes %s' % (len(pids), sorted(pids)))
+            self._executor = executor
+            return executor
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            # Requests waiting for a worker are cancelled, so that shutdown
+            # only waits for the running ones
+            for future in self._futures:
+                future.cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _restart(self, executor):
+        with self._lock:
+            # Requests in flight on the broken pool all fail, only the first
+            # one to get here replaces it
+            if self._executor is not executor:
+                return
+            logger.error('worker process crashed, restarting the pool')
+            # The futures of a broken pool have all failed already
+            executor.shutdown(wait=False)
+            self._executor = None
+            self.restarts += 1
+
+
+def _write_shared(components, shm_dir):
+    """Copy buffers into a new shared memory file.
+
+    If shm_dir is full, the file is written to the temporary directory
+    instead.
+
+    :param list components: numpy arrays, bytes-like objects or
+     ChunkedBuffer objects, whose chunks are copied one at a time.
+    :return: 2-tuple of the path of the file, or None if all components are
+     empty, and the layout to pass to ``_read_shared``.
+    :raises OSError: if the file cannot be written.
+    """
+    layout = []
+    size = 0
+    for component in components:
+        size = -(-size // _ALIGNMENT) * _ALIGNMENT
+        if isinstance(component, bit_masks.PackedMask):
+            layout.append(('packed', size, component.shape))
+        elif isinstance(component, numpy.ndarray) or (
+                isinstance(component, buffers.ChunkedBuffer) and hasattr(component, 'dtype')):
+            # Arrays and SparseMasks are read back as arrays
+            layout.append(('array', size, component.dtype.str, component.shape))
+        else:
+            layout.append(('bytes', size, buffers.nbytes(component)))
+        size += buffers.nbytes(component)
+
+    if size == 0:
+        return None, layout
+
+    try:
+        path = _write_file(components, layout, size, shm_dir)
+    except OSError as e:
+        if e.errno != errno.ENOSPC or shm_dir is None:
+            raise
+        logger.warning('%s is full, writing %d bytes to the temporary directory' % (shm_dir, size))
+        path = _write_file(components, layout, size, None)
+    return path, layout
+
+
+def _write_file(components, layout, size, directory):
+    fd, path = tempfile.mkstemp(dir=directory, prefix='inference-')
+    try:
+        # Writing to a memory map of a file whose pages cannot be allocated
+        # kills the process with SIGBUS, allocating them first raises ENOSPC
+        _allocate(fd, size)
+        with mmap.mmap(fd, size) as shared:
+            for component, entry in zip(components, layout):
+                offset = entry[1]
+                for chunk in buffers.iter_chunks(component, _CHUNK_SIZE):
+                    shared[offset:offset + chunk.nbytes] = chunk
+                    offset += chunk.nbytes
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        os.close(fd)
+    return path
+
+
+def _allocate(fd, size):
+    """Allocate the pages of a file, or only set its size where the file
+    system does not support it."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    os.ftruncate(fd, size)
+
+
+def _map_shared(path):
+    if path is None:
+        return b''
+    with open(path, 'rb') as f:
+        # The mapping stays valid after the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read_shared(path, layout):
+    """Map a file written by ``_write_shared`` and remove it.
+
+    The returned arrays and memoryviews are read-only views of the mapping,
+    which is released when they are all garbage collected.
+    """
+    shared = _map_shared(path)
+    if path is not None:
+        os.remove(path)
+
+    components = []
+    for entry in layout:
+        if entry[0] == 'array':
+            _, offset, dtype, shape = entry
+            count = int(numpy.prod(shape, dtype=numpy.int64))
+            array = numpy.frombuffer(shared, dtype=dtype, count=count, offset=offset)
+            components.append(array.reshape(shape))
+        elif entry[0] == 'packed':
+            _, offset, shape = entry
+            packed = numpy.frombuffer(
+                shared, dtype=numpy.uint8, count=bit_masks.packed_size(int(numpy.prod(shape, dtype=numpy.int64))),
+                offset=offset
+            )
+            components.append(bit_masks.PackedMask(shape, packed=packed))
+        else:
+            _, offset, nbytes = entry
+            components.append(memoryview(shared)[offset:offset + nbytes])
+    return components
+
+
+def _call_model(model_fn, json_input, input_path, input_layout, input_digests, input_digest,
+                shm_dir):
+    """Run model_fn in a worker process on the parts in a shared memory file."""
+    shared = _map_shared(input_path)
+    view = memoryview(shared)
+    dicom_instances = [
+        buffers.BufferReader(view[offset:offset + nbytes], part_digest)
+        for (_, offset, nbytes), part_digest in zip(input_layout, input_digests)
+    ]
+    try:
+        response_json, binary_components = model_fn(json_input, dicom_instances, input_digest)
+        output_path, output_layout = _write_shared(
+            [buffers.as_buffer(c) for c in binary_components], shm_dir
+        )
+    finally:
+        try:
+            for dicom in dicom_instances:
+                dicom.getbuffer().release()
+            view.release()
+            if isinstance(shared, mmap.mmap):
+                shared.close()
+        except BufferError:
+            # The model kept a view of its input, leave it to the GC
+            pass
+    return response_json, output_path, output_layout
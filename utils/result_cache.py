@@ -0,0 +1,235 @@
+"""
+Content-addressed cache of inference results.
+
+Results are keyed by the inference route and the input digest computed by the
+gateway, so a study that is sent again gets the stored response replayed
+without running the model. Entries live in an in-memory LRU tier bounded by a
+byte budget, and optionally in a directory that survives restarts.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+
+from utils import buffers
+
+logger = logging.getLogger('result_cache')
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+WRITE_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class CachedResult():
+    """A serialized inference response.
+
+    :param str json_text: the JSON part of the response, exactly as sent.
+    :param list(2-tuple(str, obj)) parts: one (mime-type, bytes-like) tuple
+     for each binary part of the response.
+    :param str output_digest: digest of the response sent in the hashes part.
+    :param list(str) part_digests: optional hex digest of each binary part.
+    :param callable digests: for a result whose parts are still being hashed,
+     instead of output_digest and part_digests, function waiting for the
+     hashes and returning the (output_digest, part_digests) tuple. It is
+     called the first time either of them is read, so the parts can be sent
+     while they are hashed.
+    """
+
+    def __init__(self, json_text, parts, output_digest=None, part_digests=None, digests=None):
+        self.json_text = json_text
+        self.parts = parts
+        self._output_digest = output_digest
+        self._part_digests = part_digests
+        self._digests = digests
+        self._lock = threading.Lock()
+
+    @property
+    def output_digest(self):
+        self._wait_digests()
+        return self._output_digest
+
+    @property
+    def part_digests(self):
+        self._wait_digests()
+        return self._part_digests
+
+    @property
+    def nbytes(self):
+        return len(self.json_text) + sum(buffers.nbytes(p) for _, p in self.parts)
+
+    def _wait_digests(self):
+        # Requests sharing the result wait for the same hashes
+        with self._lock:
+            if self._digests is not None:
+                self._output_digest, self._part_digests = self._digests()
+                self._digests = None
+
+
+class ResultCache():
+    """Two-tier LRU cache of inference results.
+
+    :param int max_bytes: budget of the in-memory tier. Results larger than
+     the budget are only stored on disk.
+    :param str directory: optional directory for the on-disk tier. Entries in
+     it are kept across restarts.
+    :param int max_disk_bytes: optional budget of the on-disk tier, the least
+     recently used files are removed when it is exceeded.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(route, input_digest):
+        return '{}:{}'.format(route, input_digest)
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        with self._lock:
+            stats = {
+                'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0,
+                'disk_evictions': 0,
+            }
+            stats.update(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
+
+    def get(self, key):
+        """Return the CachedResult stored for key, or None."""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return result
+
+        result = self._read_file(key)
+        with self._lock:
+            if result is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+            self._insert(key, result)
+        return result
+
+    def put(self, key, result):
+        """Store a CachedResult in every tier it fits in."""
+        with self._lock:
+            self._insert(key, result)
+        self._write_file(key, result)
+
+    def _insert(self, key, result):
+        nbytes = result.nbytes
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = result
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._counters['evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _read_file(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                offset = f.tell()
+                # The parts are views of the mapped file, they are paged in
+                # as they are sent instead of being read into memory. The
+                # mapping outlives a later replacement or removal of the file.
+                content = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            json_text = str(content[offset:offset + header['json_size']], 'utf-8')
+            offset += header['json_size']
+            parts = []
+            for content_type, size in header['parts']:
+                parts.append((content_type, content[offset:offset + size]))
+                offset += size
+            if offset != len(content):
+                raise ValueError('size does not match its header')
+            # Keep the file at the recent end of the disk LRU order
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('ignoring unreadable cache file for %s: %s' % (key, e))
+            return None
+        return CachedResult(
+            json_text, parts, header['output_digest'], header.get('part_digests')
+        )
+
+    def _write_file(self, key, result):
+        if self.directory is None:
+            return
+        json_bytes = result.json_text.encode('utf-8')
+        header = {
+            'key': key,
+            'output_digest': result.output_digest,
+            'part_digests': result.part_digests,
+            'json_size': len(json_bytes),
+            'parts': [(content_type, buffers.nbytes(p)) for content_type, p in result.parts],
+        }
+        # Write to a temporary file first so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(json_bytes)
+                for _, part in result.parts:
+                    for chunk in buffers.iter_chunks(part, WRITE_CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning('failed to write cache file for %s: %s' % (key, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._prune_directory(self._path(key))
+
+    def _prune_directory(self, newest_path):
+        if self.max_disk_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # The file just written goes last even if the clock did not tick
+            entries.append(((path == newest_path, st.st_mtime_ns), st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self._counters['disk_evictions'] += 1
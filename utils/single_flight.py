@@ -0,0 +1,65 @@
+"""
+Coalescing of concurrent calls that compute the same result.
+
+The first caller for a key runs the computation, callers arriving while it is
+in flight wait for it and receive the same result or exception.
+"""
+
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Run at most one computation per key at a time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Call fn, unless a call for key is already in flight.
+
+        :param str key: identifies the computation.
+        :param callable fn: function without arguments computing the result.
+        :return: 2-tuple of the result and whether it was shared with another
+         caller instead of being computed by this one.
+        :raises: the exception raised by fn, in the leader and every follower.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, False
+
+    def in_flight(self):
+        """Return the number of keys currently being computed."""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,180 @@
+"""
+Sparse segmentation masks.
+
+Models that find a few small lesions return masks that are almost entirely
+zeros, yet a dense (depth, height, width) array of the whole study has to be
+allocated to return them. A SparseMask only stores the crops and runs of its
+non-zero voxels, slice by slice. Handlers return it in place of the dense
+array, and the gateway expands one slice at a time while it hashes and sends
+the mask, so the dense volume is never allocated.
+"""
+
+import numpy
+
+from utils import buffers
+
+
+class SparseMask(buffers.ChunkedBuffer):
+    """A mask stored as crops and runs of its non-zero slices.
+
+    Slices are the last two axes of the mask, and are indexed by the leading
+    axes, e.g. ``(t, z)`` for a (timepoints, depth, height, width) mask, or
+    ``z`` for a (depth, height, width) one. Crops and runs added later
+    overwrite earlier ones where they overlap.
+
+    :param tuple shape: shape of the mask, at least (height, width).
+    :param dtype: numpy dtype of the mask.
+    """
+
+    def __init__(self, shape, dtype=numpy.uint8):
+        if len(shape) < 2:
+            raise ValueError('a mask has at least 2 dimensions, got shape {}'.format(shape))
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = numpy.dtype(dtype)
+        # Flat slice index -> list of ('crop', row, column, array) and
+        # ('runs', starts, lengths, value) in the order they were added
+        self._slices = {}
+        self._zeros = None
+
+    @classmethod
+    def from_dense(cls, array):
+        """Return the SparseMask of a dense array, with one crop for the
+        bounding box of the non-zero values of each slice."""
+        array = numpy.asarray(array)
+        mask = cls(array.shape, array.dtype)
+        slices = array.reshape((-1,) + array.shape[-2:])
+        rows = slices.any(axis=2)
+        columns = slices.any(axis=1)
+        for i in numpy.flatnonzero(rows.any(axis=1)):
+            top, bottom = _extent(rows[i])
+            left, right = _extent(columns[i])
+            mask._add(i, ('crop', top, left, slices[i, top:bottom, left:right].copy()))
+        return mask
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape, dtype=numpy.int64)) * self.dtype.itemsize
+
+    @property
+    def slice_shape(self):
+        return self.shape[-2:]
+
+    @property
+    def stored_nbytes(self):
+        """Size of the stored crops and runs."""
+        return sum(
+            _stored_nbytes(item[3]) if item[0] == 'crop' else item[1].nbytes + item[2].nbytes
+            for items in self._slices.values() for item in items
+        )
+
+    def add_crop(self, index, row, column, crop):
+        """Set the values of a rectangle of a slice.
+
+        :param index: index of the slice in the leading axes, an int or a tuple.
+        :param int row: first row of the rectangle.
+        :param int column: first column of the rectangle.
+        :param crop: 2D array of the values of the rectangle. It is not
+         copied, and may be a broadcast array, e.g.
+         ``numpy.broadcast_to(255, (rows, columns))``.
+        """
+        crop = numpy.asarray(crop)
+        height, width = self.slice_shape
+        if (crop.ndim != 2 or row < 0 or column < 0
+                or row + crop.shape[0] > height or column + crop.shape[1] > width):
+            raise ValueError('crop of shape {} at ({}, {}) is outside slices of shape {}'.format(
+                crop.shape, row, column, self.slice_shape
+            ))
+        self._add(self._flat_index(index), ('crop', row, column, crop))
+
+    def fill_box(self, index, top, left, bottom, right, value=255):
+        """Set the values of the rectangle [top, bottom) x [left, right) of a
+        slice to a constant, without allocating it."""
+        self.add_crop(index, top, left, numpy.broadcast_to(
+            numpy.array(value, dtype=self.dtype), (max(bottom - top, 0), max(right - left, 0))
+        ))
+
+    def add_runs(self, index, starts, lengths, value=255):
+        """Set runs of values of a slice to a constant.
+
+        :param index: index of the slice in the leading axes.
+        :param starts: offsets of the first value of the runs in the
+         row-major order of the slice.
+        :param lengths: lengths of the runs.
+        :param value: value of the runs.
+        """
+        starts = numpy.asarray(starts, dtype=numpy.int64).reshape(-1)
+        lengths = numpy.asarray(lengths, dtype=numpy.int64).reshape(-1)
+        if starts.shape != lengths.shape:
+            raise ValueError('runs need as many starts as lengths')
+        size = self.slice_shape[0] * self.slice_shape[1]
+        if len(starts) and (starts.min() < 0 or lengths.min() < 0 or (starts + lengths).max() > size):
+            raise ValueError('runs are outside slices of {} values'.format(size))
+        self._add(self._flat_index(index), ('runs', starts, lengths, value))
+
+    def get_slice(self, index):
+        """Return a new dense array of a slice."""
+        return self._expand(self._flat_index(index))
+
+    def iter_chunks(self):
+        """Iterate over the dense slices, in row-major order. Empty slices
+        share a read-only array of zeros."""
+        for i in range(self._slice_count()):
+            if i in self._slices:
+                yield self._expand(i)
+            else:
+                yield self._zero_slice()
+
+    def toarray(self):
+        """Return the dense mask, e.g. to check it in tests."""
+        return numpy.concatenate(
+            [s.reshape(1, -1) for s in self.iter_chunks()] or [numpy.empty((0, 0), self.dtype)]
+        ).reshape(self.shape)
+
+    def _add(self, i, item):
+        self._slices.setdefault(i, []).append(item)
+
+    def _slice_count(self):
+        return int(numpy.prod(self.shape[:-2], dtype=numpy.int64))
+
+    def _flat_index(self, index):
+        leading = self.shape[:-2]
+        index = (index,) if numpy.ndim(index) == 0 else tuple(index)
+        if len(index) != len(leading):
+            raise IndexError('slices of a mask of shape {} have {} indices'.format(self.shape, len(leading)))
+        return int(numpy.ravel_multi_index(index, leading)) if leading else 0
+
+    def _zero_slice(self):
+        if self._zeros is None:
+            zeros = numpy.zeros(self.slice_shape, dtype=self.dtype)
+            zeros.flags.writeable = False
+            self._zeros = zeros
+        return self._zeros
+
+    def _expand(self, i):
+        values = numpy.zeros(self.slice_shape, dtype=self.dtype)
+        flat = values.reshape(-1)
+        for item in self._slices.get(i, ()):
+            if item[0] == 'crop':
+                _, row, column, crop = item
+                values[row:row + crop.shape[0], column:column + crop.shape[1]] = crop
+            else:
+                _, starts, lengths, value = item
+                total = int(lengths.sum())
+                # Offset of each value of the runs: the start of its run plus
+                # its position in the run
+                run_starts = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+                flat[run_starts + numpy.arange(total)] = value
+        return values
+
+
+def _extent(flags):
+    """Return the first index and one past the last index of the true values."""
+    indices = numpy.flatnonzero(flags)
+    return int(indices[0]), int(indices[-1]) + 1
+
+
+def _stored_nbytes(array):
+    """Return the size of the memory of an array, broadcast axes excluded."""
+    return array.itemsize * int(numpy.prod(
+        [n for n, stride in zip(array.shape, array.strides) if stride != 0], dtype=numpy.int64
+    ))
@@ -0,0 +1,133 @@
+"""
+DICOM instances read from a study directory instead of a request body.
+
+A request with an ``application/json`` body holding a ``studyPath`` points the
+gateway at a study on a volume mounted in the container, so the instances are
+not copied through HTTP. The files of the directory are memory-mapped
+read-only, a pool of threads opens them and asks the kernel to read them
+ahead concurrently, and each one stands in for the multipart part of an
+uploaded instance, so handlers get the same dicom_instances either way.
+"""
+
+import concurrent.futures
+import mmap
+import os
+import threading
+
+from utils import multipart
+
+DEFAULT_MAX_WORKERS = min(8, 2 * (os.cpu_count() or 1))
+# DICOM files start with a 128 bytes preamble and this prefix
+DICOM_PREFIX = b'DICM'
+_PREFIX_OFFSET = 128
+
+
+class FilePart(multipart.BodyPart):
+    """A memory-mapped DICOM file, in place of a part of a multipart body.
+
+    :param str path: path of the file.
+    :param mmap.mmap file_mmap: read-only memory map of the whole file.
+    """
+
+    def __init__(self, path, file_mmap):
+        super().__init__({'content-type': 'application/dicom'}, 'utf-8', spill_threshold=0)
+        self.path = path
+        self.size = len(file_mmap)
+        self._mmap = file_mmap
+        self.buffer = memoryview(file_mmap)
+
+
+def resolve(study_path, roots):
+    """Return the real path of a study directory.
+
+    :param str study_path: the studyPath of a request.
+    :param roots: directories studies may be read from.
+    :raises ValueError: if the path is not a directory under one of the roots.
+    """
+    path = os.path.realpath(study_path)
+    if not any(os.path.commonpath([path, root]) == root for root in map(os.path.realpath, roots)):
+        raise ValueError('studyPath {} is not under an allowed directory'.format(study_path))
+    if not os.path.isdir(path):
+        raise ValueError('studyPath {} is not a directory'.format(study_path))
+    return path
+
+
+def scan(study_path):
+    """Return the paths of the regular files of a directory and its
+    subdirectories, hidden ones excluded, in sorted order."""
+    paths = []
+    for directory, subdirectories, filenames in os.walk(study_path):
+        subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+        paths.extend(
+            os.path.join(directory, filename) for filename in filenames if not filename.startswith('.')
+        )
+    return sorted(paths)
+
+
+def open_file(path):
+    """Memory-map a DICOM file and start reading it ahead.
+
+    :return: FilePart, or None if the file is not a DICOM file with a preamble.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _PREFIX_OFFSET + len(DICOM_PREFIX):
+            return None
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+        file_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if file_mmap[_PREFIX_OFFSET:_PREFIX_OFFSET + len(DICOM_PREFIX)] != DICOM_PREFIX:
+        file_mmap.close()
+        return None
+    return FilePart(path, file_mmap)
+
+
+class StudyLoader():
+    """Open the DICOM files of study directories in a thread pool.
+
+    :param int max_workers: number of threads opening files, more than the
+     number of CPUs helps on network volumes.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def load(self, study_path):
+        """Open the DICOM files of a directory, other files are skipped.
+
+        :param str study_path: the directory, see ``resolve``.
+        :return: list of FilePart, sorted by path.
+        :raises OSError: if a file cannot be read, no file is left open.
+        """
+        futures = [self._get_executor().submit(open_file, path) for path in scan(study_path)]
+        parts = []
+        error = None
+        for future in futures:
+            try:
+                part = future.result()
+            except OSError as e:
+                error = error or e
+                continue
+            if part is not None:
+                parts.append(part)
+        if error is not None:
+            for part in parts:
+                part.close()
+            raise error
+        return parts
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='study'
+                )
+            return self._executor
@@ -1,5 +1,9 @@
+import contextlib
 import logging
 import json
+import time
+
+from utils import tracing
 
 class TaggedLogger(logging.LoggerAdapter):
     """
@@ -48,3 +52,17 @@ class TaggedLogger(logging.LoggerAdapter):
         t = TaggedLogger(self)
         t.add_tags(tags);
         return t
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Record the block of this context manager as a span of the trace of the request being
+        processed, e.g. to time the preprocessing, forward pass and postprocessing of a model. The
+        span is tagged with the persistent tags, and its duration is logged at debug level.
+        """
+        start = time.perf_counter()
+        try:
+            with tracing.span(name, **self.tags) as s:
+                yield s
+        finally:
+            self.debug('{} took {:.3f} ms'.format(name, (time.perf_counter() - start) * 1000))
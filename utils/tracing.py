@@ -0,0 +1,153 @@
+"""
+Per-request span tracing.
+
+The gateway records a tree of timed spans for each inference request, e.g.
+decoding, running the model and encoding the response. The spans are summed up
+in the Server-Timing header of the response, and sampled traces are written as
+Chrome trace event files that can be opened in chrome://tracing or Perfetto.
+
+Code running while a request is processed, e.g. a model handler, can add its
+own spans with ``span``, or ``TaggedLogger.span``.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+# (trace, span) the spans opened in this context are added to
+_current = contextvars.ContextVar('inference_trace', default=(None, None))
+
+
+class Span():
+    """A timed operation of a trace."""
+
+    def __init__(self, name, start, end=None, parent=None, attributes=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.thread_id = threading.get_ident()
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+
+class Trace():
+    """Spans recorded while processing one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans = []
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Context manager recording a span around its block.
+
+        Spans opened inside the block, in the same thread, are its children.
+        """
+        trace, parent = _current.get()
+        if trace is not self:
+            parent = None
+        span = self.add_span(name, time.perf_counter(), parent=parent, **attributes)
+        token = _current.set((self, span))
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+
+    def add_span(self, name, start, end=None, parent=None, **attributes):
+        """Record a span with explicit times from ``time.perf_counter``."""
+        span = Span(name, start, end, parent, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header.
+
+        The durations of the finished top-level spans are summed by name, in
+        milliseconds, followed by the total time since the trace started.
+        """
+        durations = {}
+        with self._lock:
+            for span in self.spans:
+                if span.parent is None and span.end is not None:
+                    durations[span.name] = durations.get(span.name, 0) + span.duration
+        durations['total'] = time.perf_counter() - self.start
+        return ', '.join(
+            '{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in durations.items()
+        )
+
+    def to_chrome_trace(self):
+        """Return the trace as a Chrome trace event format dictionary."""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {
+                'name': span.name,
+                'cat': 'inference',
+                'ph': 'X',
+                'ts': (self.wall_start + span.start - self.start) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': span.attributes,
+            }
+            for span in spans
+        ]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': dict(self.tags)}
+
+    def write(self, directory, name):
+        """Write the trace as a Chrome trace event JSON file.
+
+        :param str directory: directory of the file, created if needed.
+        :param str name: file name without the .json extension.
+        :return: the path of the file.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '{}.json'.format(name))
+        # Write to a temporary file first so readers never see partial traces
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+        os.replace(tmp_path, path)
+        return path
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Context manager making this the trace of ``span`` calls in its block."""
+        token = _current.set((self, None))
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+
+def current_trace():
+    """Return the trace of the request being processed, or None."""
+    trace, _ = _current.get()
+    return trace
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Context manager recording a span in the trace of the request being
+    processed. Does nothing outside of a request."""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attributes) as s:
+        yield s
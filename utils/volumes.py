@@ -0,0 +1,222 @@
+"""
+Assembly of the DICOM instances of a request into volumes.
+
+The instances of a series are sorted by the projection of their
+ImagePositionPatient onto the normal of their ImageOrientationPatient, split
+into timepoints when several instances share a position, and their pixels
+are decoded straight into a preallocated (timepoints, depth, height, width)
+array. That is the layout of the segmentation masks returned to the gateway,
+so a mask computed on the volume can be returned as is.
+"""
+
+import numpy
+from pydicom.pixel_data_handlers.util import pixel_dtype
+
+from utils import lazy_instances
+from utils import sparse_masks
+
+# Instances closer than this many millimeters are at the same position
+POSITION_TOLERANCE = 1e-3
+
+
+class Volume():
+    """The instances of a series stacked into a volume.
+
+    :param numpy.ndarray pixels: stored pixel values, of shape (timepoints,
+     depth, height, width), plus a trailing samples axis for color images.
+     None if the volume was assembled without pixels.
+    :param list instances: LazyInstance objects in volume order, i.e. the
+     instance of slice z of timepoint t is ``instances[t * depth + z]``.
+    :param tuple shape: (timepoints, depth, height, width).
+    :param str series_instance_uid: SeriesInstanceUID of the instances.
+    :param tuple spacing: (slice, row, column) spacing in millimeters.
+    :param numpy.ndarray origin: ImagePositionPatient of the first slice, or
+     None if unknown.
+    :param numpy.ndarray direction: 3x3 array of the row direction, column
+     direction and slice normal, or None if unknown.
+    """
+
+    def __init__(self, pixels, instances, shape, series_instance_uid, spacing, origin, direction):
+        self.pixels = pixels
+        self.instances = instances
+        self.shape = shape
+        self.series_instance_uid = series_instance_uid
+        self.spacing = spacing
+        self.origin = origin
+        self.direction = direction
+
+    @property
+    def timepoints(self):
+        return self.shape[0]
+
+    @property
+    def depth(self):
+        return self.shape[1]
+
+    @property
+    def height(self):
+        return self.shape[2]
+
+    @property
+    def width(self):
+        return self.shape[3]
+
+    def binary_data_shape(self):
+        """Return the ``binary_data_shape`` of a mask of this volume."""
+        return {
+            'timepoints': self.timepoints,
+            'depth': self.depth,
+            'width': self.width,
+            'height': self.height,
+        }
+
+    def mask_part(self, label, binary_type='probability_mask', **fields):
+        """Return the JSON part describing a mask of this volume.
+
+        :param str label: label of the mask.
+        :param str binary_type: binary type of the mask.
+        :param fields: other fields of the part, e.g. probability_threshold.
+        """
+        part = {
+            'label': label,
+            'binary_type': binary_type,
+            'binary_data_shape': self.binary_data_shape(),
+            'SeriesInstanceUID': self.series_instance_uid,
+        }
+        part.update(fields)
+        return part
+
+    def new_mask(self, dtype=numpy.uint8):
+        """Return an empty mask of this volume, in the layout the gateway
+        sends it in."""
+        return numpy.zeros(self.shape, dtype=dtype)
+
+    def new_sparse_mask(self, dtype=numpy.uint8):
+        """Return an empty SparseMask of this volume, whose slices are
+        indexed by (timepoint, slice)."""
+        return sparse_masks.SparseMask(self.shape, dtype)
+
+
+def assemble_volumes(dicom_instances, pixels=True, decode_pool=None):
+    """Assemble the instances of a request into one volume per series.
+
+    :param list dicom_instances: the dicom_instances passed to a handler,
+     lazy or not.
+    :param bool pixels: whether to decode the pixels, otherwise only the
+     geometry of the volumes is computed from the headers.
+    :param utils.decoding.DecodePool decode_pool: optional pool decoding the
+     instances of a series in parallel.
+    :return: list of Volume, in the order the series first appear.
+    """
+    if not isinstance(dicom_instances, lazy_instances.InstanceList):
+        dicom_instances = lazy_instances.to_instance_list(dicom_instances)
+    return [
+        assemble_volume(dicom_instances.series(series_uid), pixels, decode_pool)
+        for series_uid in dicom_instances.series_uids()
+    ]
+
+
+def assemble_volume(instances, pixels=True, decode_pool=None):
+    """Assemble the instances of a single series into a volume.
+
+    Instances without ImagePositionPatient or ImageOrientationPatient are
+    kept in request order, as a single timepoint.
+
+    :param list instances: LazyInstance objects of the series.
+    :param bool pixels: whether to decode the pixels.
+    :param utils.decoding.DecodePool decode_pool: optional pool decoding the
+     instances in parallel.
+    :return: Volume
+    :raises ValueError: if the instances do not form a volume, e.g. their
+     sizes differ or timepoints have different numbers of slices.
+    """
+    headers = [instance.header for instance in instances]
+    first = headers[0]
+    if len(headers) > 1 and any(int(h.get('NumberOfFrames', 1)) > 1 for h in headers):
+        raise ValueError('series with several multi-frame instances are not supported')
+    if any((h.Rows, h.Columns) != (first.Rows, first.Columns) for h in headers):
+        raise ValueError('instances of series {} have different sizes'.format(first.SeriesInstanceUID))
+
+    order, timepoints, slice_spacing, origin, direction = _sort(headers)
+    depth = len(instances) // timepoints
+    frames = int(first.get('NumberOfFrames', 1))
+    if frames > 1:
+        depth = frames
+    shape = (timepoints, depth, first.Rows, first.Columns)
+
+    row_spacing, column_spacing = (float(s) for s in first.get('PixelSpacing', (1.0, 1.0)))
+    if slice_spacing is None:
+        slice_spacing = float(first.get('SliceThickness', 1.0) or 1.0)
+
+    instances = [instances[i] for i in order]
+    volume_pixels = None
+    if pixels:
+        volume_pixels = _decode(instances, first, shape, decode_pool)
+    return Volume(
+        volume_pixels, instances, shape, first.SeriesInstanceUID,
+        (slice_spacing, row_spacing, column_spacing), origin, direction
+    )
+
+
+def _sort(headers):
+    """Return the volume order of the instances, the number of timepoints,
+    the slice spacing, the origin and the direction of a series."""
+    request_order = numpy.arange(len(headers))
+    if any('ImagePositionPatient' not in h or 'ImageOrientationPatient' not in h for h in headers):
+        return request_order, 1, None, None, None
+
+    positions = numpy.array([h.ImagePositionPatient for h in headers], dtype=numpy.float64)
+    orientation = numpy.array(headers[0].ImageOrientationPatient, dtype=numpy.float64)
+    normal = numpy.cross(orientation[:3], orientation[3:])
+    direction = numpy.stack([orientation[:3], orientation[3:], normal])
+
+    # A stable sort keeps the request order of instances at the same position
+    order = numpy.argsort(positions @ normal, kind='stable')
+    positions = positions[order]
+
+    # Instances at the same position are next to each other once sorted, a
+    # position starts at the first instance away from the previous one
+    starts = [0]
+    for i in range(1, len(positions)):
+        if numpy.linalg.norm(positions[i] - positions[starts[-1]]) >= POSITION_TOLERANCE:
+            starts.append(i)
+    counts = numpy.diff(starts + [len(positions)])
+    timepoints = int(counts[0])
+    if numpy.any(counts != timepoints):
+        raise ValueError(
+            'series positions have from {} to {} instances, they must all have '
+            'one per timepoint'.format(counts.min(), counts.max())
+        )
+    depth = len(starts)
+
+    # Slices of the same position are ordered in time by InstanceNumber,
+    # then the (depth, timepoints) grid is transposed to timepoint-major
+    grid = order.reshape(depth, timepoints)
+    if timepoints > 1:
+        instance_numbers = numpy.array(
+            [int(headers[i].get('InstanceNumber', 0) or 0) for i in order]
+        ).reshape(depth, timepoints)
+        grid = numpy.take_along_axis(grid, numpy.argsort(instance_numbers, axis=1, kind='stable'), axis=1)
+    order = grid.T.reshape(-1)
+
+    slice_spacing = None
+    if depth > 1:
+        slice_positions = positions[::timepoints] @ normal
+        slice_spacing = float(numpy.median(numpy.diff(slice_positions)))
+    return order, timepoints, slice_spacing, positions[0], direction
+
+
+def _decode(instances, header, shape, decode_pool):
+    """Decode the pixels of the instances into a new (t, z, y, x) array."""
+    samples = int(header.get('SamplesPerPixel', 1))
+    full_shape = shape + ((samples,) if samples > 1 else ())
+    dtype = pixel_dtype(header)
+    if decode_pool is not None:
+        return decode_pool.decode(instances, full_shape, dtype)
+
+    volume = numpy.empty(full_shape, dtype=dtype)
+    # One row per instance, a single multi-frame instance fills the volume
+    slots = volume.reshape(len(instances), -1)
+    for i, instance in enumerate(instances):
+        slots[i] = instance.read_pixels().reshape(-1)
+    return volume